@@ -0,0 +1,137 @@
+# -*- encoding: utf-8 -*-
+"""Measure with tracemalloc the memory used by the state the backend keeps
+for concurrent envelopes: one event per envelope, going through a worker
+and a consumer.
+
+The current :class:`.Envelope`, :class:`.Event` and node classes are
+compared with replicas of their former layout: plain objects with a
+__dict__ and a future created upfront for each envelope and node::
+
+    python benchmarks/bench_memory.py --envelopes 20000
+"""
+
+import argparse
+import asyncio
+import tracemalloc
+import uuid
+
+from xbus.broker.core.back.envelope import Envelope
+
+
+class LegacyNode(object):
+
+    def __init__(self, envelope_id, event_id, node_id, loop):
+        self.envelope_id = envelope_id
+        self.event_id = event_id
+        self.node_id = node_id
+        self.sent = 0
+        self.recv = -1
+        self.loop = loop
+        self.active = False
+        self.done = False
+        self.trigger = asyncio.Future(loop=loop)
+        self.pending = None
+        self.acked = -1
+        self.skip_until = -1
+
+
+class LegacyEvent(object):
+
+    def __init__(self, envelope_id, event_id, type_name, type_id, loop):
+        self.envelope_id = envelope_id
+        self.event_id = event_id
+        self.type_name = type_name
+        self.type_id = type_id
+        self.nodes = {}
+        self.start = []
+        self.loop = loop
+        self.immediate_reply = False
+        self.started = 0.0
+        self.digest = None
+        self.deferred = None
+        self.cache_ttl = 0
+        self.cached = False
+
+
+class LegacyEnvelope(object):
+
+    def __init__(self, envelope_id, loop):
+        self.envelope_id = envelope_id
+        self.client_calls = set()
+        self.events = {}
+        self.dbengine = None
+        self.loop = loop
+        self.stopped = False
+        self.trigger = asyncio.Future(loop=loop)
+        self.start_event_timeout = 60
+        self.send_item_timeout = 60
+        self.end_event_timeout = 3600
+        self.end_envelope_timeout = 3600
+        self.stop_envelope_timeout = 60
+        self.spill_threshold = 0
+        self.spill_dir = None
+        self.limiter = None
+        self.tenant = None
+        self.weight = 1
+        self.blobs = None
+
+
+def legacy(envelope_id, event_id, type_id, loop):
+    envelope = LegacyEnvelope(envelope_id, loop)
+    # The type comes from the RPC call of each event: a new string each time.
+    event = LegacyEvent(
+        envelope_id, event_id, ''.join('type'), ''.join(type_id), loop
+    )
+    envelope.events[event_id] = event
+    for node_id, role_id in (('w', 'rw'), ('c', 'rc')):
+        node = LegacyNode(envelope_id, event_id, node_id, loop)
+        node.role_id = role_id
+        node.recipient = None
+        node.children = ['c'] if node_id == 'w' else None
+        event.nodes[node_id] = node
+    event.start.append(event.nodes['w'])
+    return envelope
+
+
+def current(envelope_id, event_id, type_id, loop):
+    envelope = Envelope(envelope_id, None, loop)
+    event = envelope.new_event(event_id, ''.join('type'), ''.join(type_id))
+    event.new_worker('w', 'rw', None, ('c',), True)
+    event.new_consumer('c', ['rc'], [None], False)
+    return envelope
+
+
+def measure(factory, count, loop):
+    type_id = uuid.uuid4().hex
+    ids = [(uuid.uuid4().hex, uuid.uuid4().hex) for _ in range(count)]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    envelopes = [
+        factory(envelope_id, event_id, type_id, loop)
+        for envelope_id, event_id in ids
+    ]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del envelopes
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--envelopes', type=int, default=20000)
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    baseline = measure(legacy, args.envelopes, loop)
+    size = measure(current, args.envelopes, loop)
+    loop.close()
+    for name, value in (('before', baseline), ('after', size)):
+        print('{:8} {:12,d} bytes  {:8.0f} bytes/envelope'.format(
+            name, value, value / args.envelopes
+        ))
+    print('saved    {:.1%}'.format(1 - size / baseline))
+
+
+if __name__ == '__main__':
+    main()
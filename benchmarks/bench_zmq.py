@@ -0,0 +1,96 @@
+# -*- encoding: utf-8 -*-
+"""Measure the effect of the options of the [zmq] configuration section on
+the throughput of a DEALER socket streaming items to a ROUTER socket, like
+the data plane between the front and the backend.
+
+Each option is measured alone, against the 0mq defaults, over TCP on the
+loopback interface; the defaults are also measured over ipc://::
+
+    python benchmarks/bench_zmq.py --count 200000 --size 1024
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import zmq
+
+from xbus.broker.core.transport import SOCKET_OPTIONS
+from xbus.broker.core.transport import SocketTuning
+
+CASES = [
+    ('defaults', {}),
+    ('sndhwm=100', {'sndhwm': 100}),
+    ('sndhwm=100000', {'sndhwm': 100000}),
+    ('rcvhwm=100000', {'rcvhwm': 100000}),
+    ('sndbuf=rcvbuf=4MiB', {'sndbuf': 4194304, 'rcvbuf': 4194304}),
+    ('linger=0', {'linger': 0}),
+    ('tcp_keepalive=1', {'tcp_keepalive': 1, 'tcp_keepalive_idle': 60}),
+]
+
+
+def run(context, endpoint, tuning, count, data):
+    """Send `count` items and return the number of items per second."""
+    receiver = context.socket(zmq.ROUTER)
+    tuning.apply(receiver)
+    receiver.bind(endpoint)
+    endpoint = receiver.getsockopt_string(zmq.LAST_ENDPOINT)
+
+    def send():
+        sender = context.socket(zmq.DEALER)
+        tuning.apply(sender)
+        sender.connect(endpoint)
+        for index in range(count):
+            sender.send_multipart([b'item', b'envelope', b'event', data])
+        sender.close(linger=-1)
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=send)
+    thread.start()
+    for _ in range(count):
+        receiver.recv_multipart()
+    elapsed = time.perf_counter() - start
+    thread.join()
+    receiver.close(linger=0)
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--io-threads', type=int, default=1)
+    args = parser.parse_args()
+
+    data = os.urandom(args.size)
+    context = zmq.Context(io_threads=args.io_threads)
+    print('{} items of {} bytes, {} I/O thread(s)'.format(
+        args.count, args.size, args.io_threads
+    ))
+
+    results = []
+    for name, options in CASES:
+        tuning = SocketTuning({
+            SOCKET_OPTIONS[option]: value
+            for option, value in options.items()
+        })
+        rate = run(context, 'tcp://127.0.0.1:*', tuning, args.count, data)
+        results.append(('tcp ' + name, rate))
+
+    with tempfile.TemporaryDirectory() as directory:
+        endpoint = 'ipc://' + os.path.join(directory, 'bench')
+        rate = run(context, endpoint, SocketTuning(), args.count, data)
+        results.append(('ipc defaults', rate))
+
+    context.term()
+    baseline = results[0][1]
+    for name, rate in results:
+        print('{:30} {:12.0f} items/s  {:+6.1%}'.format(
+            name, rate, rate / baseline - 1
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -58,6 +58,7 @@ setup(
         "console_scripts": [
             'setup_xbusbroker = xbus.broker.cli:setup_xbusbroker',
             'start_xbusbroker = xbus.broker.cli:start_server',
+            'replay_xbusevent = xbus.broker.cli:replay_event',
         ],
     },
 )
@@ -0,0 +1,66 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import unittest
+
+from xbus.broker.core.admission import AdmissionController
+from xbus.broker.core.admission import get_rss
+from xbus.broker.core.errors import OverloadedError
+
+
+class MockBroker(object):
+
+    def __init__(self):
+        self.envelopes = {}
+        self.queued = 0
+
+    def queued_items(self):
+        return self.queued
+
+
+class TestAdmissionController(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = MockBroker()
+        self.admission = AdmissionController(
+            self.broker, max_lag=0.5, max_envelopes=2, max_queued=10
+        )
+
+    def test_thresholds(self):
+        """new envelopes are refused while a threshold is crossed"""
+        self.admission.sample()
+        self.admission.check()
+
+        self.broker.envelopes = {1: None, 2: None, 3: None}
+        self.admission.sample()
+        with self.assertRaises(OverloadedError):
+            self.admission.check()
+
+        self.broker.envelopes = {}
+        self.broker.queued = 11
+        self.admission.sample()
+        with self.assertRaises(OverloadedError):
+            self.admission.check()
+
+        self.broker.queued = 0
+        self.admission.lag = 1.0
+        self.admission.sample()
+        with self.assertRaises(OverloadedError):
+            self.admission.check()
+
+        self.admission.lag = 0.0
+        self.admission.sample()
+        self.admission.check()
+        snapshot = self.admission.snapshot()
+        assert snapshot['rejected'] == 3
+        assert snapshot['overloaded'] is False
+
+    def test_rss(self):
+        """the memory threshold only applies when the RSS is known"""
+        rss = get_rss()
+        if rss is None:
+            self.skipTest('No /proc on this system')
+        self.admission.max_rss = rss // 2
+        self.admission.sample()
+        with self.assertRaises(OverloadedError):
+            self.admission.check()
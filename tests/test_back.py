@@ -0,0 +1,31 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import unittest
+
+from xbus.broker.core.back import XbusBrokerBack
+
+
+class TestReplayEvent(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.broker = XbusBrokerBack(
+            None, 'inproc://#front', 'inproc://#back', loop=self.loop
+        )
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_finished_replay_forgotten(self):
+        """finished replays are forgotten even if nobody asks for them"""
+        self.broker.replay_ttl = 0.01
+        # No database: the replay fails right away.
+        replay_id = self.loop.run_until_complete(
+            self.broker.replay_event('0' * 32, ['node'])
+        )
+        assert replay_id in self.broker.replays
+        self.loop.run_until_complete(asyncio.sleep(0.05, loop=self.loop))
+        assert replay_id not in self.broker.replays
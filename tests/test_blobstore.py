@@ -0,0 +1,69 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import hashlib
+import os
+import tempfile
+import time
+import unittest
+
+from xbus.broker.core.blobstore import BlobRef
+from xbus.broker.core.blobstore import BlobStore
+from xbus.broker.core.back.spill import SpillQueue
+
+
+class TestBlobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = BlobStore(self.directory.name, threshold=4)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_write_once(self):
+        """blobs are named after their SHA-256 and only written once"""
+        data = b'x' * 100
+        handle = self.store.write(data)
+        assert handle == hashlib.sha256(data).hexdigest()
+        assert self.store.exists(handle)
+        assert self.store.read(handle) == data
+
+        path = self.store.path_for(handle)
+        os.utime(path, (0, 0))
+        assert self.store.write(data) == handle
+        assert os.stat(path).st_mtime > 0, "The blob should be kept longer"
+
+    def test_accepts(self):
+        """only large items are claim checked"""
+        assert not self.store.accepts(b'abc')
+        assert self.store.accepts(b'abcd')
+
+    def test_invalid_handle(self):
+        """handles cannot point outside of the store"""
+        with self.assertRaises(ValueError):
+            self.store.path_for('../../etc/passwd')
+        assert not self.store.exists('../../etc/passwd')
+        with self.assertRaises(FileNotFoundError):
+            self.store.read('0' * 64)
+
+    def test_sweep(self):
+        """blobs unused for max_age seconds are removed"""
+        self.store.max_age = 60
+        old = self.store.write(b'old data')
+        new = self.store.write(b'new data')
+        past = time.time() - 120
+        os.utime(self.store.path_for(old), (past, past))
+        assert self.store.sweep() == 1
+        assert not self.store.exists(old)
+        assert self.store.exists(new)
+
+    def test_spill_queue(self):
+        """claim checks are kept in memory by the spill queues"""
+        queue = SpillQueue(threshold=0)
+        blob = BlobRef('0' * 64, 1000)
+        handle = queue.push(blob)
+        assert queue.segment is None
+        assert queue.memory_size == 0
+        assert queue.pop(handle) is blob
+        queue.close()
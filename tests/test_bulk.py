@@ -0,0 +1,42 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import struct
+import unittest
+import uuid
+
+from xbus.broker.core.front.bulk import COPY_SIGNATURE
+from xbus.broker.core.front.bulk import ItemCopier
+from xbus.broker.core.front.bulk import encode_copy_rows
+
+
+class TestEncodeCopyRows(unittest.TestCase):
+
+    def test_binary_format(self):
+        """rows are encoded as the COPY binary format expects them"""
+        event_id = uuid.uuid4()
+        payload = encode_copy_rows([
+            {'event_id': event_id.hex, 'index': 7, 'data': b'abc'},
+            {'event_id': event_id.hex, 'index': 8, 'data': None},
+        ])
+        assert payload.startswith(COPY_SIGNATURE)
+        pos = len(COPY_SIGNATURE) + 8
+
+        fields, uuid_len = struct.unpack_from('!hi', payload, pos)
+        assert (fields, uuid_len) == (3, 16)
+        pos += 6
+        assert payload[pos:pos + 16] == event_id.bytes
+        pos += 16
+        assert struct.unpack_from('!iii', payload, pos) == (4, 7, 3)
+        pos += 12
+        assert payload[pos:pos + 3] == b'abc'
+        pos += 3
+
+        pos += 6 + 16
+        assert struct.unpack_from('!iii', payload, pos) == (4, 8, -1)
+        pos += 12
+        assert payload[pos:] == struct.pack('!h', -1)
+
+    def test_supports(self):
+        """COPY is only used with PostgreSQL"""
+        assert not ItemCopier.supports('sqlite:///xbus.db')
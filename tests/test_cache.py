@@ -0,0 +1,83 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import unittest
+import asyncio
+
+from xbus.broker.core.back.cache import ReplyCache
+
+
+class TestReplyCache(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.cache = ReplyCache(None, max_entries=2, loop=self.loop)
+        self.calls = 0
+
+    def tearDown(self):
+        self.loop.close()
+
+    @asyncio.coroutine
+    def compute(self):
+        self.calls += 1
+        yield from asyncio.sleep(0.01, loop=self.loop)
+        return True, 'reply {}'.format(self.calls)
+
+    def test_expiry_and_eviction(self):
+        """replies are forgotten after their TTL or when the cache is full"""
+        self.cache.put('a', 1, 60)
+        self.cache.put('b', 2, -1)
+        assert self.cache.get('a') == (True, 1)
+        assert self.cache.get('b') == (False, None), "Expired reply"
+        self.cache.put('c', 3, 60)
+        self.cache.put('d', 4, 60)
+        assert self.cache.get('a') == (False, None), "Evicted reply"
+        assert len(self.cache) == 2
+
+    def test_coalescing(self):
+        """identical concurrent requests call the consumer once"""
+        tasks = [
+            asyncio.async(
+                self.cache.fetch('key', 60, self.compute), loop=self.loop
+            )
+            for _ in range(3)
+        ]
+        res = self.loop.run_until_complete(
+            asyncio.gather(*tasks, loop=self.loop)
+        )
+        assert self.calls == 1
+        assert res[0] == (True, 'reply 1', False)
+        assert res[1] == res[2] == (True, 'reply 1', True)
+
+        res = self.loop.run_until_complete(
+            self.cache.fetch('key', 60, self.compute)
+        )
+        assert res == (True, 'reply 1', True), "Served from the cache"
+        assert not self.cache.inflight
+
+    def test_coalescing_after_failure(self):
+        """when the call fails, a single waiter calls the consumer again"""
+        @asyncio.coroutine
+        def compute():
+            self.calls += 1
+            yield from asyncio.sleep(0.01, loop=self.loop)
+            return self.calls > 1, 'reply {}'.format(self.calls)
+
+        tasks = [
+            asyncio.async(
+                self.cache.fetch('key', 60, compute), loop=self.loop
+            )
+            for _ in range(4)
+        ]
+        res = self.loop.run_until_complete(
+            asyncio.gather(*tasks, loop=self.loop)
+        )
+        assert self.calls == 2
+        assert res[0] == (False, 'reply 1', False)
+        assert sorted(res[1:]) == [
+            (True, 'reply 2', False),
+            (True, 'reply 2', True),
+            (True, 'reply 2', True),
+        ]
+        assert not self.cache.inflight
@@ -0,0 +1,54 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import os
+import tempfile
+import unittest
+
+from xbus.broker.core.back.checkpoint import Checkpointer
+from xbus.broker.core.back.envelope import Envelope
+from xbus.broker.core.back.event import Event
+from xbus.broker.core.back.node import ConsumerNode
+from xbus.broker.core.back.node import WorkerNode
+
+
+class FakeBroker(object):
+
+    def __init__(self):
+        self.envelopes = {}
+
+
+class TestCheckpointer(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'checkpoint.json')
+        self.broker = FakeBroker()
+        self.checkpointer = Checkpointer(self.broker, self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rmdir(self.directory)
+
+    def test_missing_file(self):
+        """a missing checkpoint file means nothing to recover"""
+        assert self.checkpointer.load() == {}
+
+    def test_snapshot_round_trip(self):
+        """the acknowledged index of each consumer is saved and read back"""
+        envelope = Envelope('env', None, None)
+        event = Event('env', 'evt', 'type', 'type_id')
+        worker = WorkerNode('env', 'evt', 'w1', 'r1', None, None)
+        consumer = ConsumerNode('env', 'evt', 'c1', ['r2'], None, None)
+        consumer.acked = 41
+        event.nodes = {'w1': worker, 'c1': consumer}
+        envelope.events['evt'] = event
+        self.broker.envelopes['env'] = envelope
+        self.checkpointer.recovering = {'old': {'e': {'c': 3}}}
+
+        self.checkpointer.write(self.checkpointer.snapshot())
+        assert self.checkpointer.load() == {
+            'env': {'evt': {'c1': 41}},
+            'old': {'e': {'c': 3}},
+        }
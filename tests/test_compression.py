@@ -0,0 +1,57 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import os
+import unittest
+
+from xbus.broker.model.compression import MAGIC
+from xbus.broker.model.compression import compress
+from xbus.broker.model.compression import compress_rows
+from xbus.broker.model.compression import decompress
+from xbus.broker.model.compression import decompress_rows
+
+
+class TestCompression(unittest.TestCase):
+
+    data = b'<item><name>xbus</name><value>42</value></item>' * 100
+
+    def test_round_trip(self):
+        """compressed items are smaller and read back as they were"""
+        for compression in ('zlib', 'lzma'):
+            stored = compress(self.data, compression)
+            assert stored.startswith(MAGIC)
+            assert len(stored) < len(self.data) // 5
+            assert decompress(stored) == self.data
+
+    def test_not_compressed(self):
+        """small, incompressible and old items are stored as they are"""
+        assert compress(self.data, 'none') == self.data
+        assert compress(b'small', 'zlib') == b'small'
+        noise = os.urandom(1000)
+        assert compress(noise, 'zlib') == noise
+        assert decompress(self.data) == self.data
+        assert decompress(None) is None
+
+    def test_header_without_compression(self):
+        """raw items which happen to start with the header are read as
+        they are"""
+        data = MAGIC + b'\x01not zlib data'
+        assert decompress(data) == data
+
+    def test_compress_rows(self):
+        """only the items of the events with a compression are compressed"""
+        rows = [
+            {'event_id': 'a', 'index': 0, 'data': self.data},
+            {'event_id': 'b', 'index': 0, 'data': self.data},
+        ]
+        compress_rows(rows, {'a': 'zlib'})
+        assert rows[0]['data'].startswith(MAGIC)
+        assert rows[1]['data'] == self.data
+
+    def test_decompress_rows(self):
+        """stored rows are read back with their index"""
+        rows = [
+            (0, memoryview(compress(self.data, 'lzma'))),
+            (1, self.data),
+        ]
+        assert decompress_rows(rows) == [(0, self.data), (1, self.data)]
@@ -0,0 +1,157 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import struct
+import unittest
+
+from xbus.broker.core.blobstore import BlobRef
+from xbus.broker.core.dataplane import ACK
+from xbus.broker.core.dataplane import ITEM
+from xbus.broker.core.dataplane import NACK
+from xbus.broker.core.dataplane import DataPlaneProtocol
+from xbus.broker.core.dataplane import DataPlaneReceiver
+from xbus.broker.core.dataplane import DataPlaneSender
+from xbus.broker.core.front import XbusBrokerFront
+from xbus.broker.core.trigger import Trigger
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.frames = []
+
+    def write(self, frames):
+        self.frames.append(frames)
+
+
+class FakeEnvelope(object):
+
+    def __init__(self, event_ids):
+        self.events = {event_id: event_id for event_id in event_ids}
+
+
+class FakeBack(object):
+
+    blobs = None
+
+    def __init__(self):
+        self.envelopes = {'env': FakeEnvelope(['evt'])}
+        self.dispatched = []
+
+    def dispatch_item(self, envelope, event, indices, data, forward_index):
+        self.dispatched.append((event, indices, data))
+
+
+class FakeFront(object):
+
+    def __init__(self):
+        self.acks = []
+
+    def acknowledge_items(self, envelope_id, event_id, index):
+        self.acks.append((envelope_id, event_id, index))
+
+
+class FakeBackend(object):
+
+    def __init__(self):
+        self.call = self
+        self.items = []
+
+    @asyncio.coroutine
+    def send_item(self, envelope_id, event_id, index, data):
+        self.items.append((envelope_id, event_id, index, data))
+        return 0, ''
+
+
+def item_frames(index, data, event_id=b'evt'):
+    return [
+        b'peer', ITEM, b'env', event_id, struct.pack('!Q', index), data
+    ]
+
+
+class TestDataPlane(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.back = FakeBack()
+        self.receiver = DataPlaneReceiver(self.back, loop=self.loop)
+        self.receiver.protocol = DataPlaneProtocol(self.receiver.received)
+        self.receiver.protocol.transport = FakeTransport()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_once(self):
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+
+    def test_cumulative_ack(self):
+        """items read at once are acknowledged by a single message"""
+        for index in range(3):
+            self.receiver.received(item_frames(index, b'data'))
+        assert [d[1] for d in self.back.dispatched] == [[0], [1], [2]]
+        assert self.receiver.protocol.transport.frames == []
+
+        self.run_once()
+        frames = self.receiver.protocol.transport.frames
+        assert frames == [
+            [b'peer', ACK, b'env', b'evt', struct.pack('!Q', 2)]
+        ]
+
+        front = FakeFront()
+        sender = DataPlaneSender(front, loop=self.loop)
+        sender.received(frames[0][1:])
+        assert front.acks == [('env', 'evt', 2)]
+
+    def test_unknown_event(self):
+        """items of unknown events are refused"""
+        self.receiver.received(item_frames(0, b'data', b'other'))
+        assert self.back.dispatched == []
+        frames = self.receiver.protocol.transport.frames
+        assert frames[0][1] == NACK
+        assert frames[0][-1] == b'No such event'
+
+    def test_send(self):
+        """items and claim checks are framed for the backend"""
+        sender = DataPlaneSender(FakeFront(), loop=self.loop)
+        assert not sender.send('env', 'evt', 0, b'data')
+
+        sender.protocol = DataPlaneProtocol(sender.received)
+        sender.protocol.transport = FakeTransport()
+        assert sender.send('env', 'evt', 0, b'data')
+        assert sender.send('env', 'evt', 1, BlobRef('a' * 64, 10))
+        item, blob = sender.protocol.transport.frames
+
+        self.back.blobs = None
+        self.receiver.received([b'peer'] + item)
+        self.receiver.received([b'peer'] + blob)
+        assert self.back.dispatched == [('evt', [0], b'data')]
+        nack = self.receiver.protocol.transport.frames[0]
+        assert nack[1] == NACK and nack[-1] == b'No such blob'
+
+    def test_backend_without_data_plane(self):
+        """items go through the RPC calls when the backend registered
+        without a data plane"""
+        front = XbusBrokerFront(None, loop=self.loop)
+        front.data_plane = DataPlaneSender(front, loop=self.loop)
+        front.backend = FakeBackend()
+        front.profile_weights['profile'] = 1
+        front.envelopes['env'] = {
+            'emitter_id': 'emitter', 'profile_id': 'profile', 'forward': True,
+            'trigger': Trigger(self.loop),
+            'events': {'evt': {
+                'immediate_reply': False, 'sent': 0, 'started': True,
+                'written': 0, 'trigger': Trigger(self.loop),
+            }},
+        }
+
+        # ie: what register_backend does when given no data_uri
+        front.data_plane.close()
+        assert not front.data_plane.connected
+        res = self.loop.run_until_complete(
+            front.backend_send_item('env', 'evt', 0, b'data')
+        )
+        assert res
+        assert front.backend.items == [('env', 'evt', 0, b'data')]
+        assert front.envelopes['env']['forward']
@@ -8,6 +8,9 @@ import json
 from unittest.mock import Mock
 
 from xbus.broker.core.front import XbusBrokerFront
+from xbus.broker.core.front.batch import EnvelopeBatcher
+from xbus.broker.core.front.session import SessionStore
+from xbus.broker.core.front.writer import ItemWriter
 from aiozmq import rpc
 from xbus.broker.model.auth.helpers import gen_password
 from xbus.broker.model.auth.helpers import validate_password
@@ -209,3 +212,403 @@ class TestNewEnvelope(TestFrontBase):
             )
 
         self.loop.run_until_complete(gotest())
+
+
+class TestEnvelopeBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.states = {}
+
+        @asyncio.coroutine
+        def process_envelopes(batch):
+            # the backend refuses the envelope "e2"
+            return [envelope[0] != 'e2' for envelope in batch]
+
+        @asyncio.coroutine
+        def update_envelopes_state(envelope_ids, state):
+            for envelope_id in envelope_ids:
+                self.states[envelope_id] = state
+
+        self.broker = Mock()
+        self.broker.backend.call.process_envelopes = process_envelopes
+        self.broker.update_envelopes_state = update_envelopes_state
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_full_batch(self):
+        """a full batch is sent at once and each envelope gets its state"""
+        batcher = EnvelopeBatcher(
+            self.broker, max_items=4, max_envelopes=3, linger=60,
+            loop=self.loop
+        )
+        for envelope_id in ('e1', 'e2', 'e3'):
+            batcher.add(envelope_id, 'evt', 'type', 'name', [b'data'])
+        assert not batcher.batches, "The batch should have been sent"
+        assert not batcher.timers, "The timer should have been cancelled"
+
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        assert self.states == {'e1': 'exec', 'e2': 'wait', 'e3': 'exec'}
+
+    def test_linger(self):
+        """an incomplete batch is sent once the linger time is over"""
+        batcher = EnvelopeBatcher(
+            self.broker, max_items=4, max_envelopes=3, linger=0.01,
+            loop=self.loop
+        )
+        batcher.add('e1', 'evt', 'type', 'name', [b'data'])
+        assert 'type' in batcher.batches
+
+        self.loop.run_until_complete(asyncio.sleep(0.05, loop=self.loop))
+        assert not batcher.batches
+        assert self.states == {'e1': 'exec'}
+
+
+class FakeRow(tuple):
+
+    def as_tuple(self):
+        return tuple(self)
+
+
+class FakeCursor(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    @asyncio.coroutine
+    def fetchall(self):
+        return [FakeRow(row) for row in self.rows]
+
+
+class FakeConnection(object):
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    @asyncio.coroutine
+    def execute(self, query):
+        if self.engine.fail:
+            raise RuntimeError('database unavailable')
+        self.engine.queries.append(query)
+        return FakeCursor(self.engine.rows)
+
+
+class FakeEngine(object):
+
+    def __init__(self, fail=False, rows=()):
+        self.fail = fail
+        self.queries = []
+        self.rows = rows
+
+    def __iter__(self):
+        yield from ()
+        return FakeConnection(self)
+
+
+class TestItemWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.broker = Mock()
+        self.broker.dbengine = FakeEngine()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_max_rows(self):
+        """the pending items are written at once past max_rows"""
+        writer = ItemWriter(
+            self.broker, max_rows=2, interval=60, loop=self.loop
+        )
+        writer.write('evt', 0, b'data')
+        assert writer.timer is not None
+        writer.write('evt', 1, b'data')
+        assert not writer.rows, "The items should be written"
+        assert writer.timer is None, "The timer should have been cancelled"
+
+        res = self.loop.run_until_complete(writer.flush('evt'))
+        assert res is True
+        assert len(self.broker.dbengine.queries) == 1
+
+    def test_interval(self):
+        """the pending items are written once the interval is over"""
+        writer = ItemWriter(
+            self.broker, max_rows=100, interval=0.01, loop=self.loop
+        )
+        writer.write('evt', 0, b'data')
+        writer.write('evt', 1, b'data')
+        assert len(writer.rows) == 2
+
+        self.loop.run_until_complete(asyncio.sleep(0.05, loop=self.loop))
+        assert not writer.rows
+        assert not writer.writing
+        assert len(self.broker.dbengine.queries) == 1
+
+    def test_failed_write(self):
+        """flush tells whether the items of the event could be written"""
+        self.broker.dbengine.fail = True
+        writer = ItemWriter(self.broker, loop=self.loop)
+        writer.write('evt', 0, b'data')
+        writer.write('other', 0, b'data')
+
+        res = self.loop.run_until_complete(writer.flush('evt'))
+        assert res is False
+        assert writer.failed == {'other'}
+
+    def test_cancel(self):
+        """the failures of a cancelled event are forgotten"""
+        self.broker.dbengine.fail = True
+        writer = ItemWriter(self.broker, loop=self.loop)
+        writer.write('evt', 0, b'data')
+        writer.start()
+        writer.write('evt', 1, b'data')
+        writer.write('other', 0, b'data')
+
+        self.loop.run_until_complete(writer.cancel('evt'))
+        assert writer.failed == set()
+        assert [row['event_id'] for row in writer.rows] == ['other']
+
+
+class TestDurabilityNone(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.broker = XbusBrokerFront(None, loop=self.loop)
+        self.calls = []
+
+        def record(name, result=None):
+            @asyncio.coroutine
+            def method(*args, **kwargs):
+                self.calls.append(name)
+                return result
+            setattr(self.broker, name, method)
+
+        record('get_emitter_info', {'id': 'emitter', 'profile_id': 'prof'})
+        record('find_allowed_event_types', {
+            'name': ('type', False, 'none', 'none')
+        })
+        for name in (
+            'log_sent_item', 'log_complete_envelope',
+            'update_envelope_state_wait', 'update_envelope_state_cancel',
+            'update_envelope_state_exec',
+        ):
+            record(name)
+        self.broker.item_writer = Mock()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def open_envelope(self, forward):
+        self.broker.envelopes['env'] = {
+            'emitter_id': 'emitter',
+            'profile_id': 'prof',
+            'forward': forward,
+            'trigger': Mock(),
+            'events': {
+                'evt': {
+                    'durability': 'none', 'compression': 'none',
+                    'recv': 0, 'items': [], 'immediate_reply': False,
+                },
+            },
+        }
+
+    def test_not_stored(self):
+        """the items of a forwarded event are not stored"""
+        self.open_envelope(forward=True)
+        record = []
+
+        @asyncio.coroutine
+        def backend_send_item(envelope_id, event_id, index, data):
+            record.append((envelope_id, event_id, index, data))
+            return True
+
+        self.broker.backend_send_item = backend_send_item
+        res = self.loop.run_until_complete(
+            self.broker.send_item('token', 'env', 'evt', b'data')
+        )
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        assert res is True
+        assert record == [('env', 'evt', 0, b'data')]
+        assert 'log_sent_item' not in self.calls
+        assert not self.broker.item_writer.write.called
+
+    def test_not_forwarded(self):
+        """the items which can be neither stored nor forwarded are refused,
+        and the envelope is cancelled instead of waiting for a replay"""
+        self.open_envelope(forward=False)
+        res = self.loop.run_until_complete(
+            self.broker.send_item('token', 'env', 'evt', b'data')
+        )
+        assert res is False
+
+        self.broker.envelopes['env']['events']['evt']['closed'] = True
+        res = self.loop.run_until_complete(
+            self.broker.end_envelope('token', 'env')
+        )
+        assert res is False
+        assert 'env' not in self.broker.envelopes
+        assert 'update_envelope_state_cancel' in self.calls
+        assert 'update_envelope_state_wait' not in self.calls
+
+    def test_send_envelope_without_backend(self):
+        """a complete envelope is refused while no backend is registered"""
+        envelope_id, success, reply_data = self.loop.run_until_complete(
+            self.broker.send_envelope('token', [('name', 1, [b'data'])])
+        )
+        assert envelope_id
+        assert success is False
+        assert 'update_envelope_state_cancel' in self.calls
+        assert 'update_envelope_state_wait' not in self.calls
+
+
+class TestSendEnvelope(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        # The event types the emitter may send.
+        self.allowed = [
+            ('bulk', 'type1', False, 'sync', 'none'),
+            ('reply', 'type2', True, 'sync', 'none'),
+            ('reply2', 'type3', True, 'sync', 'none'),
+        ]
+        self.engine = FakeEngine()
+        self.broker = XbusBrokerFront(self.engine, loop=self.loop)
+        self.states = {}
+        self.logged = []
+
+        @asyncio.coroutine
+        def get_emitter_info(token, peer=None):
+            return {'id': 'emitter', 'profile_id': 'prof'}
+
+        @asyncio.coroutine
+        def log_complete_envelope(envelope_id, emitter_id, events):
+            self.logged.append(envelope_id)
+
+        @asyncio.coroutine
+        def get_tenant(emitter_id, profile_id):
+            return profile_id, 1
+
+        def update_state(state):
+            @asyncio.coroutine
+            def update_envelope_state(envelope_id):
+                self.states[envelope_id] = state
+            return update_envelope_state
+
+        self.broker.get_emitter_info = get_emitter_info
+        self.broker.log_complete_envelope = log_complete_envelope
+        self.broker.get_tenant = get_tenant
+        self.broker.update_envelope_state_exec = update_state('exec')
+        self.broker.update_envelope_state_wait = update_state('wait')
+        self.broker.update_envelope_state_cancel = update_state('canc')
+        self.broker.backend = Mock()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def send_envelope(self, events):
+        names = {event[0] for event in events}
+        self.engine.rows = [row for row in self.allowed if row[0] in names]
+        return self.loop.run_until_complete(
+            self.broker.send_envelope('token', events)
+        )
+
+    def test_single_query(self):
+        """the types of all the events and the emitter's rights on them are
+        read with a single query"""
+        @asyncio.coroutine
+        def process_envelope(envelope_id, events, tenant=None, weight=1):
+            return {'success': True, 'reply_data': b'reply'}
+
+        self.broker.backend.call.process_envelope = process_envelope
+        envelope_id, success, reply_data = self.send_envelope([
+            ('bulk', 1, [b'data']), ('reply', 1, [b'data']),
+            ('bulk', 2, [b'data', b'data']),
+        ])
+        assert success is True
+        assert reply_data == b'reply'
+        assert len(self.engine.queries) == 1
+        assert self.logged == [envelope_id]
+        assert self.states == {envelope_id: 'exec'}
+
+    def test_unknown_type(self):
+        """an envelope with an event the emitter may not send is refused"""
+        self.allowed = self.allowed[:1]
+        res = self.send_envelope([
+            ('bulk', 1, [b'data']), ('reply', 1, [b'data']),
+        ])
+        assert res == ("", False, None)
+        assert not self.logged
+
+    def test_several_immediate_replies(self):
+        """an envelope with several immediate reply events is refused"""
+        res = self.send_envelope([
+            ('reply', 1, [b'data']), ('reply2', 1, [b'data']),
+        ])
+        assert res == ("", False, None)
+        assert not self.logged
+        assert not self.states
+
+    def test_backend_failure(self):
+        """the envelope waits for a replay when the backend call fails"""
+        @asyncio.coroutine
+        def process_envelope(envelope_id, events, tenant=None, weight=1):
+            raise RuntimeError('backend unavailable')
+
+        self.broker.backend.call.process_envelope = process_envelope
+        envelope_id, success, reply_data = self.send_envelope([
+            ('bulk', 1, [b'data']), ('reply', 1, [b'data']),
+        ])
+        assert success is False
+        assert reply_data is None
+        assert self.states == {envelope_id: 'wait'}
+
+
+class TestSessionStore(unittest.TestCase):
+
+    def test_bound_session(self):
+        """a session is only found for its connection and its token"""
+        sessions = SessionStore()
+        sessions.bind(b'peer', 'token', {'id': 1})
+        assert sessions.get(b'peer', 'token') == {'id': 1}
+        assert sessions.get(b'peer', 'other') is None
+        assert sessions.get(b'other', 'token') is None
+
+        sessions.drop(b'peer')
+        assert sessions.get(b'peer', 'token') is None
+
+    def test_expired_session(self):
+        """expired sessions are forgotten"""
+        sessions = SessionStore(ttl=-1)
+        sessions.bind(b'peer', 'token', {'id': 1})
+        sessions.purge()
+        assert len(sessions) == 0
+
+        sessions.ttl = 10
+        sessions.bind(b'peer', 'token', {'id': 1})
+        assert sessions.get(b'peer', 'token') == {'id': 1}
+        sessions.sessions[b'peer'].last_seen -= 11
+        assert sessions.get(b'peer', 'token') is None
+        assert len(sessions) == 0
+
+    def test_drop_token(self):
+        """every session of a token is forgotten at logout"""
+        sessions = SessionStore()
+        sessions.bind(b'peer', 'token', {'id': 1})
+        sessions.bind(b'other', 'token', {'id': 1})
+        sessions.bind(b'third', 'third', {'id': 2})
+        sessions.drop_token('token')
+        assert sessions.get(b'peer', 'token') is None
+        assert sessions.get(b'other', 'token') is None
+        assert sessions.get(b'third', 'third') == {'id': 2}
+        assert 'token' not in sessions.peers
@@ -0,0 +1,98 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import unittest
+
+from xbus.broker.core.metrics import LatencyHistogram
+from xbus.broker.core.metrics import MetricsExporter
+from xbus.broker.core.metrics import MetricsRegistry
+from xbus.broker.core.metrics import RPCMetrics
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_render(self):
+        """the metrics are rendered in the Prometheus text format"""
+        calls = self.registry.counter('calls_total', 'Calls', ('method',))
+        calls.labels('ping').inc()
+        calls.labels('ping').inc(2)
+        self.registry.gauge(
+            'depth', 'Depth', ('queue',), collect=lambda: {('a"b',): 4}
+        )
+        histogram = self.registry.histogram(
+            'latency_seconds', 'Latency', bounds=(0.1, 1)
+        )
+        histogram.labels().observe(0.05)
+        histogram.labels().observe(5)
+
+        lines = self.registry.render().splitlines()
+        assert '# TYPE calls_total counter' in lines
+        assert 'calls_total{method="ping"} 3.0' in lines
+        assert 'depth{queue="a\\"b"} 4.0' in lines
+        assert 'latency_seconds_bucket{le="0.1"} 1.0' in lines
+        assert 'latency_seconds_bucket{le="1"} 1.0' in lines
+        assert 'latency_seconds_bucket{le="+Inf"} 2.0' in lines
+        assert 'latency_seconds_count 2.0' in lines
+
+    def test_shared(self):
+        """the same metric may be asked for twice, not as another kind"""
+        counter = self.registry.counter('calls_total', 'Calls')
+        assert self.registry.counter('calls_total', 'Calls') is counter
+        with self.assertRaises(ValueError):
+            self.registry.gauge('calls_total', 'Calls')
+
+    def test_attach(self):
+        """existing histograms are exposed with their labels"""
+        histogram = LatencyHistogram()
+        histogram.observe(0.2)
+        metric = self.registry.histogram('reply', 'Reply', ('component',))
+        metric.attach(histogram, 'front')
+        assert 'reply_count{component="front"} 1.0' in (
+            self.registry.render().splitlines()
+        )
+
+    def test_rpc_metrics(self):
+        """the values of a method are looked up once"""
+        metrics = RPCMetrics('back', registry=self.registry)
+        values = metrics.method('send_item')
+        assert metrics.method('send_item') is values
+        values[0].inc()
+        assert 'xbus_rpc_calls_total{component="back",method="send_item"} ' \
+            '1.0' in self.registry.render().splitlines()
+
+
+class TestMetricsExporter(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.registry = MetricsRegistry()
+        self.registry.counter('calls_total', 'Calls').labels().inc()
+        self.exporter = MetricsExporter(self.registry, loop=self.loop)
+
+    def tearDown(self):
+        self.exporter.close()
+        self.loop.close()
+
+    @asyncio.coroutine
+    def fetch(self, path):
+        port = self.exporter.server.sockets[0].getsockname()[1]
+        reader, writer = yield from asyncio.open_connection(
+            '127.0.0.1', port, loop=self.loop
+        )
+        writer.write('GET {} HTTP/1.0\r\n\r\n'.format(path).encode())
+        response = yield from reader.read()
+        writer.close()
+        return response
+
+    def test_serve(self):
+        """the metrics are served on /metrics"""
+        self.loop.run_until_complete(self.exporter.start('127.0.0.1', 0))
+        response = self.loop.run_until_complete(self.fetch('/metrics'))
+        assert response.startswith(b'HTTP/1.0 200 OK\r\n')
+        assert b'\r\n\r\n# HELP calls_total Calls\n' in response
+        response = self.loop.run_until_complete(self.fetch('/other'))
+        assert response.startswith(b'HTTP/1.0 404')
@@ -0,0 +1,134 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import unittest
+
+from xbus.broker.core.back.plan import RoutingPlan
+
+
+class FakeEvent(object):
+
+    def __init__(self):
+        self.workers = []
+        self.consumers = []
+
+    def new_worker(self, node_id, role_id, recipient, children, is_start):
+        self.workers.append((node_id, role_id, recipient, children, is_start))
+
+    def new_consumer(self, node_id, role_ids, recipients, is_start):
+        self.consumers.append((node_id, role_ids, recipients, is_start))
+
+
+class TestRoutingPlan(unittest.TestCase):
+
+    def setUp(self):
+        # start worker -> (worker -> consumer c1), consumer c2; given
+        # children first
+        self.rows = [
+            ('c1', 's3', False, []),
+            ('w2', 's2', False, ['c1']),
+            ('w1', 's1', True, ['w2', 'c2']),
+            ('c2', 's4', False, []),
+            ('c3', 's5', True, []),
+        ]
+        self.active_roles = {
+            's1': {'r1a', 'r1b'}, 's2': {'r2'}, 's3': {'r3'}, 's4': set(),
+            's5': {'r5'},
+        }
+        self.recipients = {
+            role: 'recipient ' + role
+            for roles in self.active_roles.values() for role in roles
+        }
+        self.consumers = {'s3': {'r3', 'r3b'}, 's4': {'r4'}, 's5': {'r5'}}
+
+    def make_plan(self):
+        return RoutingPlan(
+            'type', self.rows, self.active_roles, self.recipients,
+            self.consumers
+        )
+
+    def test_sorted(self):
+        """parents come before their children"""
+        plan = self.make_plan()
+        order = [node.node_id for node in plan.nodes]
+        assert order == ['w1', 'c3', 'w2', 'c2', 'c1']
+        assert [plan.nodes[i].node_id for i in plan.start] == ['w1', 'c3']
+
+    def test_consumer_sets(self):
+        """the inactive consumers are known in advance"""
+        plan = self.make_plan()
+        nodes = {node.node_id: node for node in plan.nodes}
+        assert nodes['c1'].inactive_roles == {'r3b'}
+        assert nodes['c2'].inactive_roles == {'r4'}
+        assert nodes['c2'].role_ids == ()
+        assert nodes['c3'].recipients == ('recipient r5',)
+
+    def instantiate(self, plan, event, targets=None):
+        return plan.instantiate(
+            event, self.active_roles, self.recipients, targets
+        )
+
+    def test_instantiate(self):
+        """every node is created; each worker is taken until it is ready
+        again"""
+        plan = self.make_plan()
+        event = FakeEvent()
+        assert self.instantiate(plan, event)
+        assert len(event.workers) == 2
+        assert len(event.consumers) == 3
+        node_id, role_id, recipient, children, is_start = event.workers[0]
+        assert node_id == 'w1' and role_id in ('r1a', 'r1b')
+        assert recipient == 'recipient ' + role_id
+        assert children == ('w2', 'c2')
+        assert self.active_roles['s1'] == {'r1a', 'r1b'} - {role_id}
+        assert self.active_roles['s2'] == set()
+
+        # No worker of s2 is left: nothing is taken.
+        other = FakeEvent()
+        assert not self.instantiate(plan, other)
+        assert not other.workers and not other.consumers
+        assert len(self.active_roles['s1']) == 1
+
+        # ie: r2 called ready
+        self.active_roles['s2'].add('r2')
+        assert self.instantiate(plan, other)
+        assert other.workers[0][1] != role_id
+
+    def test_targets(self):
+        """only the branches leading to the targets are created"""
+        plan = self.make_plan()
+        event = FakeEvent()
+        assert self.instantiate(plan, event, ['c2'])
+        assert [worker[0] for worker in event.workers] == ['w1']
+        assert event.workers[0][3] == ('c2',)
+        assert [consumer[0] for consumer in event.consumers] == ['c2']
+
+    def test_no_worker(self):
+        """events needing a worker which is not active are refused"""
+        self.active_roles['s2'] = set()
+        plan = self.make_plan()
+        event = FakeEvent()
+        assert not self.instantiate(plan, event)
+        assert not event.workers and not event.consumers
+        # The branch of the missing worker is not needed to reach c3.
+        assert self.instantiate(plan, event, ['c3'])
+        assert [consumer[0] for consumer in event.consumers] == ['c3']
+
+    def kept(self, targets):
+        plan = self.make_plan()
+        return [
+            node.node_id for node, kept in zip(plan.nodes, plan.kept(targets))
+            if kept
+        ]
+
+    def test_kept_single_branch(self):
+        """only the ancestors of the target are kept"""
+        assert self.kept(['c1']) == ['w1', 'w2', 'c1']
+
+    def test_kept_start_consumer(self):
+        """a start consumer has no ancestor"""
+        assert self.kept(['c3']) == ['c3']
+
+    def test_kept_several_targets(self):
+        """branches leading to any target are kept"""
+        assert self.kept(['c2', 'c3']) == ['w1', 'c3', 'c2']
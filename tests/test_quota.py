@@ -0,0 +1,112 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import unittest
+import asyncio
+import time
+
+from xbus.broker.core.errors import ThrottledError
+from xbus.broker.core.front.quota import Quota
+from xbus.broker.core.front.quota import QuotaManager
+from xbus.broker.core.front.quota import TokenBucket
+
+
+class FakeBroker(object):
+
+    def __init__(self):
+        self.envelopes = {}
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_delay(self):
+        """units are refused once the burst is used, until refilled"""
+        bucket = TokenBucket(10, burst=1.0)
+        for _ in range(10):
+            assert bucket.delay(1) == 0
+            bucket.take(1)
+        delay = bucket.delay(1)
+        assert 0 < delay <= 0.1
+        bucket.stamp -= 0.1
+        assert bucket.delay(1) == 0, "The bucket should have been refilled"
+
+    def test_large_amount(self):
+        """a full bucket lets an amount above its capacity through"""
+        bucket = TokenBucket(100)
+        assert bucket.delay(1000) == 0
+        bucket.take(1000)
+        assert bucket.delay(1) > 0
+
+
+class TestQuotaManager(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        # Limits preloaded, so that no database is needed.
+        self.quotas = QuotaManager(None, loop=self.loop)
+        self.quotas.quotas = {
+            ('emitter', 'e1'): Quota(None, 100, 1),
+            ('profile', 'p1'): Quota(5, None, None),
+        }
+        self.quotas.loaded[('emitter', 'e1')] = time.monotonic()
+        self.quotas.loaded[('profile', 'p1')] = time.monotonic()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_open_envelopes(self):
+        """an emitter cannot open more envelopes than allowed"""
+        run = self.loop.run_until_complete
+        run(self.quotas.open_envelope('e1', 'p1'))
+        with self.assertRaises(ThrottledError):
+            run(self.quotas.open_envelope('e1', 'p1'))
+        self.quotas.close_envelope('e1', 'p1')
+        run(self.quotas.open_envelope('e1', 'p1'))
+
+    def test_items(self):
+        """the limits of both the emitter and its profile apply"""
+        run = self.loop.run_until_complete
+        run(self.quotas.take_items('e1', 'p1', 4, 50))
+        with self.assertRaises(ThrottledError) as cm:
+            run(self.quotas.take_items('e1', 'p1', 1, 60))
+        assert cm.exception.args[0] == 'Too many bytes per second'
+        assert cm.exception.retry_after > 0
+        with self.assertRaises(ThrottledError):
+            run(self.quotas.take_items('e1', 'p1', 2, 10))
+        run(self.quotas.take_items('e1', 'p1', 1, 10))
+
+    def test_refresh_keeps_buckets(self):
+        """reading unchanged limits again does not refill the buckets"""
+        run = self.loop.run_until_complete
+        self.quotas.broker = FakeBroker()
+        run(self.quotas.take_items('e1', 'p1', 5, 10))
+        profile = self.quotas.quotas[('profile', 'p1')]
+        self.quotas.loaded[('emitter', 'e2')] = time.monotonic()
+        self.quotas.update({('profile', 'p1'): (5, None, None)})
+        assert self.quotas.quotas[('profile', 'p1')] is profile
+        with self.assertRaises(ThrottledError):
+            run(self.quotas.take_items('e2', 'p1', 1, 10))
+
+        self.quotas.update({('profile', 'p1'): (10, None, None)})
+        assert self.quotas.quotas[('profile', 'p1')] is not profile
+
+    def test_reconcile_open_envelopes(self):
+        """open envelopes are counted again from the live envelopes"""
+        run = self.loop.run_until_complete
+        self.quotas.broker = FakeBroker()
+        run(self.quotas.open_envelope('e1', 'p1'))
+        self.quotas.update({('emitter', 'e1'): (None, 100, 1)})
+        run(self.quotas.open_envelope('e1', 'p1'))
+
+        self.quotas.broker.envelopes['env'] = {
+            'emitter_id': 'e1', 'profile_id': 'p1',
+            'opened': time.monotonic() - 10,
+        }
+        self.quotas.update({('emitter', 'e1'): (None, 100, 1)})
+        with self.assertRaises(ThrottledError):
+            run(self.quotas.open_envelope('e1', 'p1'))
+
+        self.quotas.envelope_ttl = 5
+        self.quotas.update({('emitter', 'e1'): (None, 100, 1)})
+        run(self.quotas.open_envelope('e1', 'p1'))
@@ -0,0 +1,82 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import unittest
+
+from xbus.broker.core.back.envelope import Envelope
+from xbus.broker.core.back.node import Node
+from xbus.broker.core.back.registry import EnvelopeRegistry
+
+
+class FakeEnvelope(object):
+
+    def __init__(self, envelope_id):
+        self.envelope_id = envelope_id
+        self.client_calls = set()
+        self.stopped = False
+
+    @asyncio.coroutine
+    def stop_envelope(self):
+        self.stopped = True
+
+
+class TestEnvelopeRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.registry = EnvelopeRegistry(idle_timeout=100, loop=self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def add(self, envelope_id, idle: float=0):
+        envelope = FakeEnvelope(envelope_id)
+        self.registry.add(envelope)
+        envelope.touched -= idle
+        return envelope
+
+    def test_discard(self):
+        """an envelope leaves the registry once done, unless replaced"""
+        first = self.add('env')
+        second = self.add('env')
+        self.registry.discard(first)
+        assert self.registry['env'] is second
+        self.registry.discard(second)
+        assert 'env' not in self.registry
+        assert len(self.registry) == 0
+
+    def test_evict(self):
+        """only the envelopes idle for too long are stopped and removed"""
+        old = self.add('old', idle=150)
+        busy = self.add('busy', idle=150)
+        busy.client_calls.add('call')
+        self.add('new', idle=50)
+
+        assert self.registry.evict() == 1
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        assert old.stopped and not busy.stopped
+        assert list(self.registry) == ['new', 'busy']
+        assert self.registry.evicted == 1
+
+    def test_get_touches(self):
+        """looking an envelope up records activity on it"""
+        envelope = self.add('env', idle=150)
+        assert self.registry.get('env') is envelope
+        assert self.registry.evict() == 0
+        assert self.registry.get('nope') is None
+
+    def test_held_items(self):
+        """the items held for the nodes are counted as they come and go"""
+        envelope = Envelope('env', loop=self.loop)
+        self.registry.add(envelope)
+        event = envelope.new_event('evt', 'type', 'type_id')
+        node = event.nodes['node'] = Node('env', 'evt', 'node', self.loop)
+
+        handle = envelope.hold_item(node, b'first')
+        envelope.hold_item(node, b'second')
+        assert self.registry.held == 2
+        assert envelope.release_item(node, handle) == b'first'
+        assert self.registry.held == 1
+        envelope.release_all_items()
+        assert self.registry.held == 0
@@ -0,0 +1,188 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import unittest
+from unittest.mock import patch
+
+from xbus.broker.core.errors import OverloadedError
+from xbus.broker.core.front.replay import EnvelopeReplayer
+
+
+class FakeConnection(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    @asyncio.coroutine
+    def begin(self):
+        return self
+
+    @asyncio.coroutine
+    def commit(self):
+        pass
+
+    @asyncio.coroutine
+    def rollback(self):
+        pass
+
+
+class FakeEngine(object):
+
+    def __iter__(self):
+        yield from ()
+        return FakeConnection()
+
+
+class FakeBackend(object):
+
+    def __init__(self, loop, start_event=(0, ''), overloaded=0):
+        self.call = self
+        self.loop = loop
+        self.start_event_res = start_event
+        self.overloaded = overloaded
+        self.batches = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.cancelled = []
+
+    @asyncio.coroutine
+    def start_envelope(self, envelope_id):
+        if self.overloaded:
+            self.overloaded -= 1
+            raise OverloadedError('too many envelopes')
+        return envelope_id
+
+    @asyncio.coroutine
+    def start_event(self, envelope_id, event_id, type_id, type_name):
+        return self.start_event_res
+
+    @asyncio.coroutine
+    def send_items(self, envelope_id, event_id, items):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        yield from asyncio.sleep(0.01, loop=self.loop)
+        self.in_flight -= 1
+        self.batches.append(items)
+        return 0, ''
+
+    @asyncio.coroutine
+    def end_event(self, envelope_id, event_id, nb_items, immediate_reply):
+        return {'success': nb_items == 7}
+
+    @asyncio.coroutine
+    def end_envelope(self, envelope_id):
+        return {'success': True}
+
+    @asyncio.coroutine
+    def cancel_envelope(self, envelope_id):
+        self.cancelled.append(envelope_id)
+        return {'success': True}
+
+
+class FakeFront(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.dbengine = FakeEngine()
+        self.states = {}
+
+    @asyncio.coroutine
+    def update_envelope_state_exec(self, envelope_id):
+        self.states[envelope_id] = 'exec'
+
+
+class TestEnvelopeReplayer(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.items = [(index, b'item') for index in range(7)]
+        self.cursors = []
+
+        @asyncio.coroutine
+        def get_envelopes_by_state(conn, state):
+            return ['env']
+
+        @asyncio.coroutine
+        def get_envelope_events(conn, envelope_id):
+            return [('evt', 'type', 'name')]
+
+        @asyncio.coroutine
+        def open_item_cursor(conn, name, event_id):
+            self.cursors.append(name)
+
+        @asyncio.coroutine
+        def fetch_item_cursor(conn, name, count, loop=None):
+            batch, self.items = self.items[:count], self.items[count:]
+            return batch
+
+        @asyncio.coroutine
+        def close_item_cursor(conn, name):
+            self.cursors.remove(name)
+
+        module = 'xbus.broker.core.front.replay.'
+        for helper in (
+            get_envelopes_by_state, get_envelope_events, open_item_cursor,
+            fetch_item_cursor, close_item_cursor,
+        ):
+            patcher = patch(module + helper.__name__, helper)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def replay(self, backend):
+        front = FakeFront(backend)
+        replayer = EnvelopeReplayer(
+            front, batch_size=2, window=2, loop=self.loop
+        )
+        res = self.loop.run_until_complete(replayer.replay_waiting())
+        return front, res
+
+    def test_replay(self):
+        """the items are sent in batches, with a bounded window, and the
+        envelope is then being executed"""
+        backend = FakeBackend(self.loop)
+        front, res = self.replay(backend)
+        assert res == 1
+        assert [len(batch) for batch in backend.batches] == [2, 2, 2, 1]
+        assert backend.max_in_flight == 2
+        assert not self.cursors, "The cursor should have been closed"
+        assert front.states == {'env': 'exec'}
+        assert not backend.cancelled
+
+    def test_refused_start(self):
+        """an event the backend cannot start cancels the envelope"""
+        backend = FakeBackend(self.loop, start_event=False)
+        front, res = self.replay(backend)
+        assert res == 0
+        assert backend.cancelled == ['env']
+        assert not backend.batches
+        assert front.states == {}
+
+    def test_retry_refused(self):
+        """the envelopes refused by an overloaded backend are replayed again
+        until it accepts them"""
+        backend = FakeBackend(self.loop, overloaded=2)
+        front = FakeFront(backend)
+        replayer = EnvelopeReplayer(
+            front, batch_size=2, window=2, interval=0.01, loop=self.loop
+        )
+        res = self.loop.run_until_complete(replayer.replay_waiting())
+        assert res == 0
+        assert front.states == {}
+
+        replayer.start()
+        task = replayer.task
+        self.loop.run_until_complete(asyncio.sleep(0.2, loop=self.loop))
+        replayer.stop()
+        self.loop.run_until_complete(
+            asyncio.wait([task], loop=self.loop)
+        )
+        assert front.states == {'env': 'exec'}
+        assert [len(batch) for batch in backend.batches] == [2, 2, 2, 1]
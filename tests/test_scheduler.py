@@ -0,0 +1,101 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import unittest
+import asyncio
+
+from xbus.broker.core.metrics import LatencyHistogram
+from xbus.broker.core.scheduler import DeficitRoundRobin
+from xbus.broker.core.scheduler import PriorityLimiter
+
+
+class TestPriorityLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_reserved_slots(self):
+        """bulk calls cannot take the slots reserved to urgent calls"""
+        limiter = PriorityLimiter(limit=2, reserved=1, loop=self.loop)
+        assert limiter.available(False)
+        self.loop.run_until_complete(limiter.acquire(False))
+        assert not limiter.available(False), "Only reserved slots left"
+        assert limiter.available(True)
+        self.loop.run_until_complete(limiter.acquire(True))
+        assert not limiter.available(True)
+        assert limiter.in_use == 2
+
+    def test_urgent_served_first(self):
+        """a released slot goes to an urgent call before bulk ones"""
+        limiter = PriorityLimiter(limit=1, reserved=0, loop=self.loop)
+        served = []
+
+        @asyncio.coroutine
+        def call(name, urgent):
+            with (yield from limiter.acquire(urgent)):
+                served.append(name)
+                yield from asyncio.sleep(0, loop=self.loop)
+
+        @asyncio.coroutine
+        def run():
+            slot = yield from limiter.acquire(False)
+            tasks = [
+                asyncio.async(call('bulk', False), loop=self.loop),
+                asyncio.async(call('urgent', True), loop=self.loop),
+            ]
+            yield from asyncio.sleep(0, loop=self.loop)
+            with slot:
+                pass
+            yield from asyncio.wait(tasks, loop=self.loop)
+
+        self.loop.run_until_complete(run())
+        assert served == ['urgent', 'bulk']
+        assert limiter.in_use == 0
+
+
+class TestDeficitRoundRobin(unittest.TestCase):
+
+    def test_weights(self):
+        """tenants are served in proportion to their weights"""
+        drr = DeficitRoundRobin()
+        for i in range(100):
+            drr.push('bulk', 1, ('bulk', i))
+        for i in range(3):
+            drr.push('small', 2, ('small', i))
+        served = [drr.pop()[0] for _ in range(6)]
+        assert served.count('small') == 3, "The small tenant must not wait"
+        assert served.count('bulk') == 3
+        assert len(drr) == 97
+        assert list(drr.queues) == ['bulk'], "Empty queues are dropped"
+
+    def test_remove(self):
+        """removed items are never popped"""
+        drr = DeficitRoundRobin()
+        drr.push('a', 1, 1)
+        drr.push('b', 1, 2)
+        assert drr.remove('a', 1)
+        assert not drr.remove('a', 1)
+        assert drr.pop() == 2
+        with self.assertRaises(IndexError):
+            drr.pop()
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        """percentiles are reported with the precision of the buckets"""
+        histogram = LatencyHistogram(bounds=(0.001, 0.01, 0.1))
+        assert histogram.percentile(50) is None
+        for _ in range(98):
+            histogram.observe(0.0005)
+        histogram.observe(0.05)
+        histogram.observe(1)
+        snapshot = histogram.snapshot()
+        assert snapshot['count'] == 100
+        assert snapshot['p50'] == 0.001
+        assert snapshot['p99'] == 0.1
+        assert snapshot['p999'] == float('inf')
@@ -0,0 +1,121 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import mmap
+import os
+import unittest
+
+from xbus.broker.core.back.envelope import Envelope
+from xbus.broker.core.back.shm import ShmRing
+
+
+class FakeEvent(object):
+
+    event_id = 'evt'
+    immediate_reply = False
+
+
+class FakeRecipient(object):
+
+    def __init__(self, ring, delay=0):
+        self.ring = ring
+        self.call = self
+        self.socket = self
+        self.delay = delay
+
+    def socket_for(self, event):
+        return self.socket
+
+    @asyncio.coroutine
+    def send_item_shm(self, envelope_id, event_id, indices, offset, size):
+        yield from asyncio.sleep(self.delay)
+        return True, []
+
+
+class TestShmRing(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = ShmRing(100)
+
+    def tearDown(self):
+        self.ring.close()
+
+    def test_shared(self):
+        """another process mapping the file sees the data"""
+        offset = self.ring.write(b'hello')
+        with open(self.ring.path, 'r+b') as segment:
+            view = mmap.mmap(segment.fileno(), self.ring.size)
+            assert view[offset:offset + 5] == b'hello'
+            view.close()
+        self.ring.unlink()
+        assert not os.path.exists(self.ring.path)
+
+    def test_wrap_around(self):
+        """space is reused once released, wrapping around at the end"""
+        first = self.ring.write(b'a' * 40)
+        second = self.ring.write(b'b' * 40)
+        assert (first, second) == (0, 40)
+        assert self.ring.write(b'c' * 40) is None, "The ring should be full"
+
+        self.ring.release(first)
+        third = self.ring.write(b'c' * 40)
+        assert third == 0
+        assert self.ring.map[0:40] == b'c' * 40
+        assert self.ring.write(b'd' * 10) is None
+
+    def test_release_out_of_order(self):
+        """space is only reused once the oldest items are released"""
+        first = self.ring.write(b'a' * 50)
+        second = self.ring.write(b'b' * 50)
+        self.ring.release(second)
+        assert self.ring.write(b'c' * 10) is None
+        self.ring.release(first)
+        assert self.ring.write(b'c' * 100) == 0
+
+    def test_too_large(self):
+        """items larger than the ring are not written"""
+        assert self.ring.write(b'x' * 101) is None
+        assert self.ring.write(b'') is None
+
+    def test_retire(self):
+        """a retired ring is closed once its items are released"""
+        offset = self.ring.write(b'hello')
+        self.ring.retire()
+        assert self.ring.write(b'hello') is None
+        assert not self.ring.map.closed
+        self.ring.release(offset)
+        assert self.ring.map.closed
+
+
+class TestSendItemShm(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.ring = ShmRing(100)
+        self.envelope = Envelope('env', loop=self.loop)
+
+    def tearDown(self):
+        self.ring.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def send(self, recipient, timeout=None):
+        return self.loop.run_until_complete(asyncio.wait_for(
+            self.envelope.send_item_shm(
+                recipient, FakeEvent(), [0], b'hello'
+            ),
+            timeout, loop=self.loop
+        ))
+
+    def test_replied(self):
+        """the space of an item is reused once the recipient replied"""
+        assert self.send(FakeRecipient(self.ring)) == (True, [])
+        assert not self.ring.used
+
+    def test_timed_out(self):
+        """the space of an item is kept when its call times out"""
+        with self.assertRaises(asyncio.TimeoutError):
+            self.send(FakeRecipient(self.ring, delay=1), timeout=0.01)
+        assert len(self.ring.used) == 1
@@ -0,0 +1,44 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import unittest
+
+from xbus.broker.core.back.spill import SpillQueue
+
+
+class TestSpillQueue(unittest.TestCase):
+
+    def test_memory_only(self):
+        """items below the threshold never reach the segment file"""
+        queue = SpillQueue(threshold=100)
+        handles = [queue.push(b'x' * 10) for _ in range(5)]
+        assert queue.segment is None, "Nothing should have been spilled"
+        assert len(queue) == 5
+        for handle in handles:
+            assert queue.pop(handle) == b'x' * 10
+        assert queue.memory_size == 0
+        queue.close()
+
+    def test_spill_and_read_back(self):
+        """items above the threshold are read back in order from disk"""
+        queue = SpillQueue(threshold=16)
+        items = [bytes([i]) * 8 for i in range(10)]
+        handles = [queue.push(data) for data in items]
+        assert queue.segment is not None, "Items should have been spilled"
+        assert queue.segment_items == 8
+        for handle, data in zip(handles, items):
+            assert queue.pop(handle) == data
+        assert len(queue) == 0
+        assert queue.segment_size == 0, "The segment should be truncated"
+        queue.close()
+
+    def test_interleaved(self):
+        """pushing while the node catches up keeps every item intact"""
+        queue = SpillQueue(threshold=4)
+        first = queue.push(b'abcd')
+        second = queue.push(b'efgh')
+        assert queue.pop(first) == b'abcd'
+        third = queue.push(b'ijkl')
+        assert queue.pop(second) == b'efgh'
+        assert queue.pop(third) == b'ijkl'
+        queue.close()
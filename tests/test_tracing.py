@@ -0,0 +1,135 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+
+from xbus.broker.core import tracing
+from xbus.broker.core.tracing import Span
+from xbus.broker.core.tracing import Tracer
+from xbus.broker.core.tracing import traced
+
+
+class FakeEvent(object):
+
+    def __init__(self, event_id):
+        self.event_id = event_id
+
+
+class FakeBroker(object):
+
+    component = 'front'
+
+    @traced('start_envelope', result='envelope_id')
+    @asyncio.coroutine
+    def start_envelope(self, token):
+        return 'env'
+
+    @traced('send_item')
+    @asyncio.coroutine
+    def send_item(self, token, envelope_id, event_id, data):
+        if data is None:
+            raise ValueError()
+        return True
+
+
+class FakeEnvelope(object):
+
+    component = 'back'
+    envelope_id = 'env'
+
+    @traced('worker_send_item')
+    @asyncio.coroutine
+    def worker_send_item(self, node, event):
+        return True
+
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.tracer = Tracer(size=10, sample_rate=1, loop=self.loop)
+        self.previous, tracing.TRACER = tracing.TRACER, self.tracer
+
+    def tearDown(self):
+        tracing.TRACER = self.previous
+        self.loop.close()
+
+    def run_coro(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_traced(self):
+        """the spans of an envelope are recorded in each stage"""
+        broker = FakeBroker()
+        assert self.run_coro(broker.start_envelope('token')) == 'env'
+        self.run_coro(broker.send_item('token', 'env', 'evt', b'data'))
+        with self.assertRaises(ValueError):
+            self.run_coro(broker.send_item('token', 'env', 'evt', None))
+        self.run_coro(FakeEnvelope().worker_send_item(None, FakeEvent('evt')))
+
+        spans = self.tracer.trace('env')
+        assert [(s.component, s.stage, s.event_id) for s in spans] == [
+            ('front', 'start_envelope', None),
+            ('front', 'send_item', 'evt'),
+            ('front', 'send_item', 'evt'),
+            ('back', 'worker_send_item', 'evt'),
+        ]
+        assert [s.error for s in spans] == [None, None, 'ValueError', None]
+
+        breakdown = self.tracer.breakdown('env')
+        assert [s['stage'] for s in breakdown['stages']] == [
+            'start_envelope', 'send_item', 'worker_send_item',
+        ]
+        assert breakdown['stages'][1]['calls'] == 2
+        assert breakdown['stages'][1]['errors'] == 1
+        assert self.tracer.breakdown('other') == {}
+
+    def test_sampling(self):
+        """envelopes are sampled on their ID; 0 disables tracing"""
+        self.tracer.sample_rate = 0.5
+        ids = ['%032x' % i for i in range(1000)]
+        sampled = [self.tracer.sampled(i) for i in ids]
+        assert 400 < sum(sampled) < 600
+        assert sampled == [self.tracer.sampled(i) for i in ids]
+
+        self.tracer.sample_rate = 0
+        self.run_coro(FakeBroker().send_item('token', 'env', 'evt', b''))
+        assert self.tracer.recorded == 0
+
+    def test_ring_buffer(self):
+        """only the most recent spans are kept"""
+        for i in range(15):
+            self.tracer.record(Span('stage', 'back', 'env', None, i, i, None))
+        assert self.tracer.recorded == 15
+        assert [s.start for s in self.tracer.trace('env')] == list(
+            range(5, 15)
+        )
+
+    def test_export(self):
+        """the new spans are appended to the export file"""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        envelope_id = 'a' * 32
+
+        self.tracer.record(
+            Span('stage', 'back', envelope_id, 'evt', 1, 2, None)
+        )
+        assert self.tracer.export(path) == 1
+        assert self.tracer.export(path) == 0
+        self.tracer.record(Span('stage', 'back', envelope_id, None, 2, 3, 'E'))
+        assert self.tracer.export(path, 'otlp') == 1
+
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        assert lines[0]['duration'] == 1 and lines[0]['event_id'] == 'evt'
+        span = lines[1]['resourceSpans'][0]['scopeSpans'][0]['spans'][0]
+        assert span['traceId'] == envelope_id
+        assert span['name'] == 'back.stage'
+        assert span['startTimeUnixNano'] == '2000000000'
+        assert span['status'] == {'code': 2, 'message': 'E'}
+        with self.assertRaises(ValueError):
+            self.tracer.export(path, 'xml')
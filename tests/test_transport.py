@@ -0,0 +1,132 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import configparser
+import socket
+import unittest
+
+import zmq
+
+from xbus.broker.core.transport import SocketTuning
+from xbus.broker.core.transport import call_many
+from xbus.broker.core.transport import get_socket_tuning
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.frames = []
+
+    def write(self, frames):
+        self.frames.append(frames)
+
+
+class FakeSocket(object):
+
+    def __init__(self):
+        self.options = {}
+
+    def setsockopt(self, option, value):
+        self.options[option] = value
+
+
+class FakePacker(object):
+
+    def __init__(self):
+        self.packed = 0
+
+    def packb(self, data):
+        self.packed += 1
+        return repr(data).encode()
+
+
+class FakeProtocol(object):
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.packer = FakePacker()
+        self.calls = {}
+        self.counter = 0
+
+    def _new_id(self):
+        self.counter += 1
+        return b'header%d' % self.counter, self.counter
+
+
+class FakeClient(object):
+
+    def __init__(self, transport=None):
+        self._proto = FakeProtocol(transport)
+
+
+class TestCallMany(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_encode_once(self):
+        """the arguments are encoded once and sent to every client"""
+        clients = [FakeClient(FakeTransport()) for _ in range(3)]
+        args = ('envelope', 'event', [0], b'x' * 1000)
+        futures = call_many(clients, 'send_item', args, loop=self.loop)
+
+        assert len(futures) == 3
+        assert clients[0]._proto.packer.packed == 2
+        frames = [client._proto.transport.frames for client in clients]
+        assert all(len(sent) == 1 for sent in frames)
+        assert frames[0][0][1] == b'send_item'
+        assert frames[0][0][2] == repr(args).encode()
+        for sent in frames[1:]:
+            assert sent[0][2] is frames[0][0][2], "Payload not shared"
+        for client, future in zip(clients, futures):
+            assert client._proto.calls[1] is future
+
+    def test_closed(self):
+        """calls to closed clients fail without affecting the others"""
+        clients = [FakeClient(None), FakeClient(FakeTransport())]
+        futures = call_many(clients, 'send_item', (b'data',), loop=self.loop)
+        assert futures[0].done() and futures[0].exception() is not None
+        assert not futures[1].done()
+
+
+class TestSocketTuning(unittest.TestCase):
+
+    def test_apply(self):
+        """the configured options are set on the sockets"""
+        config = configparser.ConfigParser()
+        config.read_string(
+            '[zmq]\nsndhwm = 5000\nlinger = 0\ntcp_keepalive = 1\n'
+        )
+        tuning = get_socket_tuning(config)
+        sock = FakeSocket()
+        tuning.apply(sock)
+        assert sock.options == {
+            zmq.SNDHWM: 5000, zmq.LINGER: 0, zmq.TCP_KEEPALIVE: 1
+        }
+
+    def test_defaults(self):
+        """no option is set without configuration"""
+        config = configparser.ConfigParser()
+        config.read_string('[zmq]\n')
+        sock = FakeSocket()
+        get_socket_tuning(config).apply(sock)
+        assert sock.options == {}
+
+    def test_endpoint_for(self):
+        """the ipc endpoint is preferred for recipients on the same host"""
+        url = 'tcp://127.0.0.1:5555'
+        metadata = {'host': socket.gethostname(), 'ipc_uri': 'ipc:///tmp/r'}
+        assert SocketTuning().endpoint_for(url, metadata) == 'ipc:///tmp/r'
+        assert SocketTuning(prefer_ipc=False).endpoint_for(
+            url, metadata
+        ) == url
+
+        remote = dict(metadata, host=socket.gethostname() + '.elsewhere')
+        assert SocketTuning().endpoint_for(url, remote) == url
+        assert SocketTuning().endpoint_for(
+            url, {'host': socket.gethostname()}
+        ) == url
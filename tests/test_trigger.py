@@ -0,0 +1,40 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import unittest
+
+from xbus.broker.core.trigger import Trigger
+
+
+class TestTrigger(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.trigger = Trigger(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_lazy(self):
+        """no future is created until a coroutine waits"""
+        self.trigger.fire()
+        assert self.trigger.future is None
+
+    def test_fire(self):
+        """the waiting coroutines are woken up with True"""
+        waiter = asyncio.async(self.trigger.wait(), loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        assert self.trigger.future is not None
+        self.trigger.fire()
+        assert self.loop.run_until_complete(waiter) is True
+        assert self.trigger.future is None
+
+    def test_cancel(self):
+        """once cancelled, waiting returns False at once"""
+        waiter = asyncio.async(self.trigger.wait(), loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.trigger.cancel()
+        assert self.loop.run_until_complete(waiter) is False
+        self.trigger.fire()
+        assert self.loop.run_until_complete(self.trigger.wait()) is False
@@ -2,5 +2,7 @@
 __author__ = 'faide'
 
 from xbus.broker.cli.main import get_config
+from xbus.broker.cli.main import load_config
 from xbus.broker.cli.setup_application import setup_xbusbroker
 from xbus.broker.cli.start_server import start_server
+from xbus.broker.cli.replay_event import replay_event
@@ -25,14 +25,20 @@ def get_config():  # pragma: nocover
     )
 
     (options, args) = optparser.parse_args()
+    return load_config(options.config_file)
 
+
+def load_config(config_file):  # pragma: nocover
+    """Create a Config object from the given config file and initialize the
+    logging system accordingly
+    """
     config = ConfigParser()
-    if not os.path.exists(options.config_file):
+    if not os.path.exists(config_file):
         # can't log when logging system is not yet ready
-        print('Config file: %s not found !' % options.config_file)
+        print('Config file: %s not found !' % config_file)
         sys.exit(1)
 
-    config.read(options.config_file)
+    config.read(config_file)
 
     logging_configfile = os.path.abspath(config.get('logging', 'configfile'))
     if not os.path.exists(logging_configfile):
@@ -0,0 +1,126 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import optparse
+import sys
+import logging
+
+from aiozmq import rpc
+
+from xbus.broker.cli import load_config
+from xbus.broker.core import prepare_event_loop
+
+logger = logging.getLogger(__name__)
+
+
+@asyncio.coroutine
+def run_replay(
+    config, event_id, targets, rate=None, batch_size=500, interval=1,
+    loop=None
+) -> bool:
+    """Ask the backend to replay an event through the branches leading to the
+    given consumer nodes, and report its progress until it is finished.
+
+    :param config:
+     a config instance returned by the load_config helper
+
+    :param event_id:
+     the UUID of the event to replay
+
+    :param targets:
+     the UUIDs of the consumer nodes that must receive the event again
+
+    :param rate:
+     an optional maximum number of items sent per second
+
+    :param batch_size:
+     the number of items read at once from the database
+
+    :param interval:
+     the period of time in seconds between two progress reports
+
+    :param loop:
+     the event loop you want to use
+
+    :return:
+     True if the replay was successful, False otherwise
+    """
+    client = yield from rpc.connect_rpc(
+        connect=config.get('zmq', 'backsocket'), loop=loop
+    )
+    try:
+        replay_id = yield from client.call.replay_event(
+            event_id, targets, rate=rate, batch_size=batch_size
+        )
+        while True:
+            yield from asyncio.sleep(interval, loop=loop)
+            progress = yield from client.call.get_replay_progress(replay_id)
+            if progress is None:
+                print('Replay {} is unknown to the backend'.format(replay_id))
+                return False
+
+            print(
+                '{state}: {sent}/{total} items ({rate:.1f} items/s) '
+                '{message}'.format(**progress)
+            )
+            if progress['state'] in ('done', 'fail'):
+                return progress['state'] == 'done'
+    finally:
+        client.close()
+
+
+def replay_event() -> None:  # pragma: nocover
+    """A command line tool used to replay an event through the branches of
+    its graph that lead to some consumers
+    """
+    optparser = optparse.OptionParser(
+        usage='%prog -c CONFIG -e EVENT_ID -t CONSUMER_NODE_ID [...]'
+    )
+    optparser.add_option(
+        "-c", "--config",
+        dest="config_file",
+        help="Read the configuration from FILE",
+        metavar="FILE",
+        default="/etc/xbus.ini"
+    )
+    optparser.add_option(
+        "-e", "--event",
+        dest="event_id",
+        help="UUID of the event to replay",
+    )
+    optparser.add_option(
+        "-t", "--target",
+        dest="targets",
+        action="append",
+        default=[],
+        help="UUID of a consumer node the event must reach (repeatable)",
+    )
+    optparser.add_option(
+        "-r", "--rate",
+        dest="rate",
+        type="float",
+        help="Maximum number of items sent per second",
+    )
+    optparser.add_option(
+        "-b", "--batch-size",
+        dest="batch_size",
+        type="int",
+        default=500,
+        help="Number of items read at once from the database",
+    )
+
+    (options, args) = optparser.parse_args()
+    if not options.event_id or not options.targets:
+        optparser.error('an event and at least one target are required')
+
+    config = load_config(options.config_file)
+    prepare_event_loop()
+    loop = asyncio.get_event_loop()
+    res = loop.run_until_complete(
+        run_replay(
+            config, options.event_id, options.targets, rate=options.rate,
+            batch_size=options.batch_size, loop=loop
+        )
+    )
+    sys.exit(0 if res else 1)
@@ -0,0 +1,218 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import logging
+import os
+import time
+
+from xbus.broker.core.errors import OverloadedError
+from xbus.broker.core.metrics import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+
+def get_rss() -> int:
+    """Find the resident memory of the process, in bytes, or None if it
+    cannot be known (ie: on systems without /proc).
+    """
+    try:
+        with open('/proc/self/statm', 'rb') as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+class AdmissionController(object):
+    """An AdmissionController refuses new envelopes while the broker is
+    overloaded, so that the envelopes already accepted can finish instead of
+    all of them slowing down until the broker runs out of memory.
+
+    The front and the backend each have one. It samples, every `interval`
+    seconds:
+
+    - the lag of the event loop, ie: how late a sleep of `interval` seconds
+      wakes up;
+    - the number of open envelopes (`broker.envelopes`);
+    - the number of items waiting to be forwarded
+      (`broker.queued_items()`);
+    - the resident memory of the process.
+
+    The broker is overloaded when one of them is above its threshold; a
+    threshold of 0 disables the corresponding check. Checking is then as
+    cheap as reading an attribute.
+    """
+
+    def __init__(
+        self, broker, max_lag: float=0.5, max_envelopes: int=10000,
+        max_queued: int=1000000, max_rss: int=0, interval: float=0.1,
+        loop=None
+    ):
+        """
+        :param broker:
+         the :class:`.XbusBrokerFront` or :class:`.XbusBrokerBack` instance
+         to watch
+
+        :param max_lag:
+         the lag of the event loop above which the broker is overloaded, in
+         seconds
+
+        :param max_envelopes:
+         the number of open envelopes above which the broker is overloaded
+
+        :param max_queued:
+         the number of waiting items above which the broker is overloaded
+
+        :param max_rss:
+         the resident memory above which the broker is overloaded, in bytes
+
+        :param interval:
+         the period of time in seconds between two samples
+
+        :param loop:
+         the event loop used by the broker
+        """
+        self.broker = broker
+        self.max_lag = max_lag
+        self.max_envelopes = max_envelopes
+        self.max_queued = max_queued
+        self.max_rss = max_rss
+        self.interval = interval
+        self.loop = loop
+
+        self.lag = 0.0
+        self.queued = 0
+        self.rss = None
+        self.lag_histogram = LatencyHistogram()
+        # Why the broker is overloaded, None when it is not.
+        self.reason = None
+        self.rejected = 0
+        self.task = None
+
+    def start(self):
+        """Start sampling in the background.
+        """
+        if self.task is None:
+            self.task = asyncio.async(self.watch(), loop=self.loop)
+
+    def stop(self):
+        """Stop sampling.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    @asyncio.coroutine
+    def watch(self):
+        """Internal helper method used to sample the load of the broker
+        until cancelled.
+        """
+        while True:
+            expected = time.monotonic() + self.interval
+            yield from asyncio.sleep(self.interval, loop=self.loop)
+            self.lag = max(time.monotonic() - expected, 0.0)
+            self.lag_histogram.observe(self.lag)
+            try:
+                self.sample()
+            except Exception:
+                logger.exception('Could not sample the load of the broker')
+
+    def sample(self):
+        """Sample the load of the broker, besides the loop lag, and decide
+        whether it is overloaded.
+        """
+        self.queued = self.broker.queued_items()
+        if self.max_rss:
+            self.rss = get_rss()
+
+        reason = None
+        if self.max_lag and self.lag > self.max_lag:
+            reason = 'Event loop lag of {:.3f}s'.format(self.lag)
+        elif (
+            self.max_envelopes and
+            len(self.broker.envelopes) > self.max_envelopes
+        ):
+            reason = 'Too many open envelopes'
+        elif self.max_queued and self.queued > self.max_queued:
+            reason = 'Too many items waiting'
+        elif self.max_rss and self.rss and self.rss > self.max_rss:
+            reason = 'Too much memory used'
+
+        if reason != self.reason:
+            if reason is None:
+                logger.info('No longer overloaded')
+            else:
+                logger.warning('Overloaded: %s', reason)
+        self.reason = reason
+
+    def check(self):
+        """Check that a new envelope may be accepted.
+
+        :raises OverloadedError:
+         if the broker is overloaded
+        """
+        if self.reason is not None:
+            self.rejected += 1
+            raise OverloadedError(self.reason)
+
+    def snapshot(self) -> dict:
+        """Report the load of the broker.
+
+        :return:
+         a dict with the last samples, the thresholds, whether the broker is
+         overloaded and why, the number of refused envelopes, and the
+         distribution of the loop lag (see :meth:`.LatencyHistogram.snapshot`)
+        """
+        return {
+            'lag': self.lag,
+            'envelopes': len(self.broker.envelopes),
+            'queued': self.queued,
+            'rss': self.rss,
+            'max_lag': self.max_lag,
+            'max_envelopes': self.max_envelopes,
+            'max_queued': self.max_queued,
+            'max_rss': self.max_rss,
+            'overloaded': self.reason is not None,
+            'reason': self.reason,
+            'rejected': self.rejected,
+            'lag_histogram': self.lag_histogram.snapshot(),
+        }
+
+
+def get_admission_controller(broker, config, loop=None):
+    """A helper function that is used internally to create the admission
+    controller of the front or the backend from the `admission` section of
+    the configuration, and start it.
+
+    :param broker:
+     the :class:`.XbusBrokerFront` or :class:`.XbusBrokerBack` instance to
+     watch
+
+    :param config:
+     the application configuration instance
+     :class:`configparser.ConfigParser`
+
+    :param loop:
+     the event loop used by the broker
+
+    :return:
+     the running :class:`AdmissionController`, or None if admission control
+     is disabled
+    """
+    if not config.getboolean('admission', 'enabled', fallback=True):
+        return None
+
+    admission = AdmissionController(
+        broker,
+        max_lag=config.getfloat('admission', 'max_lag', fallback=0.5),
+        max_envelopes=config.getint(
+            'admission', 'max_envelopes', fallback=10000
+        ),
+        max_queued=config.getint('admission', 'max_queued', fallback=1000000),
+        max_rss=config.getint('admission', 'max_rss', fallback=0) << 20,
+        interval=config.getfloat('admission', 'interval', fallback=0.1),
+        loop=loop,
+    )
+    admission.start()
+    return admission
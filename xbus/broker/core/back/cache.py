@@ -0,0 +1,157 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import time
+from collections import OrderedDict
+
+from sqlalchemy.sql import select
+
+from xbus.broker.model import event_type
+
+
+class ReplyCache(object):
+    """A ReplyCache keeps the replies of the consumers to the immediate reply
+    events whose type has a `reply_cache_ttl`, keyed by a digest of the event
+    type and items (see :meth:`.Event.defer`).
+
+    Identical requests received while a reply is being computed are
+    coalesced: they wait for the pending reply instead of calling the
+    consumer again.
+    """
+
+    def __init__(self, broker, max_entries: int=10000, loop=None):
+        """
+        :param broker:
+         the :class:`.XbusBrokerBack` instance whose database is used
+
+        :param max_entries:
+         the number of replies above which the oldest ones are forgotten
+
+        :param loop:
+         the event loop used by the backend
+        """
+        self.broker = broker
+        self.max_entries = max_entries
+        self.loop = loop
+
+        # {key: (expiry time, reply data)}
+        self.entries = OrderedDict()
+        # {key: Future of the (success, reply data) 2-tuple}
+        self.inflight = {}
+        # {type ID: TTL in seconds}
+        self.ttls = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    @asyncio.coroutine
+    def ttl_for(self, type_id: str) -> int:
+        """Find the number of seconds the replies to an event type may be
+        cached. The value is read from the database once per event type.
+
+        :param type_id:
+         the UUID of the event type
+
+        :return:
+         the TTL, 0 when the replies of the event type are not cached
+        """
+        ttl = self.ttls.get(type_id)
+        if ttl is None:
+            with (yield from self.broker.dbengine) as conn:
+                query = select([event_type.c.reply_cache_ttl])
+                query = query.where(event_type.c.id == type_id)
+                cr = yield from conn.execute(query)
+                row = yield from cr.first()
+            ttl = self.ttls[type_id] = (row[0] or 0) if row else 0
+        return ttl
+
+    def get(self, key: str) -> tuple:
+        """Look up a reply.
+
+        :param key:
+         the digest of the event
+
+        :return:
+         a 2-tuple (found, reply data)
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return False, None
+        expires, reply_data = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return False, None
+        return True, reply_data
+
+    def put(self, key: str, reply_data, ttl: float):
+        """Keep a reply for `ttl` seconds.
+
+        :param key:
+         the digest of the event
+
+        :param reply_data:
+         the data sent back by the consumer
+
+        :param ttl:
+         the number of seconds the reply may be served from the cache
+        """
+        self.entries.pop(key, None)
+        self.entries[key] = (time.monotonic() + ttl, reply_data)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """Forget the cached replies and the TTLs of the event types.
+        """
+        self.entries.clear()
+        self.ttls.clear()
+
+    @asyncio.coroutine
+    def fetch(self, key: str, ttl: float, compute) -> tuple:
+        """Get the reply to an event from the cache, from an identical
+        request in progress, or by calling `compute`.
+
+        :param key:
+         the digest of the event
+
+        :param ttl:
+         the number of seconds a computed reply may be served from the cache
+
+        :param compute:
+         a callable returning a coroutine which calls the consumer, and
+         returns a (success, reply data) 2-tuple
+
+        :return:
+         a 3-tuple (success, reply data, cached), where cached is True when
+         the consumer was not called for this event
+        """
+        found, reply_data = self.get(key)
+        if found:
+            return True, reply_data, True
+
+        pending = self.inflight.get(key)
+        while pending is not None:
+            success, reply_data = yield from asyncio.shield(
+                pending, loop=self.loop
+            )
+            if success:
+                return True, reply_data, True
+            # The other request failed: the first waiter to wake up calls
+            # the consumer again, the others wait for it.
+            pending = self.inflight.get(key)
+
+        future = asyncio.Future(loop=self.loop)
+        self.inflight[key] = future
+        success, reply_data = False, None
+        try:
+            success, reply_data = yield from compute()
+            if success:
+                self.put(key, reply_data, ttl)
+        finally:
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+            # One of the waiters retries when the call failed.
+            future.set_result((success, reply_data))
+
+        return success, reply_data, False
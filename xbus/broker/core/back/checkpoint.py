@@ -0,0 +1,198 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import json
+import logging
+import os
+
+from xbus.broker.model.helpers import get_envelopes_by_state
+from xbus.broker.model.helpers import get_envelope_events
+from xbus.broker.core.back.replay import dispatch_stored_items
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpointer(object):
+    """A Checkpointer periodically saves the progress of the envelopes
+    handled by the backend into a local file, and uses it to resume the
+    envelopes that were being executed when the backend stopped.
+
+    The progress of an envelope is the highest item index acknowledged by
+    each consumer node of each of its events::
+
+        {envelope ID: {event ID: {node ID: index}}}
+
+    When an envelope is recovered, the items of each event are forwarded
+    again starting from the lowest acknowledged index, and the consumers
+    skip the items they had already acknowledged. Consumers must therefore
+    accept to receive the start_event call of an envelope again.
+    """
+
+    def __init__(self, broker, path: str, interval: float=5, loop=None):
+        """Create a new checkpointer.
+
+        :param broker:
+         the :class:`.XbusBrokerBack` instance
+
+        :param path:
+         the path of the checkpoint file
+
+        :param interval:
+         the period of time in seconds between two checkpoints
+
+        :param loop:
+         the event loop used by the backend
+        """
+        self.broker = broker
+        self.path = path
+        self.interval = interval
+        self.loop = loop
+
+        # Envelopes waiting to be recovered: {envelope ID: progress}
+        self.recovering = {}
+
+    def snapshot(self) -> dict:
+        """Compute the progress of the live envelopes.
+
+        :return:
+         the progress of the envelopes, in the checkpoint file format
+        """
+        state = dict(self.recovering)
+        for envelope_id, envelope in self.broker.envelopes.items():
+            if envelope.stopped:
+                continue
+            state[envelope_id] = {
+                event_id: {
+                    node.node_id: node.acked
+                    for node in event.nodes.values() if node.is_consumer()
+                }
+                for event_id, event in envelope.events.items()
+            }
+        return state
+
+    def load(self) -> dict:
+        """Read the checkpoint file.
+
+        :return:
+         the progress of the envelopes saved in the file, or an empty dict
+        """
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.error('Invalid checkpoint file %s, ignored', self.path)
+            return {}
+
+    def write(self, state: dict):
+        """Write the checkpoint file atomically.
+
+        :param state:
+         the progress of the envelopes
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    @asyncio.coroutine
+    def save(self):
+        """Save the progress of the live envelopes, without blocking the
+        event loop while the file is written.
+        """
+        state = self.snapshot()
+        yield from self.loop.run_in_executor(None, self.write, state)
+
+    @asyncio.coroutine
+    def run(self, recovery_delay: float=10):
+        """Resume the envelopes that were being executed, then save a
+        checkpoint at regular intervals. The envelopes that cannot be
+        resumed yet (ie: their workers are not registered) are retried at
+        each interval.
+
+        :param recovery_delay:
+         the period of time in seconds to wait before resuming envelopes, to
+         let workers and consumers register themselves
+        """
+        progress = self.load()
+        with (yield from self.broker.dbengine) as conn:
+            envelope_ids = yield from get_envelopes_by_state(conn, 'exec')
+        self.recovering = {
+            envelope_id: progress.get(envelope_id, {})
+            for envelope_id in envelope_ids
+        }
+        if self.recovering:
+            logger.info('%d envelopes to recover', len(self.recovering))
+            yield from asyncio.sleep(recovery_delay, loop=self.loop)
+
+        while True:
+            for envelope_id in list(self.recovering):
+                try:
+                    res = yield from self.recover(envelope_id)
+                except Exception:
+                    logger.exception('Could not recover %s', envelope_id)
+                    res = False
+                if res:
+                    del self.recovering[envelope_id]
+
+            try:
+                yield from self.save()
+            except OSError:
+                logger.exception('Could not write checkpoint %s', self.path)
+            yield from asyncio.sleep(self.interval, loop=self.loop)
+
+    @asyncio.coroutine
+    def recover(self, envelope_id: str) -> bool:
+        """Resume an envelope from its saved progress.
+
+        :param envelope_id:
+         the UUID of the envelope
+
+        :return:
+         True if the envelope has been resumed, False if it must be retried
+        """
+        broker = self.broker
+        progress = self.recovering[envelope_id]
+        if envelope_id in broker.envelopes:
+            return True
+
+        with (yield from broker.dbengine) as conn:
+            events = yield from get_envelope_events(conn, envelope_id)
+
+        broker.open_envelope(envelope_id)
+        envelope = broker.envelopes[envelope_id]
+
+        started = []
+        for event_id, type_id, type_name in events:
+            res = yield from broker.start_event(
+                envelope_id, event_id, type_id, type_name
+            )
+            if not res or res[0] != 0:
+                yield from broker.cancel_envelope(envelope_id)
+                return False
+
+            event = envelope[event_id]
+            acked = progress.get(event_id, {})
+            consumers = [
+                node for node in event.nodes.values() if node.is_consumer()
+            ]
+            for node in consumers:
+                node.skip_until = acked.get(node.node_id, -1)
+            start = min((node.skip_until for node in consumers), default=-1)
+            started.append((event, start + 1))
+
+        for event, start in started:
+            nb_items = yield from dispatch_stored_items(
+                broker, envelope, event, start
+            )
+            yield from broker.end_event(
+                envelope_id, event.event_id, nb_items, False
+            )
+        yield from broker.end_envelope(envelope_id)
+
+        logger.info('Envelope %s recovered', envelope_id)
+        return True
@@ -2,18 +2,48 @@
 __author__ = 'jgavrel'
 
 import asyncio
+import contextlib
 from datetime import datetime
 from uuid import uuid4
 from sqlalchemy import func
 from xbus.broker.model.logging import envelope
 from xbus.broker.model.logging import event_error
+from xbus.broker.core.blobstore import BlobRef
 from xbus.broker.core.back.event import Event
+from xbus.broker.core.back.spill import SpillQueue
+from xbus.broker.core.back.spill import DEFAULT_SPILL_THRESHOLD
+from xbus.broker.core.features import RecipientFeature
+from xbus.broker.core.metrics import REGISTRY
+from xbus.broker.core.tracing import traced
+from xbus.broker.core.transport import call_many
+from xbus.broker.core.trigger import Trigger
+
+items_in_flight = REGISTRY.gauge(
+    'xbus_node_items_in_flight',
+    'Items held for a node until it is ready to receive them', ('node',),
+)
 
 
 class Envelope(object):
     """An Envelope instance represents a transactional unit and controls its
     execution through the network. It can contain several events."""
 
+    __slots__ = (
+        'envelope_id', 'client_calls', 'events', 'dbengine', 'loop',
+        'stopped', 'trigger', 'spill_threshold', 'spill_dir', 'limiter',
+        'tenant', 'weight', 'blobs', 'registry', 'touched',
+    )
+
+    # Labels the spans of the envelope, see tracing.
+    component = 'back'
+
+    # Time limits of the calls to the recipients, in seconds.
+    start_event_timeout = 60
+    send_item_timeout = 60
+    end_event_timeout = 3600
+    end_envelope_timeout = 3600
+    stop_envelope_timeout = 60
+
     def __init__(self, envelope_id: str, dbengine=None, loop=None):
         """Initializes a new Envelope instance.
 
@@ -32,12 +62,22 @@ class Envelope(object):
         self.dbengine = dbengine
         self.loop = loop
         self.stopped = False
-        self.trigger = asyncio.Future(loop=loop)
-        self.start_event_timeout = 60
-        self.send_item_timeout = 60
-        self.end_event_timeout = 3600
-        self.end_envelope_timeout = 3600
-        self.stop_envelope_timeout = 60
+        self.trigger = Trigger(loop)
+        self.spill_threshold = DEFAULT_SPILL_THRESHOLD
+        self.spill_dir = None
+        # A :class:`.PriorityLimiter` shared by the envelopes, bounding the
+        # number of items in flight towards the recipients, and the tenant
+        # the items of the envelope are accounted to.
+        self.limiter = None
+        self.tenant = None
+        self.weight = 1
+        # The :class:`.BlobStore` holding the data of the claim checked
+        # items, if enabled.
+        self.blobs = None
+        # The :class:`.EnvelopeRegistry` the envelope is registered in, and
+        # when it was last active.
+        self.registry = None
+        self.touched = 0
 
     def new_event(self, event_id, type_name, type_id):
         """Create a new :class:`.Event` instance and add it to the envelope.
@@ -61,6 +101,200 @@ class Envelope(object):
         self.events[event_id] = event
         return event
 
+    def hold_item(self, node, data: bytes):
+        """Keep the data of an item until the node is ready to receive it.
+        The data is stored in the node's :class:`.SpillQueue`, so that the
+        items waiting for a slow node do not pile up in memory.
+
+        :param node:
+         the node object the item will be forwarded to
+
+        :param data:
+         the item data
+
+        :return:
+         a handle to give to the send_item methods of the envelope
+        """
+        if node.pending is None:
+            node.pending = SpillQueue(self.spill_threshold, self.spill_dir)
+        items_in_flight.labels(node.node_id).inc()
+        if self.registry is not None:
+            self.registry.held += 1
+        return node.pending.push(data)
+
+    def release_item(self, node, handle) -> bytes:
+        """Retrieve the data of an item previously stored using
+        :meth:`hold_item`.
+
+        :param node:
+         the node object the item is forwarded to
+
+        :param handle:
+         the handle returned by :meth:`hold_item`
+
+        :return:
+         the item data
+        """
+        items_in_flight.labels(node.node_id).dec()
+        if self.registry is not None:
+            self.registry.held -= 1
+        return node.pending.pop(handle)
+
+    @asyncio.coroutine
+    def inline_blob(self, data, recipients: list) -> bytes:
+        """Read the data of a claim checked item, if one of the recipients
+        it is forwarded to does not support the "claim_check" feature.
+
+        :param data:
+         the item data, or its :class:`.BlobRef`
+
+        :param recipients:
+         the recipients the item is forwarded to
+
+        :return:
+         the data of the blob, or None if it is not needed
+
+        :raises OSError:
+         if the blob could not be read
+        """
+        if isinstance(data, BlobRef) and not all(
+            recipient.has_feature(RecipientFeature.claim_check)
+            for recipient in recipients
+        ):
+            res = yield from self.blobs.get(data.handle)
+            return res
+        return None
+
+    def send_item_calls(
+        self, recipients: list, event, indices: list, data, inline
+    ) -> list:
+        """Call the send_item method of recipients, or their send_item_blob
+        method to give them the handle of a claim checked item if they
+        support the "claim_check" feature. The request is encoded once for
+        all the recipients (see :func:`.call_many`), except for those with a
+        shared memory ring (see :meth:`send_item_shm`).
+
+        :param recipients:
+         the recipient objects
+
+        :param event:
+         the event object
+
+        :param indices:
+         the item indices
+
+        :param data:
+         the item data, or its :class:`.BlobRef`
+
+        :param inline:
+         the data of the blob, as returned by :meth:`inline_blob`
+
+        :return:
+         the future or coroutine of the reply of each recipient
+        """
+        blob = data if isinstance(data, BlobRef) else None
+        if blob is not None:
+            data = inline
+
+        calls = [None] * len(recipients)
+        # The positions of the recipients called through each method.
+        groups = {'send_item': [], 'send_item_blob': []}
+        for position, recipient in enumerate(recipients):
+            if (
+                blob is not None and
+                recipient.has_feature(RecipientFeature.claim_check)
+            ):
+                groups['send_item_blob'].append(position)
+            elif recipient.ring is not None:
+                calls[position] = self.send_item_shm(
+                    recipient, event, indices, data
+                )
+            else:
+                groups['send_item'].append(position)
+
+        args = (self.envelope_id, event.event_id, indices)
+        for name, positions in groups.items():
+            if not positions:
+                continue
+            if name == 'send_item_blob':
+                call_args = args + (blob.handle, blob.size)
+            else:
+                call_args = args + (data,)
+            futures = call_many(
+                [recipients[position].socket_for(event)
+                 for position in positions],
+                name, call_args, loop=self.loop
+            )
+            for position, future in zip(positions, futures):
+                calls[position] = future
+        return calls
+
+    @asyncio.coroutine
+    def send_item_shm(self, recipient, event, indices: list, data: bytes):
+        """Call the send_item_shm method of a recipient, with the offset
+        and size of the item data in its shared memory ring, or its send_item
+        method if the data does not fit in the ring.
+
+        :return:
+         the reply of the recipient
+        """
+        call = recipient.socket_for(event).call
+        # The recipient may be replaced, and its ring retired, meanwhile.
+        ring = recipient.ring
+        offset = None if ring is None else ring.write(data)
+        if offset is None:
+            res = yield from call.send_item(
+                self.envelope_id, event.event_id, indices, data
+            )
+            return res
+        try:
+            res = yield from call.send_item_shm(
+                self.envelope_id, event.event_id, indices, offset, len(data)
+            )
+        except asyncio.CancelledError:
+            # ie: the call timed out; the recipient may still be reading the
+            # data, so its space is left allocated.
+            raise
+        except Exception:
+            ring.release(offset)
+            raise
+        ring.release(offset)
+        return res
+
+    def release_all_items(self):
+        """Forget the items still waiting to be forwarded to the nodes of
+        the envelope and remove their spill files.
+        """
+        for event in self.events.values():
+            for node in event.nodes.values():
+                if node.pending is not None:
+                    items_in_flight.labels(node.node_id).dec(
+                        len(node.pending)
+                    )
+                    if self.registry is not None:
+                        self.registry.held -= len(node.pending)
+                    node.pending.close()
+                    node.pending = None
+
+    @asyncio.coroutine
+    def acquire_slot(self, event):
+        """Wait until an item of the event may be sent to a recipient, the
+        items of immediate reply events being served first, and the others
+        in turn with the items of the other tenants.
+
+        :param event:
+         the event object
+
+        :return:
+         a context manager releasing the slot
+        """
+        if self.limiter is None:
+            return contextlib.suppress()
+        slot = yield from self.limiter.acquire(
+            event.immediate_reply, self.tenant, self.weight
+        )
+        return slot
+
     @asyncio.coroutine
     def watch_call(self, call, timeout):
         """Call a coroutine with a timeout. The created :class:`asyncio.Task`
@@ -88,7 +322,17 @@ class Envelope(object):
                 self.client_calls.remove(task)
             except KeyError:
                 pass
+            if self.registry is not None:
+                self.registry.touch(self)
+
+    def unregister(self):
+        """Remove the envelope from its registry, once it has ended or has
+        been stopped.
+        """
+        if self.registry is not None:
+            self.registry.discard(self)
 
+    @traced('end_envelope')
     @asyncio.coroutine
     def end_envelope(self):
         """Wait until every event in the envelope is fully treated, then
@@ -98,38 +342,44 @@ class Envelope(object):
          None
         """
 
-        all_nodes = {}
-        for key, event in self.events.items():
-            all_nodes.update(event.nodes)
+        try:
+            all_nodes = {}
+            for key, event in self.events.items():
+                all_nodes.update(event.nodes)
+
+            worker_nodes = []
+            consumer_nodes = []
+            for node in all_nodes.values():
+                if node.is_consumer():
+                    consumer_nodes.append(node)
+                else:
+                    worker_nodes.append(node)
 
-        worker_nodes = []
-        consumer_nodes = []
-        for node in all_nodes.values():
-            if node.is_consumer():
-                consumer_nodes.append(node)
-            else:
-                worker_nodes.append(node)
+            while not all(node.done for node in consumer_nodes):
+                trigger_res = yield from self.trigger.wait()
+                if trigger_res is False:
+                    return False
 
-        while not all(node.done for node in consumer_nodes):
-            trigger_res = yield from self.trigger
-            if trigger_res is False:
-                return False
+            tasks = []
 
-        tasks = []
+            for node in consumer_nodes:
+                task = asyncio.async(
+                    self.consumer_end_envelope(node), loop=self.loop
+                )
+                tasks.append(task)
 
-        for node in consumer_nodes:
-            task = asyncio.async(
-                self.consumer_end_envelope(node), loop=self.loop
-            )
-            tasks.append(task)
+            for node in worker_nodes:
+                asyncio.async(self.worker_end_envelope(node), loop=self.loop)
 
-        for node in worker_nodes:
-            asyncio.async(self.worker_end_envelope(node), loop=self.loop)
+            self.release_all_items()
 
-        res = yield from asyncio.gather(tasks, loop=self.loop)
-        if all(res):
-            yield from self.__update_envelope_state_done()
+            res = yield from asyncio.gather(*tasks, loop=self.loop)
+            if all(res):
+                yield from self.__update_envelope_state_done()
+        finally:
+            self.unregister()
 
+    @traced('stop_envelope')
     @asyncio.coroutine
     def stop_envelope(self, cancelled=False):
         """
@@ -139,32 +389,40 @@ class Envelope(object):
         :param cancelled:
          True if the envelope has been cancelled by the emitter.
         """
-        if self.stopped:
-            return
-        self.stopped = True
-
-        # Cancel ongoing RPC calls
-        for call in self.client_calls:
-            call.cancel()
-
-        all_nodes = {}
-        # Cancel planned (ie blocked by wait_trigger) RPC calls
-        for key, event in self.events.items():
-            all_nodes.update(event.nodes)
-
-        # Update the envelope's state, unless the front-end already did so.
-        if not cancelled:
-            yield from self.update_envelope_state_stopped()
-
-        # Warn the workers and consumers
-        for node in all_nodes.values():
-            node.cancel_trigger()
-            if node.is_consumer():
-                coro = self.consumer_stop_envelope
-            else:
-                coro = self.worker_stop_envelope
-            asyncio.async(coro(node), loop=self.loop)
+        try:
+            if self.stopped:
+                return
+            self.stopped = True
+            # Release end_envelope, if it is waiting for the consumers.
+            self.trigger.cancel()
+
+            # Cancel ongoing RPC calls
+            for call in self.client_calls:
+                call.cancel()
+            self.release_all_items()
+
+            all_nodes = {}
+            # Cancel planned (ie blocked by wait_trigger) RPC calls
+            for key, event in self.events.items():
+                all_nodes.update(event.nodes)
+
+            # Update the envelope's state, unless the front-end already did
+            # so.
+            if not cancelled:
+                yield from self.update_envelope_state_stopped()
+
+            # Warn the workers and consumers
+            for node in all_nodes.values():
+                node.cancel_trigger()
+                if node.is_consumer():
+                    coro = self.consumer_stop_envelope
+                else:
+                    coro = self.worker_stop_envelope
+                asyncio.async(coro(node), loop=self.loop)
+        finally:
+            self.unregister()
 
+    @traced('worker_start_event')
     @asyncio.coroutine
     def worker_start_event(self, node, event) -> bool:
         """Forward the new event to the workers.
@@ -181,7 +439,7 @@ class Envelope(object):
         if self.stopped:
             return False
 
-        call = node.recipient.socket.call.start_event(
+        call = node.recipient.socket_for(event).call.start_event(
             self.envelope_id, event.event_id, event.type_name
         )
         try:
@@ -209,9 +467,10 @@ class Envelope(object):
             asyncio.async(self.stop_envelope(), loop=self.loop)
             return False
 
+    @traced('worker_send_item')
     @asyncio.coroutine
     def worker_send_item(
-            self, node, event, indices: list, data: bytes, forward_index: int
+            self, node, event, indices: list, handle, forward_index: int
     ) -> bool:
         """Forward the item to the workers.
 
@@ -224,8 +483,8 @@ class Envelope(object):
         :param indices:
          the item indices
 
-        :param data:
-         the item data
+        :param handle:
+         the handle of the item data, as returned by :meth:`hold_item`
 
         :param forward_index:
          an index that corresponds to the ordering of the items sent by the
@@ -238,16 +497,26 @@ class Envelope(object):
         if trigger_res is False or self.stopped:
             return False
 
-        call = node.recipient.socket.call.send_item(
-            self.envelope_id, event.event_id, indices, data
-        )
+        data = self.release_item(node, handle)
         try:
-            res = yield from self.watch_call(call, self.send_item_timeout)
-            success, reply = res
-        except (TypeError, ValueError):
-            success, reply = False, [(indices, "Malformed reply data.")]
-        except asyncio.TimeoutError:
-            success, reply = False, [(indices, "Worker timed out.")]
+            inline = yield from self.inline_blob(data, [node.recipient])
+        except OSError:
+            errors = [(indices, "Could not read the item data.")]
+            yield from self.log_event_errors(errors, event, node)
+            asyncio.async(self.stop_envelope(), loop=self.loop)
+            return False
+
+        with (yield from self.acquire_slot(event)):
+            call, = self.send_item_calls(
+                [node.recipient], event, indices, data, inline
+            )
+            try:
+                res = yield from self.watch_call(call, self.send_item_timeout)
+                success, reply = res
+            except (TypeError, ValueError):
+                success, reply = False, [(indices, "Malformed reply data.")]
+            except asyncio.TimeoutError:
+                success, reply = False, [(indices, "Worker timed out.")]
 
         if success:
             for child_id in node.children:
@@ -257,8 +526,9 @@ class Envelope(object):
                         coro = self.consumer_send_item
                     else:
                         coro = self.worker_send_item
+                    rep_handle = self.hold_item(child, rep_data)
                     asyncio.async(
-                        coro(child, event, rep_indices, rep_data, node.sent),
+                        coro(child, event, rep_indices, rep_handle, node.sent),
                         loop=self.loop
                     )
                 node.sent += 1
@@ -269,6 +539,7 @@ class Envelope(object):
             asyncio.async(self.stop_envelope(), loop=self.loop)
             return False
 
+    @traced('worker_end_event')
     @asyncio.coroutine
     def worker_end_event(
         self, node, event, nb_items: int, immediate_reply: bool
@@ -295,7 +566,7 @@ class Envelope(object):
         if trigger_res is False or self.stopped:
             return False, None
 
-        call = node.recipient.socket.call.end_event(
+        call = node.recipient.socket_for(event).call.end_event(
             self.envelope_id, event.event_id
         )
         try:
@@ -322,6 +593,7 @@ class Envelope(object):
             asyncio.async(self.stop_envelope(), loop=self.loop)
             return False, None
 
+    @traced('worker_end_envelope')
     @asyncio.coroutine
     def worker_end_envelope(self, node) -> bool:
         """Forward the end of the envelope to the backend.
@@ -351,6 +623,7 @@ class Envelope(object):
             yield from self.log_event_errors(reply, None, node)
             return False
 
+    @traced('worker_stop_envelope')
     @asyncio.coroutine
     def worker_stop_envelope(self, node) -> bool:
         """Forward the cancellation of the envelope to the workers.
@@ -369,6 +642,7 @@ class Envelope(object):
         except asyncio.TimeoutError:
             return False
 
+    @traced('consumer_start_event')
     @asyncio.coroutine
     def consumer_start_event(self, node, event) -> bool:
         """Forward the new event to the consumers.
@@ -387,7 +661,7 @@ class Envelope(object):
 
         tasks = []
         for recipient in node.recipients:
-            call = recipient.socket.call.start_event(
+            call = recipient.socket_for(event).call.start_event(
                 self.envelope_id, event.event_id, event.type_name
             )
             corobj = self.watch_call(call, self.start_event_timeout)
@@ -410,9 +684,10 @@ class Envelope(object):
             yield from self.log_event_errors(errors, event, node)
             asyncio.async(self.stop_envelope(), loop=self.loop)
 
+    @traced('consumer_send_item')
     @asyncio.coroutine
     def consumer_send_item(
-            self, node, event, indices: list, data: bytes, forward_index: int
+            self, node, event, indices: list, handle, forward_index: int
     ) -> bool:
         """Forward the item to the consumers.
 
@@ -425,8 +700,8 @@ class Envelope(object):
         :param indices:
          the item indices
 
-        :param data:
-         the item data
+        :param handle:
+         the handle of the item data, as returned by :meth:`hold_item`
 
         :param forward_index:
          an index that corresponds to the ordering of the items sent by the
@@ -439,26 +714,43 @@ class Envelope(object):
         if trigger_res is False or self.stopped:
             return False
 
-        tasks = []
-        for recipient in node.recipients:
-            call = recipient.socket.call.send_item(
-                self.envelope_id, event.event_id, indices, data
-            )
-            corobj = self.watch_call(call, self.send_item_timeout)
-            tasks.append(asyncio.async(corobj, loop=self.loop))
+        data = self.release_item(node, handle)
+        if indices and max(indices) <= node.skip_until:
+            # Already acknowledged before the envelope was recovered.
+            node.next_trigger()
+            return True
 
         try:
-            res = yield from asyncio.gather(*tasks, loop=self.loop)
-            errors = [
-                reply for success, replies in res if not success
-                for reply in replies
-            ]
-        except (TypeError, ValueError):
-            errors = [(indices, "Malformed reply data.")]
-        except asyncio.TimeoutError:
-            errors = [([], "Consumer timed out.")]
+            inline = yield from self.inline_blob(data, node.recipients)
+        except OSError:
+            errors = [(indices, "Could not read the item data.")]
+            yield from self.log_event_errors(errors, event, node)
+            asyncio.async(self.stop_envelope(), loop=self.loop)
+            return False
+
+        with (yield from self.acquire_slot(event)):
+            tasks = []
+            calls = self.send_item_calls(
+                node.recipients, event, indices, data, inline
+            )
+            for call in calls:
+                corobj = self.watch_call(call, self.send_item_timeout)
+                tasks.append(asyncio.async(corobj, loop=self.loop))
+
+            try:
+                res = yield from asyncio.gather(*tasks, loop=self.loop)
+                errors = [
+                    reply for success, replies in res if not success
+                    for reply in replies
+                ]
+            except (TypeError, ValueError):
+                errors = [(indices, "Malformed reply data.")]
+            except asyncio.TimeoutError:
+                errors = [([], "Consumer timed out.")]
 
         if not errors:
+            if indices:
+                node.acked = max(node.acked, max(indices))
             node.next_trigger()
             return True
         else:
@@ -466,6 +758,7 @@ class Envelope(object):
             asyncio.async(self.stop_envelope(), loop=self.loop)
             return False
 
+    @traced('consumer_end_event')
     @asyncio.coroutine
     def consumer_end_event(
         self, node, event, nb_items: int, immediate_reply: bool
@@ -496,7 +789,7 @@ class Envelope(object):
 
         tasks = []
         for recipient in node.recipients:
-            call = recipient.socket.call.end_event(
+            call = recipient.socket_for(event).call.end_event(
                 self.envelope_id, event.event_id
             )
             corobj = self.watch_call(call, self.end_event_timeout)
@@ -523,10 +816,7 @@ class Envelope(object):
             return False, None
 
         node.done = True
-
-        if self.trigger._callbacks:
-            self.trigger.set_result(True)
-            self.trigger = asyncio.Future(loop=self.loop)
+        self.trigger.fire()
 
         # Transmit the first (and only) reply back when using the "immediate
         # reply" feature.
@@ -537,6 +827,7 @@ class Envelope(object):
 
         return True, immediate_reply_data
 
+    @traced('consumer_end_envelope')
     @asyncio.coroutine
     def consumer_end_envelope(self, node) -> bool:
         """Forward the end of the envelope to the consumers.
@@ -574,6 +865,7 @@ class Envelope(object):
             asyncio.async(self.stop_envelope(), loop=self.loop)
             return False
 
+    @traced('consumer_stop_envelope')
     @asyncio.coroutine
     def consumer_stop_envelope(self, node):
         """Forward the cancellation of the envelope to the consumers.
@@ -1,15 +1,34 @@
 # -*- encoding: utf-8 -*-
 __author__ = 'faide'
 
+import hashlib
+import sys
+import time
+
+from xbus.broker.core.blobstore import BlobRef
 from xbus.broker.core.back.node import WorkerNode
 from xbus.broker.core.back.node import ConsumerNode
 from xbus.broker.core.back.recipient import Recipient
 
 
+def _shared(value):
+    """Use a single copy of the identifiers repeated by many events.
+    """
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
 class Event(object):
     """An Event instance represents the event datastructure that is manipulated
     by the backend and dispatched to all workers and consumers that need it"""
 
+    __slots__ = (
+        'envelope_id', 'event_id', 'type_name', 'type_id', 'nodes', 'start',
+        'loop', 'immediate_reply', 'started', 'digest', 'deferred',
+        'cache_ttl', 'cached',
+    )
+
     def __init__(
         self, envelope_id: str, event_id: str, type_name: str, type_id: str,
         loop=None
@@ -36,11 +55,20 @@ class Event(object):
         """
         self.envelope_id = envelope_id
         self.event_id = event_id
-        self.type_name = type_name
-        self.type_id = type_id
+        self.type_name = _shared(type_name)
+        self.type_id = _shared(type_id)
         self.nodes = {}
         self.start = []
         self.loop = loop
+        # Immediate reply events are served ahead of bulk ones, see
+        # :class:`.PriorityLimiter`.
+        self.immediate_reply = False
+        self.started = time.monotonic()
+        # Set by :meth:`defer` for events whose reply may be cached.
+        self.digest = None
+        self.deferred = None
+        self.cache_ttl = 0
+        self.cached = False
 
     def new_worker(
         self, node_id, role_id, recipient: Recipient, children, is_start
@@ -93,6 +121,45 @@ class Event(object):
         self._add_node(node, is_start)
         return node
 
+    def defer(self, cache_ttl: int):
+        """Hold the event back until its end, so that its reply may be
+        served by the :class:`.ReplyCache` without calling the consumer.
+
+        :param cache_ttl:
+         the number of seconds the reply may be cached
+        """
+        self.digest = hashlib.sha256(str(self.type_id).encode())
+        self.deferred = []
+        self.cache_ttl = cache_ttl
+
+    def defer_item(self, indices: list, data: bytes, forward_index: int):
+        """Hold an item of a deferred event back, and add it to the digest
+        of the event.
+
+        :param indices:
+         the item indices
+
+        :param data:
+         the item data, or its :class:`.BlobRef`
+
+        :param forward_index:
+         the position of the item in the event
+        """
+        self.digest.update('{}:{}:'.format(indices, len(data)).encode())
+        if isinstance(data, BlobRef):
+            # The handle of a blob is the SHA-256 of its data.
+            self.digest.update(data.handle.encode())
+        else:
+            self.digest.update(data)
+        self.deferred.append((indices, data, forward_index))
+
+    def forget_nodes(self):
+        """Drop the graph of an event which was answered from the cache, so
+        that the end of its envelope does not wait for its nodes.
+        """
+        self.nodes = {}
+        self.start = []
+
     def _add_node(self, node, is_start):
         """Add a node to the graph of the event.
         """
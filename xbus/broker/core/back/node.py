@@ -4,12 +4,19 @@ __author__ = 'jgavrel'
 import asyncio
 
 from xbus.broker.core.back.recipient import Recipient
+from xbus.broker.core.trigger import Trigger
 
 
 class Node(object):
     """a Node instance represents one node in the event datastructure that is
     manipulated by the backend."""
 
+    # Many nodes are alive at once: no per-instance __dict__.
+    __slots__ = (
+        'envelope_id', 'event_id', 'node_id', 'sent', 'recv', 'active',
+        'done', 'trigger', 'pending', 'acked', 'skip_until',
+    )
+
     def __init__(self, envelope_id, event_id, node_id, loop=None):
         """create a new event instance that will be manipulated by the backend,
         it provides a few helper methods and some interesting attributes like
@@ -32,10 +39,16 @@ class Node(object):
         self.node_id = node_id
         self.sent = 0
         self.recv = -1
-        self.loop = loop
         self.active = False
         self.done = False
-        self.trigger = asyncio.Future(loop=loop)
+        self.trigger = Trigger(loop)
+        # Items waiting to be forwarded to this node, see
+        # :meth:`.Envelope.hold_item`.
+        self.pending = None
+        # Highest item index acknowledged by the node, and index up to which
+        # items are skipped when an envelope is recovered after a crash.
+        self.acked = -1
+        self.skip_until = -1
 
     @asyncio.coroutine
     def wait_trigger(self, index=0) -> bool:
@@ -49,7 +62,7 @@ class Node(object):
         """
 
         while self.recv < index:
-            trigger_res = yield from self.trigger
+            trigger_res = yield from self.trigger.wait()
             if trigger_res is False:
                 return False
         return True
@@ -60,18 +73,18 @@ class Node(object):
         """
 
         self.recv += 1
-        if self.trigger._callbacks:
-            self.trigger.set_result(True)
-            self.trigger = asyncio.Future(loop=self.loop)
+        self.trigger.fire()
 
     def cancel_trigger(self):
         """Cause all pending :meth:`wait_trigger` coroutines to return False.
         """
-        self.trigger.set_result(False)
+        self.trigger.cancel()
 
 
 class WorkerNode(Node):
 
+    __slots__ = ('role_id', 'recipient', 'children')
+
     def __init__(
         self, envelope_id: str, event_id: str, node_id: str, role_id: str,
         recipient: Recipient, children, loop=None
@@ -111,6 +124,8 @@ class WorkerNode(Node):
 
 class ConsumerNode(Node):
 
+    __slots__ = ('role_ids', 'recipients')
+
     def __init__(
         self, envelope_id: str, event_id: str, node_id: str, role_ids: list,
         recipients: list, loop=None
@@ -0,0 +1,194 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+from collections import Counter
+from collections import deque
+from collections import namedtuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# A node of a routing plan. The roles and recipients of a consumer node are
+# all of its active consumers; those of a worker node are left empty, one of
+# the active workers of its service being taken for each event.
+PlanNode = namedtuple('PlanNode', (
+    'node_id', 'service_id', 'is_start', 'is_consumer', 'role_ids',
+    'recipients', 'children', 'child_indices', 'inactive_roles',
+))
+
+
+class RoutingPlan(object):
+    """A RoutingPlan is the graph of an event type compiled against the
+    recipients which are active when it is built, so that starting an event
+    only creates its nodes instead of walking the database rows again.
+
+    The nodes are sorted topologically: parents come before their children.
+    A plan is never modified once built; the backend builds a new one when
+    the topology or the active consumers change (see
+    :meth:`XbusBrokerBack.get_plan`).
+    """
+
+    def __init__(
+        self, type_id: str, rows: list, active_roles: dict,
+        recipients: dict, consumers: dict
+    ):
+        """
+        :param type_id:
+         the UUID of the event type
+
+        :param rows:
+         the nodes of the graph of the event type, as returned by
+         :meth:`XbusBrokerBack.get_event_tree`
+
+        :param active_roles:
+         the active roles of each service: {service ID: set(role ID)}; only
+         those of the consumers are used
+
+        :param recipients:
+         the registered recipients: {role ID: Recipient instance}
+
+        :param consumers:
+         the consumer roles of each service: {service ID: set(role ID)}
+        """
+        self.type_id = type_id
+        rows = self.sort_rows(rows)
+        self.index = {row[0]: position for position, row in enumerate(rows)}
+
+        nodes = []
+        for node_id, service_id, is_start, child_ids in rows:
+            # Children which are not part of the graph are ignored.
+            children = tuple(
+                child for child in child_ids if child in self.index
+            )
+            role_ids = ()
+            inactive = frozenset()
+            if not child_ids:
+                role_ids = tuple(sorted(active_roles.get(service_id, ())))
+                inactive = frozenset(
+                    consumers.get(service_id, set()).difference(role_ids)
+                )
+            nodes.append(PlanNode(
+                node_id, service_id, bool(is_start), not child_ids, role_ids,
+                tuple(recipients[role_id] for role_id in role_ids),
+                children, tuple(self.index[child] for child in children),
+                inactive,
+            ))
+        self.nodes = tuple(nodes)
+        self.start = tuple(
+            position for position, node in enumerate(self.nodes)
+            if node.is_start
+        )
+
+    @staticmethod
+    def sort_rows(rows: list) -> list:
+        """Sort the nodes of a graph so that parents come before their
+        children, keeping the original order otherwise.
+
+        :param rows:
+         the nodes, as 4-tuples (id, service_id, is_start, [child_id, ...])
+        """
+        known = set(row[0] for row in rows)
+        parents = {row[0]: 0 for row in rows}
+        for row in rows:
+            for child_id in set(row[3]) & known:
+                parents[child_id] += 1
+
+        by_id = {row[0]: row for row in rows}
+        todo = deque(row[0] for row in rows if not parents[row[0]])
+        res = []
+        while todo:
+            row = by_id[todo.popleft()]
+            res.append(row)
+            for child_id in row[3]:
+                if child_id in parents:
+                    parents[child_id] -= 1
+                    if not parents[child_id]:
+                        todo.append(child_id)
+
+        if len(res) < len(rows):
+            logger.warning('The graph of an event type has a cycle')
+            sorted_ids = set(row[0] for row in res)
+            res.extend(row for row in rows if row[0] not in sorted_ids)
+        return res
+
+    def kept(self, targets: list) -> list:
+        """Find the nodes that are either targets or ancestors of a target.
+
+        :param targets:
+         the UUIDs of the nodes that must be reached
+
+        :return:
+         a list telling whether each node of the plan is kept
+        """
+        kept = [False] * len(self.nodes)
+        for target in targets:
+            position = self.index.get(target)
+            if position is not None:
+                kept[position] = True
+        # Children come after their parents: walk the nodes backwards.
+        for position in range(len(self.nodes) - 1, -1, -1):
+            if not kept[position]:
+                kept[position] = any(
+                    kept[child]
+                    for child in self.nodes[position].child_indices
+                )
+        return kept
+
+    def instantiate(
+        self, event, active_roles: dict, recipients: dict, targets: list=None
+    ) -> bool:
+        """Create the nodes of an event following the plan.
+
+        Each worker node takes one of the active workers of its service out
+        of `active_roles`, so that a worker handles one event at a time; it
+        becomes active again when it calls :meth:`XbusBrokerBack.ready`.
+
+        :param event:
+         the :class:`.Event` instance
+
+        :param active_roles:
+         the active roles of each service: {service ID: set(role ID)}
+
+        :param recipients:
+         the registered recipients: {role ID: Recipient instance}
+
+        :param targets:
+         the UUIDs of the nodes the event must reach; all of them if empty
+
+        :return:
+         False if a worker node of the event has no active worker, in which
+         case no node is created and no worker is taken; True otherwise
+        """
+        kept = self.kept(targets) if targets else None
+        nodes = [
+            node for position, node in enumerate(self.nodes)
+            if kept is None or kept[position]
+        ]
+        needed = Counter(
+            node.service_id for node in nodes if not node.is_consumer
+        )
+        for service_id, count in needed.items():
+            if len(active_roles.get(service_id, ())) < count:
+                return False
+
+        for node in nodes:
+            if node.is_consumer:
+                event.new_consumer(
+                    node.node_id, list(node.role_ids), list(node.recipients),
+                    node.is_start
+                )
+                continue
+
+            children = node.children
+            if kept is not None:
+                children = tuple(
+                    child for child, position in zip(
+                        node.children, node.child_indices
+                    ) if kept[position]
+                )
+            role_id = active_roles[node.service_id].pop()
+            event.new_worker(
+                node.node_id, role_id, recipients[role_id], children,
+                node.is_start
+            )
+        return True
@@ -1,26 +1,113 @@
+import logging
+import socket
+
 import aiozmq
 
+from xbus.broker.core.back.shm import DEFAULT_SHM_DIR
+from xbus.broker.core.back.shm import ShmRing
 from xbus.broker.core.features import RecipientFeature
+from xbus.broker.core.transport import SocketTuning
+
+logger = logging.getLogger(__name__)
 
 
 class Recipient(object):
     """Information about an Xbus recipient (a worker or a consumer):
     - its metadata;
     - the features it supports;
-    - a socket.
+    - a socket;
+    - a second socket dedicated to immediate reply events, if the recipient
+      supports them, so that they do not queue behind bulk calls;
+    - a shared memory ring the data of the items is passed through, if the
+      recipient runs on the same host and supports the "shared_memory"
+      feature (see :class:`.ShmRing`).
     """
 
-    def connect(self, url):
+    fast_socket = None
+    ring = None
+
+    def connect(
+        self, url, shm_size: int=0, shm_dir: str=DEFAULT_SHM_DIR,
+        tuning: SocketTuning=None
+    ):
         """Initialize the recipient information holder. Open a socket to the
         specified URL and use it to fetch metadata and supported features.
 
         :param url: URL to reach the recipient.
+
+        :param shm_size: Size of the shared memory ring offered to the
+        recipient, in bytes; 0 disables shared memory.
+
+        :param shm_dir: Where the shared memory ring is created.
+
+        :param tuning: The :class:`.SocketTuning` of the sockets; the
+        recipient is reached through its "ipc_uri" when it runs on the same
+        host, if it announces one.
         """
+        if tuning is None:
+            tuning = SocketTuning()
 
-        self.socket = yield from aiozmq.rpc.connect_rpc(connect=url)
+        self.socket = yield from tuning.connect_rpc(url)
         self.metadata = yield from self.socket.call.get_metadata()
+
+        endpoint = tuning.endpoint_for(url, self.metadata)
+        if endpoint != url:
+            self.socket.close()
+            self.socket = yield from tuning.connect_rpc(endpoint)
         yield from self.update_features()
 
+        if self.has_feature(RecipientFeature.immediate_reply):
+            self.fast_socket = yield from tuning.connect_rpc(endpoint)
+
+        if (
+            shm_size and
+            self.has_feature(RecipientFeature.shared_memory) and
+            self.metadata.get('host') == socket.gethostname()
+        ):
+            yield from self.attach_shared_memory(shm_size, shm_dir)
+
+    def attach_shared_memory(self, size: int, directory: str):
+        """Create a shared memory ring and give it to the recipient, which
+        opens it during its "attach_shared_memory" call. The file of the
+        ring is then removed, so that it disappears with both processes.
+        """
+        try:
+            ring = ShmRing(size, directory)
+        except OSError:
+            logger.exception('Could not create a shared memory ring')
+            return
+        try:
+            attached = yield from self.socket.call.attach_shared_memory(
+                ring.path, ring.size
+            )
+        except Exception:
+            logger.exception('Could not attach a shared memory ring')
+            attached = False
+        if attached is True:
+            ring.unlink()
+            self.ring = ring
+        else:
+            ring.close()
+
+    def close(self):
+        """Release the shared memory ring of a recipient which is being
+        replaced. The ring is only unmapped once the calls in progress
+        through it have finished; the nodes which still use this recipient
+        send their next items through its socket.
+        """
+        if self.ring is not None:
+            self.ring.retire()
+            self.ring = None
+
+    def socket_for(self, event):
+        """Choose the socket used to forward an event.
+
+        :param event: the event object
+        """
+        if event.immediate_reply and self.fast_socket is not None:
+            return self.fast_socket
+        return self.socket
+
     def has_feature(self, feature: RecipientFeature):
         """Tell whether the recipient has declared support for the specified
         feature.
@@ -39,10 +126,14 @@ class Recipient(object):
         for feature in RecipientFeature:
 
             # Send a "has_[feature]" API call to see what the recipient has to
-            # announce about its support for the feature.
-            feature_data = yield from getattr(
-                self.socket.call, 'has_%s' % feature.name
-            )()
+            # announce about its support for the feature. Recipients written
+            # before the feature existed do not know the call.
+            try:
+                feature_data = yield from getattr(
+                    self.socket.call, 'has_%s' % feature.name
+                )()
+            except aiozmq.rpc.NotFoundError:
+                continue
 
             # Ensure we have received valid data.
             if not feature_data or not isinstance(feature_data, (list, tuple)):
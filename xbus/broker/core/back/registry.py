@@ -0,0 +1,144 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+from collections import OrderedDict
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class EnvelopeRegistry(object):
+    """The envelopes in progress in the backend.
+
+    An envelope is registered when it is opened, and removes itself once
+    its :meth:`.Envelope.end_envelope` or :meth:`.Envelope.stop_envelope`
+    coroutine has finished. Envelopes left idle for `idle_timeout` seconds,
+    ie: which the front has not mentioned and which have had no call to
+    their recipients in progress, are stopped and removed, so that the
+    envelopes the front forgot about do not pile up.
+
+    The registry can be read like a dict: {envelope ID: Envelope instance}.
+    Looking an envelope up with :meth:`get` records activity on it.
+    """
+
+    def __init__(self, idle_timeout: float=86400, loop=None):
+        """
+        :param idle_timeout:
+         the number of seconds after which idle envelopes are stopped; 0
+         keeps them forever
+
+        :param loop:
+         the event loop used by the backend
+        """
+        self.idle_timeout = idle_timeout
+        self.loop = loop
+        self.task = None
+        # Least recently active first.
+        self.envelopes = OrderedDict()
+        self.evicted = 0
+        # Items held for the nodes of the envelopes, see
+        # :meth:`.Envelope.hold_item`.
+        self.held = 0
+
+    def __len__(self):
+        return len(self.envelopes)
+
+    def __contains__(self, envelope_id):
+        return envelope_id in self.envelopes
+
+    def __getitem__(self, envelope_id):
+        return self.envelopes[envelope_id]
+
+    def __iter__(self):
+        return iter(self.envelopes)
+
+    def items(self):
+        return self.envelopes.items()
+
+    def values(self):
+        return self.envelopes.values()
+
+    def get(self, envelope_id, default=None):
+        """Find an envelope, and record activity on it.
+        """
+        envelope = self.envelopes.get(envelope_id)
+        if envelope is None:
+            return default
+        self.touch(envelope)
+        return envelope
+
+    def add(self, envelope):
+        """Register an envelope, replacing any envelope with the same ID.
+        """
+        envelope.registry = self
+        self.envelopes[envelope.envelope_id] = envelope
+        self.touch(envelope)
+
+    def touch(self, envelope):
+        """Record activity on an envelope.
+        """
+        envelope.touched = self.loop.time()
+        if envelope.envelope_id in self.envelopes:
+            self.envelopes.move_to_end(envelope.envelope_id)
+
+    def discard(self, envelope):
+        """Remove an envelope, unless it has been replaced already.
+        """
+        if self.envelopes.get(envelope.envelope_id) is envelope:
+            del self.envelopes[envelope.envelope_id]
+
+    def evict(self) -> int:
+        """Stop and remove the envelopes which have been idle for
+        `idle_timeout` seconds.
+
+        :return:
+         the number of evicted envelopes
+        """
+        limit = self.loop.time() - self.idle_timeout
+        idle = []
+        busy = []
+        for envelope in self.envelopes.values():
+            if envelope.touched >= limit:
+                break
+            if envelope.client_calls:
+                busy.append(envelope)
+            else:
+                idle.append(envelope)
+
+        for envelope in busy:
+            self.touch(envelope)
+        for envelope in idle:
+            logger.warning(
+                'Stopping envelope %s, idle for %d seconds',
+                envelope.envelope_id, self.loop.time() - envelope.touched
+            )
+            self.discard(envelope)
+            asyncio.async(envelope.stop_envelope(), loop=self.loop)
+        self.evicted += len(idle)
+        return len(idle)
+
+    def start(self):
+        """Start evicting the idle envelopes in the background.
+        """
+        if self.task is None and self.idle_timeout:
+            self.task = asyncio.async(self.watch(), loop=self.loop)
+
+    def stop(self):
+        """Stop evicting the idle envelopes.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    @asyncio.coroutine
+    def watch(self):
+        """Internal helper method used to evict the idle envelopes every
+        tenth of `idle_timeout` until cancelled.
+        """
+        while True:
+            yield from asyncio.sleep(self.idle_timeout / 10, loop=self.loop)
+            try:
+                self.evict()
+            except Exception:
+                logger.exception('Could not evict the idle envelopes')
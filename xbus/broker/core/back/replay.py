@@ -0,0 +1,250 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import logging
+import time
+from uuid import UUID
+from uuid import uuid4
+
+from xbus.broker.model.helpers import get_event_info
+from xbus.broker.model.helpers import open_item_cursor
+from xbus.broker.model.helpers import fetch_item_cursor
+from xbus.broker.model.helpers import close_item_cursor
+
+logger = logging.getLogger(__name__)
+
+
+@asyncio.coroutine
+def dispatch_stored_items(
+    broker, envelope, event, start: int=0, batch_size: int=500,
+    on_batch=None
+) -> int:
+    """Read the items of an event from the database, in index order, and
+    forward them to the start nodes of the event. Their positions in the
+    event start from 0 whatever the index of the first item.
+
+    :param broker:
+     the :class:`.XbusBrokerBack` instance
+
+    :param envelope:
+     the envelope object
+
+    :param event:
+     the event object
+
+    :param start:
+     the index of the first item to forward
+
+    :param batch_size:
+     the number of items read from the database at once
+
+    :param on_batch:
+     an optional coroutine function called after each batch with the
+     number of items forwarded so far
+
+    :return:
+     the number of items forwarded
+    """
+    # Cursors are local to the connection, a fixed name is enough.
+    cursor_name = 'xbus_items'
+    sent = 0
+    with (yield from broker.dbengine) as conn:
+        tr = yield from conn.begin()
+        try:
+            yield from open_item_cursor(
+                conn, cursor_name, event.event_id, start
+            )
+            while not envelope.stopped:
+                items = yield from fetch_item_cursor(
+                    conn, cursor_name, batch_size, loop=broker.loop
+                )
+                if not items:
+                    break
+                for index, data in items:
+                    broker.dispatch_item(envelope, event, [index], data, sent)
+                    sent += 1
+                if on_batch is not None:
+                    yield from on_batch(sent)
+            yield from close_item_cursor(conn, cursor_name)
+
+        except Exception:
+            yield from tr.rollback()
+            raise
+
+        else:
+            yield from tr.commit()
+    return sent
+
+
+class EventReplay(object):
+    """An EventReplay re-emits the stored items of an event through the
+    branches of its graph that lead to a given set of consumers, typically
+    after a consumer failed and its defect has been corrected.
+
+    The items are streamed from the database in index order, with an
+    optional limit on the number of items per second and on the number of
+    items waiting for the start nodes of the event.
+    """
+
+    def __init__(
+        self, broker, event_id: str, targets: list, rate: float=None,
+        batch_size: int=500, max_pending: int=10000, loop=None
+    ):
+        """Prepare the replay of an event.
+
+        :param broker:
+         the :class:`.XbusBrokerBack` instance the event is replayed on
+
+        :param event_id:
+         the UUID of the event to replay, in any form accepted by
+         :class:`uuid.UUID`
+
+        :param targets:
+         the UUIDs of the consumer nodes the event must reach
+
+        :param rate:
+         the maximum number of items sent per second, or None
+
+        :param batch_size:
+         the number of items read from the database at once
+
+        :param max_pending:
+         the number of items that may wait for the start nodes of the event
+         before the replay pauses
+
+        :param loop:
+         the event loop used by the backend
+        """
+        self.replay_id = uuid4().hex
+        self.broker = broker
+        self.event_id = UUID(event_id).hex
+        self.targets = targets
+        self.rate = rate
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.loop = loop
+
+        self.envelope_id = None
+        self.state = 'pending'
+        self.message = ''
+        self.total = None
+        self.sent = 0
+        self.started = None
+        self.finished = None
+
+    def progress(self) -> dict:
+        """Report the progress of the replay.
+
+        :return:
+         a dict with the state of the replay ('pending', 'running', 'done' or
+         'fail'), the number of items sent and expected, and the throughput
+         in items per second.
+        """
+        elapsed = 0
+        if self.started is not None:
+            elapsed = (self.finished or time.time()) - self.started
+        return {
+            'replay_id': self.replay_id,
+            'event_id': self.event_id,
+            'envelope_id': self.envelope_id,
+            'state': self.state,
+            'message': self.message,
+            'sent': self.sent,
+            'total': self.total,
+            'elapsed': elapsed,
+            'rate': self.sent / elapsed if elapsed else 0,
+        }
+
+    @asyncio.coroutine
+    def run(self) -> bool:
+        """Replay the event.
+
+        :return:
+         True if all the items have been forwarded, False otherwise
+        """
+        self.state = 'running'
+        self.started = time.time()
+        try:
+            res = yield from self._run()
+        except Exception as e:
+            logger.exception('Replay of event %s failed', self.event_id)
+            res = False
+            self.message = str(e)
+        self.finished = time.time()
+        self.state = 'done' if res else 'fail'
+        logger.info(
+            'Replay of event %s: %s (%d/%s items)',
+            self.event_id, self.state, self.sent, self.total
+        )
+        return res
+
+    @asyncio.coroutine
+    def _run(self) -> bool:
+        broker = self.broker
+
+        with (yield from broker.dbengine) as conn:
+            info = yield from get_event_info(conn, self.event_id)
+        if info is None:
+            self.message = 'No such event'
+            return False
+        envelope_id, type_id, type_name, self.total = info.as_tuple()
+        self.envelope_id = envelope_id
+
+        if envelope_id in broker.envelopes:
+            self.message = 'Envelope already in progress'
+            return False
+
+        broker.open_envelope(envelope_id)
+        res = yield from broker.start_event(
+            envelope_id, self.event_id, type_id, type_name,
+            targets=self.targets
+        )
+        if not res or res[0] != 0:
+            self.message = res[1] if res else 'No available worker'
+            yield from broker.cancel_envelope(envelope_id)
+            return False
+
+        envelope = broker.envelopes[envelope_id]
+        event = envelope[self.event_id]
+
+        @asyncio.coroutine
+        def on_batch(sent):
+            self.sent = sent
+            yield from self.throttle(event)
+
+        yield from dispatch_stored_items(
+            broker, envelope, event, batch_size=self.batch_size,
+            on_batch=on_batch
+        )
+
+        if envelope.stopped:
+            self.message = 'Envelope stopped'
+            return False
+
+        res = yield from broker.end_event(
+            envelope_id, self.event_id, self.sent, False
+        )
+        if not res.get('success'):
+            self.message = res.get('error_message', '')
+            return False
+        yield from broker.end_envelope(envelope_id)
+        return True
+
+    @asyncio.coroutine
+    def throttle(self, event):
+        """Internal helper method used to wait until the start nodes of the
+        event have caught up, and until the sending rate is respected.
+        """
+        if self.max_pending:
+            for node in event.start:
+                res = yield from node.wait_trigger(
+                    self.sent - self.max_pending
+                )
+                if res is False:
+                    return
+
+        if self.rate:
+            delay = self.started + self.sent / self.rate - time.time()
+            if delay > 0:
+                yield from asyncio.sleep(delay, loop=self.loop)
@@ -2,8 +2,9 @@
 __author__ = 'jgavrel'
 
 import asyncio
+import functools
 import json
-import aiozmq
+import time
 from aiozmq import rpc
 from collections import defaultdict
 
@@ -14,10 +15,31 @@ from xbus.broker.model import validate_password
 from xbus.broker.model.helpers import get_event_tree
 from xbus.broker.model.helpers import get_consumer_roles
 
+from xbus.broker.core.admission import get_admission_controller
 from xbus.broker.core.base import XbusBrokerBase
+from xbus.broker.core.blobstore import BlobRef
+from xbus.broker.core.blobstore import get_blob_store
+from xbus.broker.core.dataplane import DataPlaneReceiver
+from xbus.broker.core.back.cache import ReplyCache
+from xbus.broker.core.back.checkpoint import Checkpointer
 from xbus.broker.core.back.envelope import Envelope
+from xbus.broker.core.back.plan import RoutingPlan
+from xbus.broker.core.back.registry import EnvelopeRegistry
 from xbus.broker.core.back.recipient import Recipient
+from xbus.broker.core.back.replay import EventReplay
+from xbus.broker.core.back.shm import DEFAULT_SHM_DIR
+from xbus.broker.core.back.spill import DEFAULT_SPILL_THRESHOLD
 from xbus.broker.core.features import RecipientFeature
+from xbus.broker.core.metrics import LatencyHistogram
+from xbus.broker.core.metrics import REGISTRY
+from xbus.broker.core.scheduler import PriorityLimiter
+from xbus.broker.core.tracing import setup_tracing
+from xbus.broker.core.tracing import traced
+from xbus.broker.core.transport import get_socket_tuning
+
+queued_items = REGISTRY.gauge(
+    'xbus_items_queued', 'Items waiting to be sent to the recipients',
+)
 
 
 class BrokerBackError(Exception):
@@ -37,6 +59,8 @@ class XbusBrokerBack(XbusBrokerBase):
     invalidate the token and make sure no one can reuse it ever.
     """
 
+    component = 'back'
+
     def __init__(self, dbengine, frontsocket, socket, loop=None):
         super(XbusBrokerBack, self).__init__(dbengine, loop=loop)
 
@@ -51,7 +75,52 @@ class XbusBrokerBack(XbusBrokerBase):
         # {role ID: Recipient instance}
         self.recipients = {}
 
-        self.envelopes = {}
+        # The envelopes in progress, see :class:`.EnvelopeRegistry`.
+        self.envelopes = EnvelopeRegistry(loop=loop)
+
+        # The graphs of the event types compiled against the active roles,
+        # see :meth:`get_plan`; bumping the generation discards them.
+        # {type ID: RoutingPlan instance}
+        self.plans = {}
+        self.plan_generation = 0
+
+        # Items waiting for a node are spilled to disk past this amount of
+        # bytes, see :class:`.SpillQueue`.
+        self.spill_threshold = DEFAULT_SPILL_THRESHOLD
+        self.spill_dir = None
+
+        # Replays of failed branches, see :meth:`replay_event`, and how long
+        # in seconds the finished ones are kept for their progress to be
+        # read. {replay ID: EventReplay instance}
+        self.replays = {}
+        self.replay_ttl = 3600
+
+        # Items in flight towards the recipients, immediate reply events
+        # first, and the time taken to reply to immediate reply events.
+        self.limiter = PriorityLimiter(loop=loop)
+        self.reply_latency = LatencyHistogram()
+
+        # Replies to immediate reply events, see :class:`.ReplyCache`.
+        self.reply_cache = ReplyCache(self, loop=loop)
+
+        # Refuses new envelopes while the backend is overloaded, see
+        # :class:`.AdmissionController`; set up by get_backserver.
+        self.admission = None
+
+        # Holds the data of the claim checked items, see :class:`.BlobStore`;
+        # set up by get_backserver.
+        self.blobs = None
+
+        # Receives the items streamed by the front, see
+        # :class:`.DataPlaneReceiver`, and the URI it is bound to; set up by
+        # get_backserver.
+        self.data_plane = None
+        self.data_uri = None
+
+        # Size of the shared memory rings offered to the recipients running
+        # on the same host, 0 to disable them, and where they are created.
+        self.shm_size = 0
+        self.shm_dir = DEFAULT_SHM_DIR
 
     @asyncio.coroutine
     def register_on_front(self):
@@ -67,8 +136,13 @@ class XbusBrokerBack(XbusBrokerBase):
          :class:`BrokerBackError`
         """
         yield from self.init_consumers()
-        client = yield from aiozmq.rpc.connect_rpc(connect=self.frontsocket)
-        result = yield from client.call.register_backend(self.socket)
+        client = yield from self.tuning.connect_rpc(self.frontsocket)
+        if self.data_uri:
+            result = yield from client.call.register_backend(
+                self.socket, self.data_uri
+            )
+        else:
+            result = yield from client.call.register_backend(self.socket)
         if result is None:
             # yeeeks we got an error here ...
             # let's do something stupid and b0rk out
@@ -134,6 +208,7 @@ class XbusBrokerBack(XbusBrokerBase):
                 self.recipients.pop(role_id)
             except KeyError:
                 pass
+            self.invalidate_plans()
             res = yield from self.destroy_key(token)
         return res
 
@@ -175,8 +250,14 @@ class XbusBrokerBack(XbusBrokerBase):
 
         # Fill recipient information.
         recipient = Recipient()
-        yield from recipient.connect(uri)
+        yield from recipient.connect(
+            uri, self.shm_size, self.shm_dir, self.tuning
+        )
+        previous = self.recipients.get(role_id)
+        if previous is not None:
+            previous.close()
         self.recipients[role_id] = recipient
+        self.invalidate_plans()
 
         # Mark the node as active.
         res = yield from self.ready(token)
@@ -211,12 +292,19 @@ class XbusBrokerBack(XbusBrokerBase):
 
             # Add the role to the list of active roles of the service.
             service_roles = self.active_roles[service_id]
-            service_roles.add(role_id)
+            if role_id not in service_roles:
+                service_roles.add(role_id)
+                if role_id in self.consumers.get(service_id, ()):
+                    # Only the consumers are compiled into the routing plans.
+                    self.invalidate_plans()
             return True
 
     @rpc.method
+    @traced('start_envelope')
     @asyncio.coroutine
-    def start_envelope(self, envelope_id: str) -> str:
+    def start_envelope(
+            self, envelope_id: str, *, tenant=None, weight: float=1
+    ) -> str:
         """Start a new envelop giving its envelop UUID.
         This is just a way to register the envelop existance with the broker
         backend. This permits to cancel this envelop further down the road.
@@ -225,19 +313,48 @@ class XbusBrokerBack(XbusBrokerBase):
          the UUID of the envelop you want to start
          expressed as a string
 
+        :param tenant:
+         the emitter profile or emitter the envelope comes from; the items
+         of the envelopes of different tenants are sent to the recipients
+         in turn (see :class:`.DeficitRoundRobin`)
+
+        :param weight:
+         the share of the tenant, relative to the other tenants
+
         :return:
          the envelop id you just started
+
+        :raises OverloadedError:
+         if the backend is overloaded
         """
-        self.envelopes[envelope_id] = Envelope(
-            envelope_id, self.dbengine, self.loop
-        )
+        if self.admission is not None:
+            self.admission.check()
+        return self.open_envelope(envelope_id, tenant=tenant, weight=weight)
+
+    def open_envelope(
+            self, envelope_id: str, *, tenant=None, weight: float=1
+    ) -> str:
+        """Internal helper method used to register an envelope, whatever
+        the load of the backend (ie: when recovering or replaying an envelope
+        which was already accepted). See :meth:`start_envelope`.
+        """
+        envelope = Envelope(envelope_id, self.dbengine, self.loop)
+        envelope.spill_threshold = self.spill_threshold
+        envelope.spill_dir = self.spill_dir
+        envelope.limiter = self.limiter
+        envelope.tenant = tenant
+        envelope.weight = weight
+        envelope.blobs = self.blobs
+        self.envelopes.add(envelope)
         return envelope_id
 
     @rpc.method
+    @traced('start_event')
     @asyncio.coroutine
     def start_event(
             self, envelope_id: str, event_id: str, type_id: str,
-            type_name: str, *, targets: list=None
+            type_name: str, *, targets: list=None,
+            immediate_reply: bool=False
     ) -> tuple:
         """Begin a new event inside an envelope opened against this broker
         backend.
@@ -274,6 +391,13 @@ class XbusBrokerBack(XbusBrokerBase):
          This will re-emit the event through a subset of the network composed
          of the branches that lead to "not properly finished" consumers.
 
+        :param immediate_reply:
+         whether the emitter waits for a reply to this event, in which case
+         the event is served ahead of bulk events and through the dedicated
+         sockets of its recipients. When the type of the event has a
+         `reply_cache_ttl`, the event is held back until its end and its
+         reply may be served from the :class:`.ReplyCache`.
+
         :return:
          a 2 tuple with the success code and a message:
 
@@ -294,40 +418,24 @@ class XbusBrokerBack(XbusBrokerBase):
             return res
 
         event = envelope.new_event(event_id, type_name, type_id)
-        rows = yield from self.get_event_tree(type_id)
-        nodes = {}
-
-        for row in rows:
-            node_id, service_id, is_start, child_ids = row.as_tuple()
-            service_roles = self.active_roles[service_id]
-
-            if child_ids:  # Workers
-                if not service_roles:
-                    return False
-                role_id = service_roles.pop()
-                recipient = self.recipients[role_id]
-                event.new_worker(
-                    node_id, role_id, recipient, child_ids, is_start
-                )
-
-            else:  # Consumers
-                role_ids = list(service_roles)
-                recipients = [self.recipients[role] for role in service_roles]
-                event.new_consumer(node_id, role_ids, recipients, is_start)
-                consumers = self.consumers[service_id]
-                inactive_consumers = consumers - service_roles
-                # TODO do something with these...
+        event.immediate_reply = immediate_reply
+        if immediate_reply and not targets:
+            cache_ttl = yield from self.reply_cache.ttl_for(type_id)
+            if cache_ttl:
+                event.defer(cache_ttl)
+        plan = yield from self.get_plan(type_id)
+        if not plan.instantiate(
+            event, self.active_roles, self.recipients, targets
+        ):
+            return False
 
-        for node in event.start:
-            if node.is_consumer():
-                coro = envelope.consumer_start_event
-            else:
-                coro = envelope.worker_start_event
-            asyncio.async(coro(node, event), loop=self.loop)
+        if event.deferred is None:
+            self.start_nodes(envelope, event)
         res = (0, "{}".format(event_id))
         return res
 
     @rpc.method
+    @traced('send_item')
     @asyncio.coroutine
     def send_item(
             self, envelope_id: str, event_id: str, index: int, data: bytes
@@ -361,19 +469,102 @@ class XbusBrokerBack(XbusBrokerBase):
             res = (1, 'No such event')
             return res
 
-        for node in event.start:
-            if node.is_consumer():
-                coro = envelope.consumer_send_item
-            else:
-                coro = envelope.worker_send_item
-            asyncio.async(
-                coro(node, event, [index], data, index), loop=self.loop
-            )
+        self.dispatch_item(envelope, event, [index], data, index)
 
         res = (0, "{}".format(event_id))
         return res
 
     @rpc.method
+    @traced('send_item_blob')
+    @asyncio.coroutine
+    def send_item_blob(
+            self, envelope_id: str, event_id: str, index: int, handle: str,
+            size: int
+    ) -> tuple:
+        """Send an item whose data has been written to the blob store by
+        the front (see :class:`.BlobStore`). Only the handle of the data is
+        forwarded to the recipients which support the "claim_check"
+        feature; the others get the data itself.
+
+        :param handle:
+         the handle of the blob
+
+        :param size:
+         the size of the item data
+
+        :return:
+         a 2 tuple with the success code and a message, like
+         :meth:`send_item`
+        """
+        if self.blobs is None or not self.blobs.exists(handle):
+            res = (1, 'No such blob')
+            return res
+
+        res = yield from self.send_item(
+            envelope_id, event_id, index, BlobRef(handle, size)
+        )
+        return res
+
+    @rpc.method
+    @asyncio.coroutine
+    def fetch_blob(self, handle: str) -> bytes:
+        """Read the data of a claim checked item, for the recipients which
+        support the "claim_check" feature.
+
+        :param handle:
+         the handle given to the send_item_blob method of the recipient
+
+        :return:
+         the item data
+
+        :raises KeyError:
+         if there is no such blob
+        """
+        if self.blobs is None:
+            raise KeyError('No such blob')
+        try:
+            data = yield from self.blobs.get(handle)
+        except (OSError, ValueError):
+            raise KeyError('No such blob')
+        return data
+
+    @rpc.method
+    @traced('send_items')
+    @asyncio.coroutine
+    def send_items(
+            self, envelope_id: str, event_id: str, items: list
+    ) -> tuple:
+        """Send a batch of items to the XBUS network. This is equivalent to
+        calling :meth:`send_item` for each item, in a single round trip.
+
+        :param event_id:
+         event UUID previously opened onto which these items will be sent
+
+        :param items:
+         a list of (index, data) 2-tuples, ordered by index.
+
+        :return:
+         a 2 tuple with the success code and a message, like
+         :meth:`send_item`
+        """
+        envelope = self.envelopes.get(envelope_id)
+        if not envelope:
+            res = (1, 'No such envelope')
+            return res
+
+        event = envelope.events.get(event_id)
+        if not event:
+            res = (1, 'No such event')
+            return res
+
+        for index, data in items:
+            self.dispatch_item(envelope, event, [index], data, index)
+
+        res = (0, "{}".format(event_id))
+        return res
+
+    @rpc.method
+    @traced('end_event')
     @asyncio.coroutine
     def end_event(
         self, envelope_id: str, event_id: str, nb_items: int,
@@ -386,6 +577,9 @@ class XbusBrokerBack(XbusBrokerBase):
 
         :param immediate_reply: Whether an immediate reply is expected; refer
         to the "Immediate reply" section of the Xbus documentation for details.
+        Identical immediate reply events of a type with a `reply_cache_ttl`
+        are answered from the :class:`.ReplyCache`, or coalesced with the one
+        in progress.
 
         :return: Dictionary.
 
@@ -412,18 +606,11 @@ class XbusBrokerBack(XbusBrokerBase):
                 'success': False,
             }
 
-        reply_data = None
-
-        for node in event.start:
-            if node.is_consumer():
-                coro = envelope.consumer_end_event
-            else:
-                coro = envelope.worker_end_event
-
-            # When issuing a request with an "immediate reply", ensure:
-            # - That there is only 1 consumer.
-            # - That the recipient supports the feature.
-            if immediate_reply:
+        # When issuing a request with an "immediate reply", ensure:
+        # - That there is only 1 consumer.
+        # - That the recipient supports the feature.
+        if immediate_reply:
+            for node in event.start:
                 recipients = node.recipients
 
                 if len(recipients) > 1:
@@ -451,13 +638,24 @@ class XbusBrokerBack(XbusBrokerBase):
                         'success': False,
                     }
 
-            reply_data_future = asyncio.async(
-                coro(node, event, nb_items, immediate_reply),
-                loop=self.loop,
+        if event.deferred is not None:
+            success, reply_data, event.cached = yield from (
+                self.reply_cache.fetch(
+                    event.digest.hexdigest(), event.cache_ttl,
+                    functools.partial(
+                        self.run_deferred_event, envelope, event, nb_items
+                    ),
+                )
+            )
+            if event.cached:
+                event.forget_nodes()
+        else:
+            success, reply_data = yield from self.end_nodes(
+                envelope, event, nb_items, immediate_reply
             )
 
-            if immediate_reply:
-                success, reply_data = yield from reply_data_future
+        if immediate_reply:
+            self.reply_latency.observe(time.monotonic() - event.started)
 
         ret = {'success': True}
         if immediate_reply:
@@ -468,6 +666,7 @@ class XbusBrokerBack(XbusBrokerBase):
         return ret
 
     @rpc.method
+    @traced('end_envelope')
     @asyncio.coroutine
     def end_envelope(self, envelope_id: str) -> dict:
         """End an envelope normally.
@@ -485,8 +684,9 @@ class XbusBrokerBack(XbusBrokerBase):
             res = (1, 'No such envelope')
             return res
 
+        # The envelope is kept until its consumers have finished, so that its
+        # progress keeps being checkpointed; it then leaves the registry.
         asyncio.async(envelope.end_envelope(), loop=self.loop)
-        del self.envelopes[envelope]
         return {
             'success': True,
             'envelope_id': envelope_id,
@@ -494,6 +694,7 @@ class XbusBrokerBack(XbusBrokerBase):
         }
 
     @rpc.method
+    @traced('cancel_envelope')
     @asyncio.coroutine
     def cancel_envelope(self, envelope_id: str) -> str:
         """This is used to cancel a previously started envelop and make sure
@@ -511,10 +712,284 @@ class XbusBrokerBack(XbusBrokerBase):
             res = (1, 'No such envelope')
             return res
 
+        # The envelope leaves the registry once stopped.
         asyncio.async(envelope.stop_envelope(cancelled=True), loop=self.loop)
-        del self.envelopes[envelope]
         return envelope_id
 
+    @rpc.method
+    @asyncio.coroutine
+    def process_envelopes(self, envelopes: list) -> list:
+        """Process a batch of complete envelopes, each holding a single
+        event. This is equivalent to calling :meth:`start_envelope`,
+        :meth:`start_event`, :meth:`send_items`, :meth:`end_event` and
+        :meth:`end_envelope` for each envelope, in a single round trip.
+
+        :param envelopes:
+         a list of (envelope ID, event ID, type ID, type name, items) tuples,
+         where items is the list of the data of the items of the event
+
+        :return:
+         a list of booleans telling, for each envelope, whether it has been
+         accepted. Refused envelopes have been cancelled.
+
+        :raises OverloadedError:
+         if the backend is overloaded; none of the envelopes was processed
+        """
+        if self.admission is not None:
+            self.admission.check()
+
+        results = []
+        for envelope_id, event_id, type_id, type_name, items in envelopes:
+            success, reply_data = yield from self.run_envelope(
+                envelope_id, [(event_id, type_id, type_name, items, False)]
+            )
+            results.append(success)
+        return results
+
+    @rpc.method
+    @traced('process_envelope')
+    @asyncio.coroutine
+    def process_envelope(
+            self, envelope_id: str, events: list, *, tenant=None,
+            weight: float=1
+    ) -> dict:
+        """Process a complete envelope in a single round trip. This is
+        equivalent to calling :meth:`start_envelope`, :meth:`start_event`,
+        :meth:`send_items` and :meth:`end_event` for each event, and
+        :meth:`end_envelope`.
+
+        :param envelope_id:
+         the UUID of the envelope
+
+        :param events:
+         a list of (event ID, type ID, type name, items, immediate reply)
+         tuples, where items is the list of the data of the items of the
+         event
+
+        :param tenant:
+         the tenant of the envelope, see :meth:`start_envelope`
+
+        :param weight:
+         the share of the tenant, relative to the other tenants
+
+        :return:
+         a dict like the one returned by :meth:`end_event`: the envelope
+         has been cancelled if 'success' is False, and 'reply_data' holds the
+         data sent back by the consumer of an event expecting an immediate
+         reply
+
+        :raises OverloadedError:
+         if the backend is overloaded
+        """
+        if self.admission is not None:
+            self.admission.check()
+
+        success, reply_data = yield from self.run_envelope(
+            envelope_id, events, tenant=tenant, weight=weight
+        )
+        return {'success': success, 'reply_data': reply_data}
+
+    @asyncio.coroutine
+    def run_envelope(
+            self, envelope_id: str, events: list, *, tenant=None,
+            weight: float=1
+    ) -> tuple:
+        """Internal helper method used to process a complete envelope.
+
+        :param envelope_id:
+         the UUID of the envelope
+
+        :param events:
+         a list of (event ID, type ID, type name, items, immediate reply)
+         tuples
+
+        :param tenant:
+         the tenant of the envelope, see :meth:`start_envelope`
+
+        :param weight:
+         the share of the tenant, relative to the other tenants
+
+        :return:
+         a 2-tuple with a success boolean and the immediate reply data
+        """
+        self.open_envelope(envelope_id, tenant=tenant, weight=weight)
+        envelope = self.envelopes[envelope_id]
+
+        for event_id, type_id, type_name, items, immediate_reply in events:
+            res = yield from self.start_event(
+                envelope_id, event_id, type_id, type_name,
+                immediate_reply=immediate_reply
+            )
+            if not res or res[0] != 0:
+                yield from self.cancel_envelope(envelope_id)
+                return False, None
+
+            event = envelope[event_id]
+            for index, data in enumerate(items):
+                self.dispatch_item(envelope, event, [index], data, index)
+
+        reply_data = None
+        for event_id, type_id, type_name, items, immediate_reply in events:
+            res = yield from self.end_event(
+                envelope_id, event_id, len(items), immediate_reply
+            )
+            if not res.get('success'):
+                yield from self.cancel_envelope(envelope_id)
+                return False, None
+            if immediate_reply:
+                reply_data = res.get('reply_data')
+
+        res = yield from self.end_envelope(envelope_id)
+        return isinstance(res, dict) and res['success'] is True, reply_data
+
+    @rpc.method
+    def get_envelopes(self) -> dict:
+        """Report the envelopes in progress in the backend.
+
+        :return:
+         a dict with the number of 'live' envelopes, and the number of
+         envelopes 'evicted' since the start of the backend because they
+         were left idle
+        """
+        return {
+            'live': len(self.envelopes),
+            'evicted': self.envelopes.evicted,
+        }
+
+    @rpc.method
+    def get_admission(self) -> dict:
+        """Report the load of the backend, as watched by its admission
+        controller.
+
+        :return:
+         a dict as returned by :meth:`.AdmissionController.snapshot`, empty
+         if admission control is disabled
+        """
+        if self.admission is None:
+            return {}
+        return self.admission.snapshot()
+
+    @asyncio.coroutine
+    def setup_metrics(self, config):
+        """See :meth:`XbusBrokerBase.setup_metrics`; the number of queued
+        items is exposed as well.
+        """
+        yield from super(XbusBrokerBack, self).setup_metrics(config)
+        if REGISTRY.exporter is not None:
+            queued_items.collectors.append(
+                lambda: {(): self.queued_items()}
+            )
+
+    def queued_items(self) -> int:
+        """Count the items waiting to be sent to the workers and consumers.
+        """
+        return self.limiter.waiting + self.envelopes.held
+
+    @rpc.method
+    def clear_reply_cache(self) -> bool:
+        """Forget the replies kept by the :class:`.ReplyCache`, and read
+        the `reply_cache_ttl` of the event types again from the database.
+
+        :return:
+         True
+        """
+        self.reply_cache.clear()
+        return True
+
+    @rpc.method
+    @asyncio.coroutine
+    def reload_topology(self) -> bool:
+        """Read the consumer roles and the graphs of the event types again
+        from the database, once they have been modified.
+
+        :return:
+         True
+        """
+        self.consumers.clear()
+        yield from self.init_consumers()
+        self.invalidate_plans()
+        return True
+
+    @rpc.method
+    def get_reply_latency(self) -> dict:
+        """Report the time taken by the backend to reply to immediate reply
+        events, from their start to the reply of their consumer.
+
+        :return:
+         a dict as returned by :meth:`.LatencyHistogram.snapshot`
+        """
+        return self.reply_latency.snapshot()
+
+    @rpc.method
+    @asyncio.coroutine
+    def replay_event(
+            self, event_id: str, targets: list, *, rate: float=None,
+            batch_size: int=500, max_pending: int=10000
+    ) -> str:
+        """Re-emit a stored event through the branches of its graph that
+        lead to the given consumer nodes only. This is meant to be used once
+        the defect of a failed consumer has been corrected, see the `targets`
+        parameter of :meth:`start_event`.
+
+        The replay runs in the background, its progress can be followed
+        using :meth:`get_replay_progress`.
+
+        :param event_id:
+         the UUID of the event to replay
+
+        :param targets:
+         the list of consumer node ids that must receive the event again
+
+        :param rate:
+         an optional maximum number of items sent per second
+
+        :param batch_size:
+         the number of items read at once from the database
+
+        :param max_pending:
+         the maximum number of items waiting for the start nodes of the
+         event before the replay pauses
+
+        :return:
+         the UUID of the replay
+        """
+        replay = EventReplay(
+            self, event_id, targets, rate=rate, batch_size=batch_size,
+            max_pending=max_pending, loop=self.loop
+        )
+        self.replays[replay.replay_id] = replay
+        task = asyncio.async(replay.run(), loop=self.loop)
+        task.add_done_callback(
+            lambda task: self.loop.call_later(
+                self.replay_ttl, self.replays.pop, replay.replay_id, None
+            )
+        )
+        return replay.replay_id
+
+    @rpc.method
+    @asyncio.coroutine
+    def get_replay_progress(self, replay_id: str) -> dict:
+        """Report the progress of a replay started with
+        :meth:`replay_event`.
+
+        :param replay_id:
+         the UUID returned by :meth:`replay_event`
+
+        :return:
+         a dict describing the progress of the replay (see
+         :meth:`.EventReplay.progress`), or None if the replay is unknown or
+         finished more than `replay_ttl` seconds ago
+        """
+        replay = self.replays.get(replay_id)
+        if replay is None:
+            return None
+
+        res = replay.progress()
+        if replay.finished is not None:
+            # The result has been delivered, forget about the replay.
+            del self.replays[replay_id]
+        return res
+
     @rpc.method
     @asyncio.coroutine
     def get_consumers(self) -> list:
@@ -539,6 +1014,135 @@ class XbusBrokerBack(XbusBrokerBase):
 
         return ret
 
+    def dispatch_item(
+            self, envelope, event, indices: list, data: bytes,
+            forward_index: int
+    ):
+        """Internal helper method used to forward an item to the start nodes
+        of an event.
+
+        :param envelope:
+         the envelope object
+
+        :param event:
+         the event object
+
+        :param indices:
+         the item indices
+
+        :param data:
+         the item data
+
+        :param forward_index:
+         the position of the item in the event
+        """
+        if event.deferred is not None:
+            event.defer_item(indices, data, forward_index)
+            return
+
+        for node in event.start:
+            if node.is_consumer():
+                coro = envelope.consumer_send_item
+            else:
+                coro = envelope.worker_send_item
+            handle = envelope.hold_item(node, data)
+            asyncio.async(
+                coro(node, event, indices, handle, forward_index),
+                loop=self.loop
+            )
+
+    def start_nodes(self, envelope, event):
+        """Internal helper method used to forward the start of an event to
+        its start nodes.
+
+        :param envelope:
+         the envelope object
+
+        :param event:
+         the event object
+        """
+        for node in event.start:
+            if node.is_consumer():
+                coro = envelope.consumer_start_event
+            else:
+                coro = envelope.worker_start_event
+            asyncio.async(coro(node, event), loop=self.loop)
+
+    @asyncio.coroutine
+    def end_nodes(
+        self, envelope, event, nb_items: int, immediate_reply: bool
+    ) -> tuple:
+        """Internal helper method used to forward the end of an event to
+        its start nodes.
+
+        :return: 2-element tuple:
+        - Boolean indicating success (True when succesful).
+        - Data sent back by the consumer, when using the "immediate reply"
+        feature; None otherwise.
+        """
+        success, reply_data = True, None
+        for node in event.start:
+            if node.is_consumer():
+                coro = envelope.consumer_end_event
+            else:
+                coro = envelope.worker_end_event
+
+            reply_data_future = asyncio.async(
+                coro(node, event, nb_items, immediate_reply),
+                loop=self.loop,
+            )
+
+            if immediate_reply:
+                success, reply_data = yield from reply_data_future
+        return success, reply_data
+
+    @asyncio.coroutine
+    def run_deferred_event(self, envelope, event, nb_items: int) -> tuple:
+        """Internal helper method used to forward an event which was held
+        back by :meth:`.Event.defer`, when its reply is not in the cache.
+
+        :return:
+         the reply, as returned by :meth:`end_nodes`
+        """
+        deferred, event.deferred = event.deferred, None
+        self.start_nodes(envelope, event)
+        for indices, data, forward_index in deferred:
+            self.dispatch_item(envelope, event, indices, data, forward_index)
+        res = yield from self.end_nodes(envelope, event, nb_items, True)
+        return res
+
+    @asyncio.coroutine
+    def get_plan(self, type_id: str) -> RoutingPlan:
+        """Internal helper method used to find the :class:`.RoutingPlan` of
+        an event type, compiling it when the topology or the active
+        consumers have changed since it was last used.
+
+        :param type_id:
+         the UUID that corresponds to the type of the event.
+        """
+        plan = self.plans.get(type_id)
+        if plan is not None:
+            return plan
+
+        generation = self.plan_generation
+        rows = yield from self.get_event_tree(type_id)
+        plan = RoutingPlan(
+            type_id, [row.as_tuple() for row in rows], self.active_roles,
+            self.recipients, self.consumers
+        )
+        if generation == self.plan_generation:
+            # Otherwise the plan may be outdated already; it is still good
+            # enough for the event it was compiled for.
+            self.plans[type_id] = plan
+        return plan
+
+    def invalidate_plans(self):
+        """Internal helper method used to discard the routing plans, when
+        the recipients or the topology change.
+        """
+        self.plans.clear()
+        self.plan_generation += 1
+
     @asyncio.coroutine
     def get_event_tree(self, type_id: str) -> list:
         """Internal helper method used to find all nodes and the links
@@ -614,19 +1218,68 @@ def get_backserver(engine_callback, config, socket, b2fsocket, loop=None):
      a future that is waiting for a closed() call before being
      fired back.
     """
+    tuning = get_socket_tuning(config)
     dbengine = yield from engine_callback(config)
     broker_back = XbusBrokerBack(dbengine, b2fsocket, socket, loop=loop)
+    broker_back.tuning = tuning
 
     redis_host = config.get('redis', 'host')
     redis_port = config.getint('redis', 'port')
 
+    broker_back.spill_threshold = config.getint(
+        'spill', 'threshold', fallback=DEFAULT_SPILL_THRESHOLD
+    )
+    broker_back.spill_dir = config.get('spill', 'directory', fallback=None)
+    broker_back.envelopes.idle_timeout = config.getfloat(
+        'envelopes', 'idle_timeout', fallback=86400
+    )
+    broker_back.envelopes.start()
+    broker_back.limiter = PriorityLimiter(
+        limit=config.getint('scheduler', 'max_in_flight', fallback=64),
+        reserved=config.getint('scheduler', 'reserved', fallback=8),
+        loop=loop
+    )
+    broker_back.reply_cache.max_entries = config.getint(
+        'reply_cache', 'max_entries', fallback=10000
+    )
+    broker_back.admission = get_admission_controller(
+        broker_back, config, loop=loop
+    )
+    yield from broker_back.setup_metrics(config)
+    setup_tracing(config, loop=loop)
+    broker_back.blobs = get_blob_store(config, loop=loop)
+    if config.getboolean('shared_memory', 'enabled', fallback=False):
+        broker_back.shm_size = config.getint(
+            'shared_memory', 'size', fallback=67108864
+        )
+        broker_back.shm_dir = config.get(
+            'shared_memory', 'directory', fallback=DEFAULT_SHM_DIR
+        )
+    if config.getboolean('data_plane', 'enabled', fallback=False):
+        broker_back.data_uri = config.get('data_plane', 'uri')
+        broker_back.data_plane = DataPlaneReceiver(broker_back, loop=loop)
+        yield from broker_back.data_plane.bind(broker_back.data_uri)
+
     yield from broker_back.prepare_redis(redis_host, redis_port)
     yield from broker_back.register_on_front()
 
-    zmqserver = yield from rpc.serve_rpc(
+    checkpoint_path = config.get('checkpoint', 'path', fallback=None)
+    if checkpoint_path:
+        checkpointer = Checkpointer(
+            broker_back, checkpoint_path,
+            interval=config.getfloat('checkpoint', 'interval', fallback=5),
+            loop=loop
+        )
+        recovery_delay = config.getfloat(
+            'checkpoint', 'recovery_delay', fallback=10
+        )
+        asyncio.async(checkpointer.run(recovery_delay), loop=loop)
+
+    zmqserver = yield from tuning.serve_rpc(
         broker_back,
         bind=socket,
         loop=loop,
+        metrics=broker_back.rpc_metrics,
     )
     yield from zmqserver.wait_closed()
 
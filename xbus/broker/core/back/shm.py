@@ -0,0 +1,141 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import collections
+import mmap
+import os
+import tempfile
+
+# Where the rings are created by default: a memory backed file system.
+DEFAULT_SHM_DIR = '/dev/shm'
+
+
+class ShmRing(object):
+    """A ShmRing passes the data of the items sent to a recipient running on
+    the same host as the backend through a shared memory segment, so that
+    only their offset and size go through the socket.
+
+    The data of an item is written after the previous one, wrapping around
+    at the end of the segment, and its space is reused once the recipient
+    has replied to the call; the space of an item whose call was cancelled
+    is never reused, since the recipient may still be reading it. Items
+    which do not fit in the free space are sent through the socket as usual.
+    """
+
+    def __init__(self, size: int, directory: str=DEFAULT_SHM_DIR):
+        """Create the segment.
+
+        :param size:
+         the size of the segment, in bytes
+
+        :param directory:
+         where the segment file is created, preferably on a tmpfs; defaults
+         to the system's temporary directory if it does not exist
+        """
+        if not os.path.isdir(directory):
+            directory = None
+        fd, self.path = tempfile.mkstemp(prefix='xbus-shm-', dir=directory)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.size = size
+        # Where the next item is written, and the (offset, size, released)
+        # lists of the items which still use the segment, oldest first.
+        self.head = 0
+        self.used = collections.deque()
+        self.allocations = {}
+        # No more items are written once retired, see :meth:`retire`.
+        self.retired = False
+
+    def write(self, data: bytes) -> int:
+        """Copy the data of an item into the segment.
+
+        :param data:
+         the item data
+
+        :return:
+         the offset of the data, to be given to :meth:`release` once the
+         recipient has read it, or None if there is not enough free space or
+         if the ring is retired
+        """
+        if self.retired:
+            return None
+        size = len(data)
+        offset = self._allocate(size)
+        if offset is None:
+            return None
+        self.map[offset:offset + size] = data
+        return offset
+
+    def release(self, offset: int):
+        """Make the space used by an item available again.
+
+        :param offset:
+         the offset returned by :meth:`write`
+        """
+        allocation = self.allocations.pop(offset, None)
+        if allocation is None:
+            return
+        allocation[2] = True
+        while self.used and self.used[0][2]:
+            self.used.popleft()
+        if not self.used:
+            self.head = 0
+            if self.retired:
+                self.close()
+
+    def retire(self):
+        """Stop writing items to the segment, and close it once the items
+        which still use it have been released.
+        """
+        self.retired = True
+        if not self.used:
+            self.close()
+
+    def unlink(self):
+        """Remove the segment file, once the recipient has opened it.
+        """
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        """Unmap and remove the segment.
+        """
+        self.retired = True
+        self.unlink()
+        self.map.close()
+        self.used.clear()
+        self.allocations.clear()
+
+    def _allocate(self, size: int) -> int:
+        """Find room for `size` bytes after the last allocation, wrapping
+        around at the end of the segment.
+        """
+        if size == 0 or size > self.size:
+            return None
+        if not self.used:
+            offset = 0
+        else:
+            tail = self.used[0][0]
+            if self.head > tail:
+                # The free space is after head, and before tail once wrapped.
+                if self.head + size <= self.size:
+                    offset = self.head
+                elif size <= tail:
+                    offset = 0
+                else:
+                    return None
+            elif self.head + size <= tail:
+                offset = self.head
+            else:
+                return None
+
+        allocation = [offset, size, False]
+        self.used.append(allocation)
+        self.allocations[offset] = allocation
+        self.head = offset + size
+        return offset
@@ -0,0 +1,133 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import mmap
+import os
+import tempfile
+
+# Default amount of item data (in bytes) a node may keep in memory before its
+# pending items are spilled to disk.
+DEFAULT_SPILL_THRESHOLD = 64 * 1024 * 1024
+
+
+class SpillQueue(object):
+    """A SpillQueue holds the items waiting to be forwarded to a node. Items
+    are kept in memory until the total size of the pending data exceeds a
+    threshold, after which they are appended to a memory-mapped segment file
+    and read back when the node catches up.
+
+    Pushing an item returns a handle, which must be given back to
+    :meth:`pop` in order to retrieve the data. The segment file is anonymous
+    (unlinked right after its creation) and is truncated each time all the
+    spilled items have been read back, so it only grows with the backlog of
+    the node. Claim checks (see :class:`.BlobRef`) are small and always kept
+    in memory.
+    """
+
+    def __init__(self, threshold: int=DEFAULT_SPILL_THRESHOLD, directory=None):
+        """Create a new spill queue.
+
+        :param threshold:
+         the number of bytes of pending data that may be kept in memory.
+
+        :param directory:
+         the directory where the segment file will be created; defaults to
+         the system's temporary directory.
+        """
+        self.threshold = threshold
+        self.directory = directory
+        self.memory = {}
+        self.memory_size = 0
+        self.counter = 0
+        self.segment = None
+        self.segment_size = 0
+        self.segment_items = 0
+        self.map = None
+
+    def push(self, data: bytes):
+        """Store the data of an item until it is needed.
+
+        :param data:
+         the item data
+
+        :return:
+         a handle that can be given to :meth:`pop`
+        """
+        if not isinstance(data, bytes):
+            self.counter += 1
+            self.memory[self.counter] = data
+            return self.counter
+
+        size = len(data)
+        if self.memory_size + size <= self.threshold:
+            self.counter += 1
+            self.memory[self.counter] = data
+            self.memory_size += size
+            return self.counter
+
+        if self.segment is None:
+            self.segment = tempfile.TemporaryFile(
+                prefix='xbus-spill-', dir=self.directory
+            )
+        offset = self.segment_size
+        os.pwrite(self.segment.fileno(), data, offset)
+        self.segment_size += size
+        self.segment_items += 1
+        return offset, size
+
+    def pop(self, handle) -> bytes:
+        """Retrieve and forget the data of an item.
+
+        :param handle:
+         the handle returned by :meth:`push`
+
+        :return:
+         the item data
+        """
+        if not isinstance(handle, tuple):
+            data = self.memory.pop(handle)
+            if isinstance(data, bytes):
+                self.memory_size -= len(data)
+            return data
+
+        offset, size = handle
+        if self.map is None or len(self.map) < offset + size:
+            self._remap()
+        data = self.map[offset:offset + size]
+
+        self.segment_items -= 1
+        if self.segment_items == 0:
+            # Every spilled item has been read back, start again from an
+            # empty segment.
+            self._unmap()
+            self.segment.truncate(0)
+            self.segment_size = 0
+        return data
+
+    def close(self):
+        """Forget every pending item and remove the segment file.
+        """
+        self.memory.clear()
+        self.memory_size = 0
+        self._unmap()
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+        self.segment_size = 0
+        self.segment_items = 0
+
+    def _remap(self):
+        """Map the whole segment file into memory.
+        """
+        self._unmap()
+        self.map = mmap.mmap(
+            self.segment.fileno(), self.segment_size, access=mmap.ACCESS_READ
+        )
+
+    def _unmap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def __len__(self):
+        return len(self.memory) + self.segment_items
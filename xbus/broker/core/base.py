@@ -4,21 +4,89 @@ __author__ = 'faide'
 import aioredis
 import uuid
 import asyncio
+import time
 
 from aiozmq import rpc
 
+from xbus.broker.core.metrics import MeteredEngine
+from xbus.broker.core.metrics import REGISTRY
+from xbus.broker.core.metrics import RPCMetrics
+from xbus.broker.core.metrics import start_metrics_exporter
+from xbus.broker.core.tracing import TRACER
+from xbus.broker.core.transport import SocketTuning
+
+db_latency = REGISTRY.histogram(
+    'xbus_db_latency_seconds', 'Time taken by database queries',
+    ('component',),
+)
+redis_latency = REGISTRY.histogram(
+    'xbus_redis_latency_seconds', 'Time taken by Redis commands',
+    ('component',),
+)
+reply_latency = REGISTRY.histogram(
+    'xbus_reply_latency_seconds',
+    'Time taken to reply to immediate reply events', ('component',),
+)
+loop_lag = REGISTRY.histogram(
+    'xbus_loop_lag_seconds', 'Lag of the event loop, see admission',
+    ('component',),
+)
+open_envelopes = REGISTRY.gauge(
+    'xbus_envelopes', 'Envelopes in progress', ('component',),
+)
+items_in_flight = REGISTRY.gauge(
+    'xbus_items_in_flight', 'Items being forwarded, see scheduler',
+    ('component',),
+)
+
 
 class XbusBrokerBase(rpc.AttrHandler):
     """The XbusBrokerBase is the boilerplate code we need for both our
     broker front and broker back (ie: initialize redis etc...)
     """
 
+    # Labels the metrics of the front and the backend: 'front' or 'back'.
+    component = None
+
     def __init__(self, dbengine, loop=None):
         self.dbengine = dbengine
         self.loop = loop
         self.redis_pool = None
+        # Options of the 0mq sockets; set up by get_frontserver and
+        # get_backserver.
+        self.tuning = SocketTuning()
+        # Calls to the RPC methods, and time taken by Redis commands.
+        self.rpc_metrics = RPCMetrics(self.component)
+        self.redis_latency = redis_latency.labels(self.component)
         super(rpc.AttrHandler, self).__init__()
 
+    @asyncio.coroutine
+    def setup_metrics(self, config):
+        """Serve the metrics of the broker from the `metrics` section of
+        the configuration, and start measuring the database queries. The
+        reply latency and admission histograms are exposed as well.
+
+        :param config:
+         the application configuration instance
+         :class:`configparser.ConfigParser`
+        """
+        exporter = yield from start_metrics_exporter(config, loop=self.loop)
+        if exporter is None:
+            return
+        self.dbengine = MeteredEngine(
+            self.dbengine, db_latency.labels(self.component)
+        )
+        reply_latency.attach(self.reply_latency, self.component)
+        if self.admission is not None:
+            loop_lag.attach(self.admission.lag_histogram, self.component)
+        labels = (self.component,)
+        open_envelopes.collectors.append(
+            lambda: {labels: len(self.envelopes)}
+        )
+        items_in_flight.collectors.append(
+            lambda: {labels: self.limiter.in_use}
+        )
+
     @asyncio.coroutine
     def prepare_redis(self, redis_host, redis_port):
         self.redis_pool = yield from aioredis.create_pool(
@@ -42,6 +110,7 @@ class XbusBrokerBase(rpc.AttrHandler):
         """Save a key with some data into Redis.
         """
 
+        start = time.monotonic()
         try:
             # unicode objects must be encoded before hashing so we encode to
             # utf-8
@@ -50,6 +119,8 @@ class XbusBrokerBase(rpc.AttrHandler):
                 yield from conn.set(key, info)
         except (aioredis.ReplyError, aioredis.ProtocolError):
             return False
+        finally:
+            self.redis_latency.observe(time.monotonic() - start)
         return True
 
     @asyncio.coroutine
@@ -57,20 +128,40 @@ class XbusBrokerBase(rpc.AttrHandler):
         """Retrieve data about a key from Redis, or None if unavailable.
         """
 
+        start = time.monotonic()
         try:
             with (yield from self.redis_pool) as conn:
                 info = yield from conn.get(key)
         except (aioredis.ReplyError, aioredis.ProtocolError):
             return None
+        finally:
+            self.redis_latency.observe(time.monotonic() - start)
         if info is None:
             return None
         return info.decode("utf-8")
 
     @asyncio.coroutine
     def destroy_key(self, key: str) -> bool:
+        start = time.monotonic()
         try:
             with (yield from self.redis_pool) as conn:
                 yield from conn.delete(key)
         except (aioredis.ReplyError, aioredis.ProtocolError):
             return False
+        finally:
+            self.redis_latency.observe(time.monotonic() - start)
         return True
+
+    @rpc.method
+    def get_trace(self, envelope_id: str) -> dict:
+        """Report where the time of a traced envelope went, from the spans
+        of its stages which are still kept, see :mod:`.tracing`.
+
+        :param envelope_id:
+         the UUID of the envelope
+
+        :return:
+         the breakdown of the envelope, see :meth:`.Tracer.breakdown`; empty
+         if the envelope has not been traced or its spans have been dropped
+        """
+        return TRACER.breakdown(envelope_id)
@@ -0,0 +1,231 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+_handle_re = re.compile(r'^[0-9a-f]{64}$')
+
+
+class BlobRef(object):
+    """A claim check: the reference to the data of an item written to a
+    :class:`BlobStore`, which takes its place on its way through the front
+    and the backend.
+    """
+
+    def __init__(self, handle: str, size: int):
+        """
+        :param handle:
+         the handle of the blob, ie: the SHA-256 of its data
+
+        :param size:
+         the size of the data, in bytes
+        """
+        self.handle = handle
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return '<BlobRef {} ({} bytes)>'.format(self.handle, self.size)
+
+
+class BlobStore(object):
+    """A BlobStore keeps the data of large items in files named after their
+    SHA-256, so that only a :class:`BlobRef` travels from the front to the
+    backend and to the recipients which support the "claim_check" feature.
+    The front and the backend must share the directory of the store.
+
+    The same data is only written once. Blobs are removed once they have not
+    been written for `max_age` seconds; the items remain in the database
+    anyway, for replays.
+    """
+
+    def __init__(
+        self, path: str, threshold: int=1048576, max_age: float=86400,
+        loop=None
+    ):
+        """
+        :param path:
+         the directory of the store
+
+        :param threshold:
+         the size of data, in bytes, from which items are claim checked
+
+        :param max_age:
+         the number of seconds after which unused blobs are removed
+
+        :param loop:
+         the event loop used by the broker
+        """
+        self.path = path
+        self.threshold = threshold
+        self.max_age = max_age
+        self.loop = loop
+        self.task = None
+        os.makedirs(path, exist_ok=True)
+
+    def accepts(self, data: bytes) -> bool:
+        """Tell whether an item is large enough to be claim checked.
+        """
+        return len(data) >= self.threshold
+
+    def path_for(self, handle: str) -> str:
+        """Find the file of a blob.
+
+        :raises ValueError:
+         if the handle is not a SHA-256 in hexadecimal
+        """
+        if not isinstance(handle, str) or not _handle_re.match(handle):
+            raise ValueError('Invalid blob handle')
+        return os.path.join(self.path, handle[:2], handle[2:])
+
+    def exists(self, handle: str) -> bool:
+        """Tell whether the store holds a blob.
+        """
+        try:
+            return os.path.exists(self.path_for(handle))
+        except ValueError:
+            return False
+
+    @asyncio.coroutine
+    def put(self, data: bytes) -> BlobRef:
+        """Write the data of an item, from a worker thread.
+
+        :return:
+         the :class:`BlobRef` of the data
+        """
+        handle = yield from self.loop.run_in_executor(None, self.write, data)
+        return BlobRef(handle, len(data))
+
+    @asyncio.coroutine
+    def get(self, handle: str) -> bytes:
+        """Read the data of an item, from a worker thread.
+
+        :raises OSError:
+         if there is no such blob
+        """
+        data = yield from self.loop.run_in_executor(None, self.read, handle)
+        return data
+
+    def write(self, data: bytes) -> str:
+        """Write the data of an item, unless it is already there.
+
+        :return:
+         the handle of the blob
+        """
+        handle = hashlib.sha256(data).hexdigest()
+        path = self.path_for(handle)
+        try:
+            # Already there: keep it for another max_age seconds.
+            os.utime(path)
+            return handle
+        except FileNotFoundError:
+            pass
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return handle
+
+    def read(self, handle: str) -> bytes:
+        """Read the data of an item.
+
+        :raises OSError:
+         if there is no such blob
+        """
+        with open(self.path_for(handle), 'rb') as blob:
+            return blob.read()
+
+    def sweep(self) -> int:
+        """Remove the blobs which have not been written for `max_age`
+        seconds.
+
+        :return:
+         the number of removed blobs
+        """
+        limit = time.time() - self.max_age
+        removed = 0
+        for directory, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    if os.stat(path).st_mtime < limit:
+                        os.unlink(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def start(self):
+        """Start removing the old blobs in the background.
+        """
+        if self.task is None and self.max_age:
+            self.task = asyncio.async(self.watch(), loop=self.loop)
+
+    def stop(self):
+        """Stop removing the old blobs.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    @asyncio.coroutine
+    def watch(self):
+        """Internal helper method used to remove the old blobs every tenth
+        of `max_age` until cancelled.
+        """
+        while True:
+            yield from asyncio.sleep(self.max_age / 10, loop=self.loop)
+            try:
+                removed = yield from self.loop.run_in_executor(
+                    None, self.sweep
+                )
+            except Exception:
+                logger.exception('Could not remove the old blobs')
+            else:
+                if removed:
+                    logger.info('Removed %d old blobs', removed)
+
+
+def get_blob_store(config, loop=None):
+    """A helper function that is used internally to create the blob store of
+    the front or the backend from the `blobstore` section of the
+    configuration, and start removing its old blobs.
+
+    :param config:
+     the application configuration instance
+     :class:`configparser.ConfigParser`
+
+    :param loop:
+     the event loop used by the broker
+
+    :return:
+     the :class:`BlobStore`, or None if claim checks are disabled
+    """
+    if not config.getboolean('blobstore', 'enabled', fallback=False):
+        return None
+
+    blobs = BlobStore(
+        config.get('blobstore', 'path'),
+        threshold=config.getint('blobstore', 'threshold', fallback=1048576),
+        max_age=config.getfloat('blobstore', 'max_age', fallback=86400),
+        loop=loop,
+    )
+    blobs.start()
+    return blobs
@@ -0,0 +1,257 @@
+# -*- encoding: utf-8 -*-
+"""A data plane between the front and the backend, for the items of the
+events which do not expect an immediate reply.
+
+The front streams the items through a DEALER socket connected to a ROUTER
+socket of the backend, one multipart message per item, without waiting for
+a reply. The backend acknowledges them cumulatively: one message per event
+for every batch of items it has read, with the index of the last one. The
+start and end of events and envelopes still go through the RPC sockets.
+
+Message frames::
+
+    front -> back:  b'item', envelope ID, event ID, index, data
+                    b'blob', envelope ID, event ID, index, handle, size
+    back -> front:  b'ack', envelope ID, event ID, index
+                    b'nack', envelope ID, event ID, index, message
+
+The IDs and handles are UTF-8 encoded, and the index and size are unsigned
+64 bits integers in network byte order.
+"""
+__author__ = 'jgavrel'
+
+import asyncio
+import logging
+import struct
+
+import aiozmq
+import zmq
+
+from xbus.broker.core.blobstore import BlobRef
+
+logger = logging.getLogger(__name__)
+
+ITEM = b'item'
+BLOB = b'blob'
+ACK = b'ack'
+NACK = b'nack'
+
+_uint64 = struct.Struct('!Q')
+
+
+class DataPlaneProtocol(aiozmq.ZmqProtocol):
+    """Hands the messages received on a data plane socket to a callback.
+    """
+
+    transport = None
+
+    def __init__(self, on_message):
+        self.on_message = on_message
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def msg_received(self, data):
+        try:
+            self.on_message(data)
+        except Exception:
+            logger.exception('Could not handle a data plane message')
+
+
+class DataPlaneSender(object):
+    """The front end of the data plane.
+
+    At most `window` items of an event may be waiting for their
+    acknowledgement; the front checks it with :meth:`XbusBrokerFront
+    .backend_stream_item` before sending an item.
+    """
+
+    def __init__(self, broker, window: int=1000, loop=None):
+        """
+        :param broker:
+         the :class:`.XbusBrokerFront` instance
+
+        :param window:
+         the number of items of an event which may wait for their
+         acknowledgement
+
+        :param loop:
+         the event loop used by the front
+        """
+        self.broker = broker
+        self.window = window
+        self.loop = loop
+        self.protocol = None
+
+    @property
+    def connected(self) -> bool:
+        """Whether the data plane is connected to a backend.
+        """
+        return (
+            self.protocol is not None and self.protocol.transport is not None
+        )
+
+    @asyncio.coroutine
+    def connect(self, uri: str):
+        """Connect to the data plane of a backend, replacing the previous
+        connection.
+
+        :param uri:
+         the URI the data plane of the backend is bound to
+        """
+        self.close()
+        transport, self.protocol = (
+            yield from self.broker.tuning.create_zmq_connection(
+                lambda: DataPlaneProtocol(self.received),
+                zmq.DEALER, connect=uri, loop=self.loop
+            )
+        )
+
+    def send(self, envelope_id: str, event_id: str, index: int, data):
+        """Send an item to the backend.
+
+        :param data:
+         the item data, or its :class:`.BlobRef`
+
+        :return:
+         True if the item was sent, False if the data plane is not connected
+        """
+        if not self.connected:
+            return False
+        frames = [envelope_id.encode(), event_id.encode(), _uint64.pack(index)]
+        if isinstance(data, BlobRef):
+            frames = [BLOB] + frames + [
+                data.handle.encode(), _uint64.pack(data.size)
+            ]
+        else:
+            frames = [ITEM] + frames + [data]
+        self.protocol.transport.write(frames)
+        return True
+
+    def received(self, frames: list):
+        """Internal helper method used to handle the acknowledgements of the
+        backend.
+        """
+        kind, envelope_id, event_id, index = frames[:4]
+        envelope_id = envelope_id.decode()
+        event_id = event_id.decode()
+        index = _uint64.unpack(index)[0]
+        if kind == ACK:
+            self.broker.acknowledge_items(envelope_id, event_id, index)
+        elif kind == NACK:
+            logger.warning(
+                'Item %d of event %s refused by the backend: %s',
+                index, event_id, frames[4].decode()
+            )
+            envelope_info = self.broker.envelopes.get(envelope_id)
+            if envelope_info is None or not envelope_info['forward']:
+                return
+            asyncio.async(
+                self.broker.disable_backend_forward(envelope_id),
+                loop=self.loop
+            )
+
+    def close(self):
+        """Close the connection to the backend.
+        """
+        if self.connected:
+            self.protocol.transport.close()
+        self.protocol = None
+
+
+class DataPlaneReceiver(object):
+    """The backend end of the data plane. The items are dispatched as soon
+    as they are read, like those sent through :meth:`XbusBrokerBack
+    .send_item`, and acknowledged once every message available at once has
+    been read.
+    """
+
+    def __init__(self, broker, loop=None):
+        """
+        :param broker:
+         the :class:`.XbusBrokerBack` instance
+
+        :param loop:
+         the event loop used by the backend
+        """
+        self.broker = broker
+        self.loop = loop
+        self.protocol = None
+        # The last index read for each event: {(peer, envelope ID, event
+        # ID): index}
+        self.acks = {}
+
+    @asyncio.coroutine
+    def bind(self, uri: str):
+        """Start receiving items.
+
+        :param uri:
+         the URI the data plane is bound to
+        """
+        transport, self.protocol = (
+            yield from self.broker.tuning.create_zmq_connection(
+                lambda: DataPlaneProtocol(self.received),
+                zmq.ROUTER, bind=uri, loop=self.loop
+            )
+        )
+
+    def received(self, frames: list):
+        """Internal helper method used to dispatch an item.
+        """
+        peer, kind, b_envelope_id, b_event_id, b_index = frames[:5]
+        index = _uint64.unpack(b_index)[0]
+        if kind == BLOB:
+            data = BlobRef(frames[5].decode(), _uint64.unpack(frames[6])[0])
+        else:
+            data = frames[5]
+
+        envelope = self.broker.envelopes.get(b_envelope_id.decode())
+        event = None
+        if envelope is not None:
+            event = envelope.events.get(b_event_id.decode())
+        if event is None:
+            if envelope is None:
+                message = b'No such envelope'
+            else:
+                message = b'No such event'
+            self.protocol.transport.write(
+                [peer, NACK, b_envelope_id, b_event_id, b_index, message]
+            )
+            return
+        if isinstance(data, BlobRef) and (
+            self.broker.blobs is None or not self.broker.blobs.exists(
+                data.handle
+            )
+        ):
+            self.protocol.transport.write(
+                [peer, NACK, b_envelope_id, b_event_id, b_index,
+                 b'No such blob']
+            )
+            return
+
+        self.broker.dispatch_item(envelope, event, [index], data, index)
+
+        if not self.acks:
+            self.loop.call_soon(self.flush)
+        self.acks[peer, b_envelope_id, b_event_id] = b_index
+
+    def flush(self):
+        """Internal helper method used to acknowledge the items read so far.
+        """
+        acks, self.acks = self.acks, {}
+        if self.protocol is None or self.protocol.transport is None:
+            return
+        for (peer, b_envelope_id, b_event_id), b_index in acks.items():
+            self.protocol.transport.write(
+                [peer, ACK, b_envelope_id, b_event_id, b_index]
+            )
+
+    def close(self):
+        """Stop receiving items.
+        """
+        if self.protocol is not None and self.protocol.transport is not None:
+            self.protocol.transport.close()
+        self.protocol = None
@@ -0,0 +1,44 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+"""Errors sent back to the clients of the broker.
+
+They are raised by the RPC methods, so that aiozmq sends them back as such:
+clients may pass them to :func:`aiozmq.rpc.connect_rpc` as its
+`error_table`, or find their names in the `exc_type` of
+:class:`aiozmq.rpc.GenericError`.
+"""
+
+
+class ThrottledError(Exception):
+    """Raised when an emitter goes over one of the limits of its emitter
+    profile or its own. The call had no effect and may be retried later.
+    """
+
+    def __init__(self, message: str, retry_after: float=None):
+        """
+        :param message:
+         which limit was reached
+
+        :param retry_after:
+         the number of seconds after which the call would be accepted, if
+         known
+        """
+        super(ThrottledError, self).__init__(message, retry_after)
+        self.message = message
+        self.retry_after = retry_after
+
+
+class OverloadedError(Exception):
+    """Raised when the broker refuses a new envelope because it is
+    overloaded (see :class:`.AdmissionController`). The envelopes already
+    accepted are still processed; the call may be retried later.
+    """
+
+    def __init__(self, message: str):
+        """
+        :param message:
+         which threshold was crossed
+        """
+        super(OverloadedError, self).__init__(message)
+        self.message = message
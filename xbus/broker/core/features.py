@@ -8,4 +8,6 @@ RecipientFeature = Enum(
 
     'clearing '
     'immediate_reply '
+    'claim_check '
+    'shared_memory '
 )
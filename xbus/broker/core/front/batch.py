@@ -0,0 +1,136 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class EnvelopeBatcher(object):
+    """An EnvelopeBatcher groups the small envelopes received by the
+    frontend, so that the envelopes holding an event of the same type are
+    forwarded to the backend in a single call instead of five round trips
+    each.
+
+    An envelope waits at most `linger` seconds in a batch. A batch is sent
+    as soon as it holds `max_envelopes` envelopes.
+    """
+
+    def __init__(
+        self, broker, max_items: int=0, max_envelopes: int=100,
+        linger: float=0.005, loop=None
+    ):
+        """Create a new batcher.
+
+        :param broker:
+         the :class:`.XbusBrokerFront` instance whose backend is used
+
+        :param max_items:
+         the number of items above which an envelope is no longer held back
+         by the frontend to be batched; 0 disables batching
+
+        :param max_envelopes:
+         the maximum number of envelopes sent to the backend in a single call
+
+        :param linger:
+         the period of time in seconds an envelope may wait for others
+
+        :param loop:
+         the event loop used by the frontend
+        """
+        self.broker = broker
+        self.max_items = max_items
+        self.max_envelopes = max_envelopes
+        self.linger = linger
+        self.loop = loop
+
+        # Envelopes waiting to be sent: {type ID: [envelope tuple]}
+        self.batches = {}
+        # Timers of the pending batches: {type ID: TimerHandle}
+        self.timers = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_items > 0
+
+    def add(
+        self, envelope_id: str, event_id: str, type_id: str, type_name: str,
+        items: list
+    ):
+        """Add an envelope holding a single event to the batch of its event
+        type.
+
+        :param envelope_id:
+         the UUID of the envelope
+
+        :param event_id:
+         the UUID of the event
+
+        :param type_id:
+         the internal UUID of the type of the event
+
+        :param type_name:
+         the name of the type of the event
+
+        :param items:
+         the data of the items of the event, in index order
+        """
+        batch = self.batches.setdefault(type_id, [])
+        batch.append((envelope_id, event_id, type_id, type_name, items))
+
+        if len(batch) >= self.max_envelopes:
+            self.flush(type_id)
+        elif type_id not in self.timers:
+            self.timers[type_id] = self.loop.call_later(
+                self.linger, self.flush, type_id
+            )
+
+    def flush(self, type_id: str):
+        """Send the pending batch of an event type to the backend.
+
+        :param type_id:
+         the internal UUID of the event type
+        """
+        timer = self.timers.pop(type_id, None)
+        if timer is not None:
+            timer.cancel()
+
+        batch = self.batches.pop(type_id, None)
+        if batch:
+            asyncio.async(self.send_batch(batch), loop=self.loop)
+
+    @asyncio.coroutine
+    def send_batch(self, batch: list) -> int:
+        """Forward a batch of envelopes to the backend, then record the state
+        of each envelope: the envelopes refused by the backend are left
+        waiting for a replay.
+
+        :param batch:
+         a list of envelopes, as given to :meth:`add`
+
+        :return:
+         the number of envelopes accepted by the backend
+        """
+        envelope_ids = [envelope[0] for envelope in batch]
+        backend = self.broker.backend
+        res = None
+        if backend is not None:
+            try:
+                res = yield from backend.call.process_envelopes(batch)
+            except Exception:
+                logger.exception('Could not send %d envelopes', len(batch))
+
+        if not res:
+            res = [False] * len(batch)
+
+        done = [eid for eid, success in zip(envelope_ids, res) if success]
+        wait = [eid for eid, success in zip(envelope_ids, res) if not success]
+
+        if done:
+            yield from self.broker.update_envelopes_state(done, 'exec')
+        if wait:
+            yield from self.broker.update_envelopes_state(wait, 'wait')
+            logger.warning('%d envelopes left waiting', len(wait))
+
+        return len(done)
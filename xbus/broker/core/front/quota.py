@@ -0,0 +1,276 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import time
+
+from sqlalchemy.sql import select
+
+from xbus.broker.model import emitter
+from xbus.broker.model import emitter_profile
+from xbus.broker.core.errors import ThrottledError
+
+
+class TokenBucket(object):
+    """A TokenBucket allows an average `rate` of units per second, with
+    bursts of up to `burst` seconds worth of units.
+    """
+
+    def __init__(self, rate: float, burst: float=1.0):
+        """
+        :param rate:
+         the number of units allowed per second
+
+        :param burst:
+         the number of seconds worth of units that may be used at once
+        """
+        self.rate = rate
+        self.capacity = max(rate * burst, 1)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+
+    def delay(self, amount: float) -> float:
+        """Tell how long to wait before `amount` units may be taken.
+
+        A full bucket lets any amount through, so that a single large item
+        is not refused forever.
+
+        :return:
+         0 if the units may be taken right away, a number of seconds
+         otherwise
+        """
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.stamp) * self.rate
+        )
+        self.stamp = now
+        missing = min(amount, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0
+
+    def take(self, amount: float):
+        """Take units, once :meth:`delay` returned 0.
+        """
+        self.tokens -= amount
+
+
+class Quota(object):
+    """The limits of an emitter or of an emitter profile, and their current
+    usage.
+    """
+
+    def __init__(
+        self, item_rate: float, byte_rate: float, max_open_envelopes: int,
+        burst: float=1.0
+    ):
+        """
+        :param item_rate:
+         the number of items allowed per second, or None
+
+        :param byte_rate:
+         the number of bytes of item data allowed per second, or None
+
+        :param max_open_envelopes:
+         the number of envelopes which may be open at the same time, or None
+
+        :param burst:
+         the number of seconds worth of items and bytes that may be sent at
+         once
+        """
+        self.limits = item_rate, byte_rate, max_open_envelopes
+        self.items = TokenBucket(item_rate, burst) if item_rate else None
+        self.bytes = TokenBucket(byte_rate, burst) if byte_rate else None
+        self.max_open_envelopes = max_open_envelopes
+        self.open_envelopes = 0
+
+
+class QuotaManager(object):
+    """A QuotaManager enforces the limits set on the emitters and emitter
+    profiles, in memory: the limits are read from the database once in a
+    while, and checked at each call with a few arithmetic operations.
+
+    Calls over a limit raise a :class:`.ThrottledError`, which is sent back
+    to the emitter.
+    """
+
+    def __init__(
+        self, broker, burst: float=1.0, refresh: float=60,
+        envelope_ttl: float=3600, loop=None
+    ):
+        """
+        :param broker:
+         the :class:`.XbusBrokerFront` instance whose database is used
+
+        :param burst:
+         the number of seconds worth of items and bytes that may be sent at
+         once
+
+        :param refresh:
+         the number of seconds after which the limits of an emitter or of a
+         profile are read again from the database
+
+        :param envelope_ttl:
+         the number of seconds after which an envelope left open no longer
+         counts against the limits, or None
+
+        :param loop:
+         the event loop used by the frontend
+        """
+        self.broker = broker
+        self.burst = burst
+        self.refresh = refresh
+        self.envelope_ttl = envelope_ttl
+        self.loop = loop
+
+        # {('emitter' or 'profile', ID): Quota instance or None}
+        self.quotas = {}
+        # {('emitter' or 'profile', ID): time the limits were read}
+        self.loaded = {}
+
+    @asyncio.coroutine
+    def get(self, emitter_id: str, profile_id: str) -> list:
+        """Find the quotas which apply to an emitter.
+
+        :param emitter_id:
+         the UUID of the emitter
+
+        :param profile_id:
+         the UUID of the profile of the emitter
+
+        :return:
+         a list of :class:`Quota` instances, empty if the emitter has no
+         limits
+        """
+        keys = ('emitter', emitter_id), ('profile', profile_id)
+        limit = time.monotonic() - self.refresh
+        stale = [
+            key for key in keys
+            if self.loaded.get(key) is None or self.loaded[key] < limit
+        ]
+        if stale:
+            yield from self.load(stale)
+        return [
+            self.quotas[key] for key in keys
+            if self.quotas.get(key) is not None
+        ]
+
+    @asyncio.coroutine
+    def load(self, keys: list):
+        """Internal helper method used to read the limits of emitters or
+        profiles from the database.
+
+        :param keys:
+         a list of ('emitter' or 'profile', ID) tuples
+        """
+        tables = {'emitter': emitter, 'profile': emitter_profile}
+        rows = {}
+        with (yield from self.broker.dbengine) as conn:
+            for key in keys:
+                kind, row_id = key
+                table = tables[kind]
+                query = select((
+                    table.c.item_rate, table.c.byte_rate,
+                    table.c.max_open_envelopes,
+                ))
+                query = query.where(table.c.id == row_id).limit(1)
+                cr = yield from conn.execute(query)
+                row = yield from cr.first()
+                rows[key] = row.as_tuple() if row else None
+        self.update(rows)
+
+    def update(self, rows: dict):
+        """Internal helper method used to apply the limits read from the
+        database.
+
+        The buckets of a quota are kept while its limits do not change, so
+        that reading them again does not refill the buckets; the number of
+        open envelopes is counted again from the envelopes of the broker.
+
+        :param rows:
+         a dict of {('emitter' or 'profile', ID): limits tuple or None}
+        """
+        now = time.monotonic()
+        for key, limits in rows.items():
+            previous = self.quotas.get(key)
+            if limits is None or not any(limits):
+                quota = None
+            elif previous is not None and previous.limits == tuple(limits):
+                quota = previous
+            else:
+                quota = Quota(*limits, burst=self.burst)
+            if quota is not None:
+                quota.open_envelopes = self.count_open_envelopes(key, now)
+            self.quotas[key] = quota
+            self.loaded[key] = now
+
+    def count_open_envelopes(self, key: tuple, now: float) -> int:
+        """Internal helper method used to count the envelopes of an emitter
+        or of a profile that are still open.
+        """
+        kind, row_id = key
+        field = 'emitter_id' if kind == 'emitter' else 'profile_id'
+        limit = None
+        if self.envelope_ttl is not None:
+            limit = now - self.envelope_ttl
+        return sum(
+            1 for info in self.broker.envelopes.values()
+            if info.get(field) == row_id and
+            not info.get('closed', False) and
+            (limit is None or info.get('opened', now) >= limit)
+        )
+
+    @asyncio.coroutine
+    def open_envelope(self, emitter_id: str, profile_id: str):
+        """Account for a new envelope.
+
+        :raises ThrottledError:
+         if the emitter or its profile has too many open envelopes
+        """
+        quotas = yield from self.get(emitter_id, profile_id)
+        for quota in quotas:
+            if (
+                quota.max_open_envelopes is not None and
+                quota.open_envelopes >= quota.max_open_envelopes
+            ):
+                raise ThrottledError('Too many open envelopes')
+        for quota in quotas:
+            quota.open_envelopes += 1
+
+    def close_envelope(self, emitter_id: str, profile_id: str):
+        """Account for the end or the cancellation of an envelope.
+        """
+        for key in ('emitter', emitter_id), ('profile', profile_id):
+            quota = self.quotas.get(key)
+            if quota is not None and quota.open_envelopes > 0:
+                quota.open_envelopes -= 1
+
+    @asyncio.coroutine
+    def take_items(
+        self, emitter_id: str, profile_id: str, count: int, size: int
+    ):
+        """Account for items sent by an emitter.
+
+        :param count:
+         the number of items
+
+        :param size:
+         the total size of their data, in bytes
+
+        :raises ThrottledError:
+         if the emitter or its profile sends too many items or bytes
+        """
+        quotas = yield from self.get(emitter_id, profile_id)
+        buckets = []
+        for quota in quotas:
+            if quota.items is not None:
+                buckets.append((quota.items, count, 'items'))
+            if quota.bytes is not None:
+                buckets.append((quota.bytes, size, 'bytes'))
+
+        for bucket, amount, unit in buckets:
+            delay = bucket.delay(amount)
+            if delay:
+                raise ThrottledError(
+                    'Too many {} per second'.format(unit), delay
+                )
+        for bucket, amount, unit in buckets:
+            bucket.take(amount)
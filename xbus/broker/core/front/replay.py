@@ -0,0 +1,247 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import logging
+
+from xbus.broker.model.helpers import get_envelopes_by_state
+from xbus.broker.model.helpers import get_envelope_events
+from xbus.broker.model.helpers import open_item_cursor
+from xbus.broker.model.helpers import fetch_item_cursor
+from xbus.broker.model.helpers import close_item_cursor
+
+logger = logging.getLogger(__name__)
+
+
+class EnvelopeReplayer(object):
+    """An EnvelopeReplayer forwards to the backend the envelopes that were
+    stored by the frontend while no backend was able to process them (ie:
+    the envelopes in the "wait" state).
+
+    The items are streamed from the database with a server-side cursor and
+    sent to the backend in batches, with a bounded number of envelopes
+    replayed at the same time and a bounded number of batches in flight for
+    each event.
+
+    The envelopes refused by the backend (ie: while it is overloaded) stay
+    in the "wait" state: they are replayed again every `interval` seconds
+    once :meth:`start` has been called.
+    """
+
+    def __init__(
+        self, broker, concurrency: int=4, batch_size: int=500,
+        window: int=4, interval: float=30, loop=None
+    ):
+        """Create a new replayer.
+
+        :param broker:
+         the :class:`.XbusBrokerFront` instance whose backend is used
+
+        :param concurrency:
+         the number of envelopes that can be replayed at the same time
+
+        :param batch_size:
+         the number of items sent to the backend in a single call
+
+        :param window:
+         the number of batches that can be waiting for the backend's answer
+         for a given event
+
+        :param interval:
+         the period of time in seconds between two replays of the waiting
+         envelopes, 0 disables them
+
+        :param loop:
+         the event loop used by the frontend
+        """
+        self.broker = broker
+        self.batch_size = batch_size
+        self.window = window
+        self.interval = interval
+        self.loop = loop
+        self.semaphore = asyncio.Semaphore(concurrency, loop=loop)
+        self.running = set()
+        self.task = None
+
+    def start(self):
+        """Start replaying the waiting envelopes in the background.
+        """
+        if self.task is None and self.interval:
+            self.task = asyncio.async(self.watch(), loop=self.loop)
+
+    def stop(self):
+        """Stop replaying the waiting envelopes.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    @asyncio.coroutine
+    def watch(self):
+        """Internal helper method used to replay the waiting envelopes every
+        `interval` seconds, while a backend is registered, until cancelled.
+        """
+        while True:
+            yield from asyncio.sleep(self.interval, loop=self.loop)
+            if self.broker.backend is None:
+                continue
+            try:
+                yield from self.replay_waiting()
+            except Exception:
+                logger.exception('Could not replay the waiting envelopes')
+
+    @asyncio.coroutine
+    def replay_waiting(self) -> int:
+        """Replay every envelope in the "wait" state.
+
+        :return:
+         the number of envelopes that were successfully replayed
+        """
+        with (yield from self.broker.dbengine) as conn:
+            envelope_ids = yield from get_envelopes_by_state(conn, 'wait')
+
+        tasks = [
+            asyncio.async(self.replay_envelope(envelope_id), loop=self.loop)
+            for envelope_id in envelope_ids
+            if envelope_id not in self.running
+        ]
+        if not tasks:
+            return 0
+
+        logger.info('Replaying %d waiting envelopes', len(tasks))
+        res = yield from asyncio.gather(*tasks, loop=self.loop)
+        done = sum(1 for success in res if success)
+        logger.info('%d/%d waiting envelopes replayed', done, len(tasks))
+        return done
+
+    @asyncio.coroutine
+    def replay_envelope(self, envelope_id: str) -> bool:
+        """Forward a stored envelope, with all its events and items, to the
+        backend. The envelope is marked as being executed if the backend
+        accepted it.
+
+        :param envelope_id:
+         the UUID of the envelope
+
+        :return:
+         True if successful, False otherwise
+        """
+        if envelope_id in self.running:
+            return False
+        self.running.add(envelope_id)
+
+        try:
+            with (yield from self.semaphore):
+                backend = self.broker.backend
+                if backend is None:
+                    return False
+
+                res = yield from self.forward_envelope(backend, envelope_id)
+                if res:
+                    yield from self.broker.update_envelope_state_exec(
+                        envelope_id
+                    )
+                return res
+
+        except Exception:
+            logger.exception('Could not replay envelope %s', envelope_id)
+            return False
+
+        finally:
+            self.running.discard(envelope_id)
+
+    @asyncio.coroutine
+    def forward_envelope(self, backend, envelope_id: str) -> bool:
+        """Internal helper method used to send an envelope to the backend.
+        """
+        res = yield from backend.call.start_envelope(envelope_id)
+        if not res:
+            return False
+
+        with (yield from self.broker.dbengine) as conn:
+            events = yield from get_envelope_events(conn, envelope_id)
+
+        for event_id, type_id, type_name in events:
+            res = yield from self.forward_event(
+                backend, envelope_id, event_id, type_id, type_name
+            )
+            if not res:
+                yield from backend.call.cancel_envelope(envelope_id)
+                return False
+
+        res = yield from backend.call.end_envelope(envelope_id)
+        return isinstance(res, dict) and res.get('success') is True
+
+    @asyncio.coroutine
+    def forward_event(
+        self, backend, envelope_id: str, event_id: str, type_id: str,
+        type_name: str
+    ) -> bool:
+        """Internal helper method used to send an event and its items to the
+        backend.
+        """
+        res = yield from backend.call.start_event(
+            envelope_id, event_id, type_id, type_name
+        )
+        # ie: False when no worker is available
+        if not isinstance(res, (list, tuple)) or res[0] != 0:
+            return False
+
+        # Cursors are local to the connection, a fixed name is enough.
+        cursor_name = 'xbus_replay'
+        nb_items = 0
+        pending = set()
+        success = True
+
+        with (yield from self.broker.dbengine) as conn:
+            tr = yield from conn.begin()
+            try:
+                yield from open_item_cursor(conn, cursor_name, event_id)
+                while success:
+                    items = yield from fetch_item_cursor(
+                        conn, cursor_name, self.batch_size, loop=self.loop
+                    )
+                    if not items:
+                        break
+
+                    if len(pending) >= self.window:
+                        done, pending = yield from asyncio.wait(
+                            pending, loop=self.loop,
+                            return_when=asyncio.FIRST_COMPLETED
+                        )
+                        success = all(self.batch_sent(t) for t in done)
+
+                    call = backend.call.send_items(
+                        envelope_id, event_id, items
+                    )
+                    pending.add(asyncio.async(call, loop=self.loop))
+                    nb_items += len(items)
+
+                yield from close_item_cursor(conn, cursor_name)
+
+            except Exception:
+                yield from tr.rollback()
+                raise
+
+            else:
+                yield from tr.commit()
+
+        if pending:
+            done, pending = yield from asyncio.wait(pending, loop=self.loop)
+            success = success and all(self.batch_sent(t) for t in done)
+        if not success:
+            return False
+
+        res = yield from backend.call.end_event(
+            envelope_id, event_id, nb_items, False
+        )
+        return res.get('success', False)
+
+    @staticmethod
+    def batch_sent(task) -> bool:
+        """Tell whether the backend accepted a batch of items.
+        """
+        if task.exception() is not None:
+            return False
+        code, msg = task.result()
+        return code == 0
@@ -3,6 +3,8 @@ __author__ = 'faide'
 
 import asyncio
 import json
+import logging
+import time
 import aiozmq
 from aiozmq import rpc
 
@@ -12,13 +14,35 @@ from sqlalchemy import func
 
 from xbus.broker.model import validate_password
 from xbus.broker.model import emitter
+from xbus.broker.model import emitter_profile
 from xbus.broker.model import envelope
 from xbus.broker.model import event
 from xbus.broker.model import event_type
 from xbus.broker.model import emitter_profile_event_type_rel
 from xbus.broker.model import item
+from xbus.broker.model.compression import compress
+from xbus.broker.model.compression import compress_rows
 
+from xbus.broker.core.admission import get_admission_controller
 from xbus.broker.core.base import XbusBrokerBase
+from xbus.broker.core.blobstore import get_blob_store
+from xbus.broker.core.dataplane import DataPlaneSender
+from xbus.broker.core.metrics import LatencyHistogram
+from xbus.broker.core.scheduler import PriorityLimiter
+from xbus.broker.core.tracing import setup_tracing
+from xbus.broker.core.tracing import traced
+from xbus.broker.core.transport import get_socket_tuning
+from xbus.broker.core.transport import serve_peer_rpc
+from xbus.broker.core.transport import with_peer
+from xbus.broker.core.trigger import Trigger
+from xbus.broker.core.front.batch import EnvelopeBatcher
+from xbus.broker.core.front.bulk import ItemCopier
+from xbus.broker.core.front.quota import QuotaManager
+from xbus.broker.core.front.replay import EnvelopeReplayer
+from xbus.broker.core.front.session import SessionStore
+from xbus.broker.core.front.writer import ItemWriter
+
+logger = logging.getLogger(__name__)
 
 
 class XbusBrokerFront(XbusBrokerBase):
@@ -38,19 +62,67 @@ class XbusBrokerFront(XbusBrokerBase):
     As long as the backend is not ready the front will just store the
     envelopes, events and data and acknowledge them to the clients.
     The corresponding envelopes will be marked as waiting as long as no
-    backend is present.
+    backend is present, and replayed as soon as a backend registers itself.
+
+    Small envelopes may be held back by the front until they are complete,
+    and then forwarded to the backend in batches (see
+    :class:`.EnvelopeBatcher`). An envelope is forwarded on its own as soon as
+    it grows too large, holds several events, or expects an immediate reply.
+
+    The events which expect an immediate reply are forwarded through a
+    dedicated connection to the backend, and their items are sent ahead of
+    the ones of bulk events (see :class:`.PriorityLimiter`). The items of
+    bulk events are sent in turn for each tenant (emitter profile, or emitter
+    if `tenant_by` is "emitter"), according to the weight of its profile.
     """
 
+    component = 'front'
+
     def __init__(self, dbengine, loop=None):
         # at the beginning the backend is None. Then the Front2Back will set
         # a backend in place when one comes to register itself.
         self.backend = None
+        # Connection dedicated to the events expecting an immediate reply.
+        self.backend_fast = None
         self.envelopes = {}
+        self.replayer = EnvelopeReplayer(self, loop=loop)
+        self.batcher = EnvelopeBatcher(self, loop=loop)
+        # Sessions bound to the connections of the emitters, only used when
+        # the front is served by serve_peer_rpc.
+        self.sessions = SessionStore()
+        # Background writer of the items of "group" durability events.
+        self.item_writer = ItemWriter(self, loop=loop)
+        # Items in flight towards the backend, immediate reply events first,
+        # and the time taken to reply to immediate reply events.
+        self.limiter = PriorityLimiter(loop=loop)
+        self.reply_latency = LatencyHistogram()
+        # Items received from the emitters and not forwarded to the backend
+        # yet, see :meth:`queued_items`.
+        self.forwarding = 0
+        # Whether the items are scheduled by "profile" or by "emitter", and
+        # the weights of the emitter profiles: {profile ID: weight}
+        self.tenant_by = 'profile'
+        self.profile_weights = {}
+        # Limits of the emitters, see :class:`.QuotaManager`; set up by
+        # get_frontserver.
+        self.quotas = None
+        # Refuses new envelopes while the front is overloaded, see
+        # :class:`.AdmissionController`; set up by get_frontserver.
+        self.admission = None
+        # Holds the data of the large items, so that only their handles are
+        # sent to the backend, see :class:`.BlobStore`; set up by
+        # get_frontserver.
+        self.blobs = None
+        # Streams the items of the events which do not expect an immediate
+        # reply to the backend, see :class:`.DataPlaneSender`; set up by
+        # get_frontserver, connected when the backend registers.
+        self.data_plane = None
         super(XbusBrokerFront, self).__init__(dbengine, loop=loop)
 
+    @with_peer
     @rpc.method
     @asyncio.coroutine
-    def login(self, login: str, password: str) -> str:
+    def login(self, login: str, password: str, *, peer=None) -> str:
         """Before doing anything useful you'll need to login into the broker
         we a login/password. If the authentication phase is ok you'll get a
         token that must be provided during other method calls.
@@ -75,15 +147,18 @@ class XbusBrokerFront(XbusBrokerBase):
                     'profile_id': emitter_profile_id}
             info_json = json.dumps(info)
             yield from self.save_key(token, info_json)
+            if peer is not None:
+                self.sessions.bind(peer, token, info)
 
         else:
             token = ""
 
         return token
 
+    @with_peer
     @rpc.method
     @asyncio.coroutine
-    def logout(self, token: str) -> bool:
+    def logout(self, token: str, *, peer=None) -> bool:
         """When you are done using the broker you should call this method to
         make sure your token is destroyed and no one can reuse it
 
@@ -93,12 +168,15 @@ class XbusBrokerFront(XbusBrokerBase):
         :return:
          True if successful, False otherwise
         """
+        self.sessions.drop_token(token)
         res = yield from self.destroy_key(token)
         return res
 
+    @with_peer
     @rpc.method
+    @traced('start_envelope', result='envelope_id')
     @asyncio.coroutine
-    def start_envelope(self, token: str) -> str:
+    def start_envelope(self, token: str, *, peer=None) -> str:
         """Start a new envelope.
 
         :param token:
@@ -108,39 +186,68 @@ class XbusBrokerFront(XbusBrokerBase):
 
         :return:
          The UUID of the new envelope if successful, an empty string otherwise
+
+        :raises ThrottledError:
+         if the emitter or its profile has too many open envelopes
+
+        :raises OverloadedError:
+         if the front is overloaded
         """
-        emitter_json = yield from self.get_key_info(token)
-        if emitter_json is None:
+        emitter_info = yield from self.get_emitter_info(token, peer)
+        if emitter_info is None:
             return ""
 
         try:
-            # lookup the emitters table and find a matching "login"
-            emitter_info = json.loads(emitter_json)
             emitter_id = emitter_info['id']
         except KeyError:
             return ""
 
+        if self.admission is not None:
+            self.admission.check()
+
+        profile_id = emitter_info.get('profile_id')
+        if self.quotas is not None:
+            yield from self.quotas.open_envelope(emitter_id, profile_id)
+
         envelope_id = self.new_envelope()
         info = {
             'emitter_id': emitter_id,
+            'profile_id': profile_id,
             'events': {},
-            'trigger': asyncio.Future(loop=self.loop)
+            'trigger': Trigger(self.loop),
+            'opened': time.monotonic(),
         }
         self.envelopes[envelope_id] = info
 
-        yield from self.log_new_envelope(envelope_id, emitter_id)
+        # The envelope is held back until it turns out to be small enough to
+        # be forwarded in a batch.
+        held = self.batcher.enabled and self.backend is not None
+        if held:
+            info['held'] = 'hold'
+            info['forward'] = False
 
-        asyncio.async(
-            self.backend_start_envelope(envelope_id),
-            loop=self.loop
-        )
+        try:
+            yield from self.log_new_envelope(envelope_id, emitter_id)
+        except Exception:
+            del self.envelopes[envelope_id]
+            if self.quotas is not None:
+                self.quotas.close_envelope(emitter_id, profile_id)
+            raise
+
+        if not held:
+            asyncio.async(
+                self.backend_start_envelope(envelope_id),
+                loop=self.loop
+            )
 
         return envelope_id
 
+    @with_peer
     @rpc.method
+    @traced('start_event', result='event_id')
     @asyncio.coroutine
     def start_event(self, token: str, envelope_id: str,
-                    event_name: str, estimate: int) -> str:
+                    event_name: str, estimate: int, *, peer=None) -> str:
         """Start a new event inside an envelop. Conceptually an event is the
         container of items (which are emitted using :meth:`.XbusBrokerFront
         .login` method on the same 0mq socket. An event is also contained
@@ -162,16 +269,15 @@ class XbusBrokerFront(XbusBrokerBase):
         :return:
          The UUID of the new event if successful, an empty string otherwise
         """
-        emitter_json = yield from self.get_key_info(token)
-        if emitter_json is None:
+        emitter_info = yield from self.get_emitter_info(token, peer)
+        if emitter_info is None:
             return ""
 
         try:
-            emitter_info = json.loads(emitter_json)
             emitter_id = emitter_info['id']
             profile_id = emitter_info['profile_id']
 
-        except (ValueError, SyntaxError, KeyError):
+        except KeyError:
             return ""
 
         try:
@@ -189,7 +295,7 @@ class XbusBrokerFront(XbusBrokerBase):
         if envelope_closed:
             return ""
 
-        type_id, immediate_reply = (
+        type_id, immediate_reply, durability, compression = (
             yield from self.find_event_type_by_name(event_name)
         )
 
@@ -203,13 +309,22 @@ class XbusBrokerFront(XbusBrokerBase):
             return ""
 
         event_id = self.new_event()
+        envelope_held = envelope_info.get('held')
+        envelope_forward = envelope_info['forward']
         info = {
             'envelope_id': envelope_id,
             'immediate_reply': immediate_reply,
             'type_id': type_id,
+            'type_name': event_name,
+            'durability': durability,
+            'compression': compression,
             'recv': 0,
             'sent': 0,
-            'trigger': asyncio.Future(loop=self.loop)
+            'written': 0,
+            'started': False,
+            'trigger': Trigger(self.loop),
+            'held': envelope_held is not None,
+            'items': [],
         }
 
         envelope_info['events'][event_id] = info
@@ -218,7 +333,16 @@ class XbusBrokerFront(XbusBrokerBase):
             event_id, envelope_id, emitter_id, type_id, estimate
         )
 
-        if envelope_forward:
+        if envelope_held:
+            if envelope_info['held'] == 'hold' and (
+                immediate_reply or len(envelope_info['events']) > 1
+            ):
+                asyncio.async(
+                    self.forward_held_envelope(envelope_id),
+                    loop=self.loop
+                )
+
+        elif envelope_forward:
             asyncio.async(
                 self.backend_start_event(
                     envelope_id, event_id, type_id, event_name
@@ -228,10 +352,12 @@ class XbusBrokerFront(XbusBrokerBase):
 
         return event_id
 
+    @with_peer
     @rpc.method
+    @traced('send_item')
     @asyncio.coroutine
     def send_item(self, token: str, envelope_id: str, event_id: str,
-                  data: bytes) -> bool:
+                  data: bytes, *, peer=None) -> bool:
         """Send an item through XBUS.
 
         :param token:
@@ -252,15 +378,18 @@ class XbusBrokerFront(XbusBrokerBase):
 
         :return:
          True if successful, False otherwise
+
+        :raises ThrottledError:
+         if the emitter or its profile sends too many items or bytes per
+         second; the item is then not accepted
         """
-        emitter_json = yield from self.get_key_info(token)
-        if emitter_json is None:
+        emitter_info = yield from self.get_emitter_info(token, peer)
+        if emitter_info is None:
             return False
 
         try:
-            emitter_info = json.loads(emitter_json)
             emitter_id = emitter_info['id']
-        except (ValueError, SyntaxError, KeyError):
+        except KeyError:
             return False
 
         try:
@@ -284,20 +413,58 @@ class XbusBrokerFront(XbusBrokerBase):
         if event_closed:
             return False
 
-        yield from self.log_sent_item(event_id, index, data)
+        durability = event_info['durability']
+        if (
+            durability == 'none' and envelope_info['forward'] is False and
+            not envelope_info.get('held')
+        ):
+            # The item would be neither stored nor forwarded.
+            return False
+
+        if self.quotas is not None:
+            yield from self.quotas.take_items(
+                emitter_id, envelope_info['profile_id'], 1, len(data)
+            )
+
+        if durability == 'sync':
+            yield from self.log_sent_item(
+                event_id, index, data, event_info['compression']
+            )
+        elif durability == 'group':
+            self.item_writer.write(
+                event_id, index, data, event_info['compression']
+            )
         event_info['recv'] = index + 1
 
-        if envelope_forward:
-            asyncio.async(
+        # A held envelope may have been forwarded in the meantime.
+        envelope_forward = envelope_info['forward']
+        if envelope_info.get('held'):
+            event_info['items'].append(data)
+            if (
+                envelope_info['held'] == 'hold' and
+                event_info['recv'] > self.batcher.max_items
+            ):
+                asyncio.async(
+                    self.forward_held_envelope(envelope_id),
+                    loop=self.loop
+                )
+
+        elif envelope_forward:
+            self.forwarding += 1
+            task = asyncio.async(
                 self.backend_send_item(envelope_id, event_id, index, data),
                 loop=self.loop
             )
+            task.add_done_callback(self.item_forwarded)
 
         return True
 
+    @with_peer
     @rpc.method
+    @traced('end_event')
     @asyncio.coroutine
-    def end_event(self, token: str, envelope_id: str, event_id: str) -> tuple:
+    def end_event(self, token: str, envelope_id: str, event_id: str,
+                  *, peer=None) -> tuple:
         """Signal that all items have been sent for a given event.
 
         :param token:
@@ -319,14 +486,13 @@ class XbusBrokerFront(XbusBrokerBase):
         feature; None otherwise.
         """
 
-        emitter_json = yield from self.get_key_info(token)
-        if emitter_json is None:
+        emitter_info = yield from self.get_emitter_info(token, peer)
+        if emitter_info is None:
             return False, None
 
         try:
-            emitter_info = json.loads(emitter_json)
             emitter_id = emitter_info['id']
-        except (ValueError, SyntaxError, KeyError):
+        except KeyError:
             return False, None
 
         try:
@@ -350,9 +516,27 @@ class XbusBrokerFront(XbusBrokerBase):
         if event_closed:
             return False, None
         event_info['closed'] = True
+        end_time = time.monotonic()
+
+        if event_info['durability'] == 'group':
+            written = yield from self.item_writer.flush(event_id)
+            if not written:
+                return False, None
 
         result = True, None
 
+        envelope_held = envelope_info.get('held')
+        if envelope_held == 'hold' and not immediate_reply:
+            # Forwarded with the envelope, see forward_held_envelope.
+            event_info['held_end'] = True
+            return result
+
+        if envelope_held == 'hold':
+            yield from self.forward_held_envelope(envelope_id)
+        elif envelope_held == 'flush':
+            yield from asyncio.shield(envelope_info['flushed'])
+        envelope_forward = envelope_info['forward']
+
         if envelope_forward:
             nb_items = event_info['recv']
             result = yield from asyncio.async(
@@ -361,12 +545,17 @@ class XbusBrokerFront(XbusBrokerBase):
                 ),
                 loop=self.loop
             )
+            if immediate_reply:
+                self.reply_latency.observe(time.monotonic() - end_time)
 
         return result
 
+    @with_peer
     @rpc.method
+    @traced('end_envelope')
     @asyncio.coroutine
-    def end_envelope(self, token: str, envelope_id: str) -> bool:
+    def end_envelope(self, token: str, envelope_id: str,
+                     *, peer=None) -> bool:
         """Closes an envelope. Each event started for this envelope must have
         been closed beforehand, using :meth:`.XbusBrokerFront.end_event`.
 
@@ -384,14 +573,13 @@ class XbusBrokerFront(XbusBrokerBase):
          True if successful, False otherwise
         """
 
-        emitter_json = yield from self.get_key_info(token)
-        if emitter_json is None:
+        emitter_info = yield from self.get_emitter_info(token, peer)
+        if emitter_info is None:
             return False
 
         try:
-            emitter_info = json.loads(emitter_json)
             emitter_id = emitter_info['id']
-        except (ValueError, SyntaxError, KeyError):
+        except KeyError:
             return False
 
         try:
@@ -413,22 +601,63 @@ class XbusBrokerFront(XbusBrokerBase):
                 return False
 
         envelope_info['closed'] = True
+        if self.quotas is not None:
+            self.quotas.close_envelope(emitter_id, envelope_info['profile_id'])
+
+        # The items of the events whose durability level is "none" are not
+        # stored: such an envelope cannot be replayed.
+        replayable = all(
+            event_info['durability'] != 'none'
+            for event_info in envelope_events.values()
+        )
 
-        if envelope_forward:
+        if envelope_info.get('held') == 'hold':
+            if len(envelope_events) == 1 and replayable:
+                (event_id, event_info), = envelope_events.items()
+                self.batcher.add(
+                    envelope_id, event_id, event_info['type_id'],
+                    event_info['type_name'], event_info['items']
+                )
+                del self.envelopes[envelope_id]
+                return True
+
+            yield from self.forward_held_envelope(envelope_id)
+
+        elif envelope_info.get('held') == 'flush':
+            yield from asyncio.shield(envelope_info['flushed'])
+
+        envelope_forward = envelope_info['forward']
+        if envelope_forward and not replayable:
+            res = yield from self.backend_end_envelope(envelope_id)
+            return res
+        elif envelope_forward:
             asyncio.async(
                 self.backend_end_envelope(envelope_id),
                 loop=self.loop
             )
             pass
         else:
-            yield from self.update_envelope_state_wait(envelope_id)
+            del self.envelopes[envelope_id]
+            if not (yield from self.park_envelope(envelope_id, replayable)):
+                return False
+
+            # The envelope is fully stored, a backend that registered itself
+            # in the meantime can process it.
+            if self.backend is not None:
+                asyncio.async(
+                    self.replayer.replay_envelope(envelope_id),
+                    loop=self.loop
+                )
 
         # Do nothing else for now.
         return True
 
+    @with_peer
     @rpc.method
+    @traced('cancel_envelope')
     @asyncio.coroutine
-    def cancel_envelope(self, token: str, envelope_id: str) -> bool:
+    def cancel_envelope(self, token: str, envelope_id: str,
+                        *, peer=None) -> bool:
         """Cancel the emission of an opened envelope.
 
         :param token:
@@ -445,14 +674,13 @@ class XbusBrokerFront(XbusBrokerBase):
          True if successful, False otherwise
         """
 
-        emitter_json = yield from self.get_key_info(token)
-        if emitter_json is None:
+        emitter_info = yield from self.get_emitter_info(token, peer)
+        if emitter_info is None:
             return False
 
         try:
-            emitter_info = json.loads(emitter_json)
             emitter_id = emitter_info['id']
-        except (ValueError, SyntaxError, KeyError):
+        except KeyError:
             return False
 
         try:
@@ -470,11 +698,29 @@ class XbusBrokerFront(XbusBrokerBase):
             return False
 
         envelope_info['closed'] = True
-        for event_info in envelope_events.values():
+        for event_id, event_info in envelope_events.items():
+            if (
+                event_info['durability'] == 'group' and
+                not event_info.get('closed', False)
+            ):
+                asyncio.async(
+                    self.item_writer.cancel(event_id), loop=self.loop
+                )
             event_info['closed'] = True
+        if self.quotas is not None:
+            self.quotas.close_envelope(emitter_id, envelope_info['profile_id'])
 
         yield from self.update_envelope_state_cancel(envelope_id)
 
+        if envelope_info.get('held') == 'hold':
+            # Nothing has reached the backend yet.
+            del self.envelopes[envelope_id]
+            return True
+
+        if envelope_info.get('held') == 'flush':
+            yield from asyncio.shield(envelope_info['flushed'])
+            envelope_forward = envelope_info['forward']
+
         if envelope_forward:
             asyncio.async(
                 self.backend_cancel_envelope(envelope_id),
@@ -484,9 +730,134 @@ class XbusBrokerFront(XbusBrokerBase):
         # Do nothing else for now.
         return True
 
+    @with_peer
+    @rpc.method
+    @asyncio.coroutine
+    def send_envelope(self, token: str, events: list,
+                      *, peer=None) -> tuple:
+        """Send a complete envelope in a single call. This is equivalent to
+        calling :meth:`start_envelope`, then :meth:`start_event`,
+        :meth:`send_item` and :meth:`end_event` for each event, and
+        :meth:`end_envelope`.
+
+        :param token:
+         the emitter's connection token, obtained from the
+         :meth:`.XbusBrokerFront.login` method which is exposed on the same
+         0mq socket.
+
+        :param events:
+         a list of (event type name, estimate, items) 3-tuples, where items
+         is the list of the data of the items of the event. At most one of
+         the events may use the "immediate reply" feature.
+
+        :return: 3-element tuple:
+        - The UUID of the new envelope, or an empty string if it was refused.
+        - Boolean indicating success (True when succesful).
+        - Data sent back by the consumer, when using the "immediate reply"
+        feature; None otherwise.
+
+        :raises ThrottledError:
+         if the emitter or its profile sends too many items or bytes per
+         second; the envelope is then not accepted
+
+        :raises OverloadedError:
+         if the front is overloaded
+        """
+        if not events:
+            return "", False, None
+
+        emitter_info = yield from self.get_emitter_info(token, peer)
+        if emitter_info is None:
+            return "", False, None
+
+        try:
+            emitter_id = emitter_info['id']
+            profile_id = emitter_info['profile_id']
+        except KeyError:
+            return "", False, None
+
+        type_names = {event_name for event_name, estimate, items in events}
+        event_types = yield from self.find_allowed_event_types(
+            profile_id, type_names
+        )
+        if len(event_types) != len(type_names):
+            return "", False, None
+
+        immediate_reply = [
+            event_name for event_name, estimate, items in events
+            if event_types[event_name][1]
+        ]
+        if len(immediate_reply) > 1:
+            return "", False, None
+
+        if self.admission is not None:
+            self.admission.check()
+
+        if self.quotas is not None:
+            yield from self.quotas.take_items(
+                emitter_id, profile_id,
+                sum(len(items) for event_name, estimate, items in events),
+                sum(
+                    len(data) for event_name, estimate, items in events
+                    for data in items
+                ),
+            )
+
+        envelope_id = self.new_envelope()
+        envelope_events = []
+        for event_name, estimate, items in events:
+            type_id, event_immediate_reply, durability, compression = (
+                event_types[event_name]
+            )
+            envelope_events.append((
+                self.new_event(), type_id, event_name, items,
+                event_immediate_reply, estimate, durability, compression
+            ))
+
+        yield from self.log_complete_envelope(
+            envelope_id, emitter_id, envelope_events
+        )
+
+        # The items of the events whose durability level is "none" are not
+        # stored: such an envelope cannot be replayed.
+        replayable = all(
+            event_row[6] != 'none' for event_row in envelope_events
+        )
+
+        # The estimate is of no use to the backend.
+        envelope_events = [event_row[:5] for event_row in envelope_events]
+
+        if self.backend is None:
+            success = yield from self.park_envelope(envelope_id, replayable)
+            return envelope_id, success, None
+
+        tenant, weight = yield from self.get_tenant(emitter_id, profile_id)
+
+        if immediate_reply or not replayable:
+            success, reply_data = yield from self.backend_process_envelope(
+                envelope_id, envelope_events, tenant=tenant, weight=weight,
+                replayable=replayable
+            )
+            return envelope_id, success, reply_data
+
+        if (
+            self.batcher.enabled and len(envelope_events) == 1 and
+            len(envelope_events[0][3]) <= self.batcher.max_items
+        ):
+            self.batcher.add(envelope_id, *envelope_events[0][:4])
+        else:
+            asyncio.async(
+                self.backend_process_envelope(
+                    envelope_id, envelope_events, tenant=tenant, weight=weight
+                ),
+                loop=self.loop
+            )
+        return envelope_id, True, None
+
+    @with_peer
     @rpc.method
     @asyncio.coroutine
-    def get_consumers(self, token: str) -> list:
+    def get_consumers(self, token: str, *, peer=None) -> list:
         """Retrieve the list of consumers that have registered into the Xbus
         back-end, including their metadata and the features they support.
 
@@ -498,12 +869,215 @@ class XbusBrokerFront(XbusBrokerBase):
         """
 
         # Check the token.
-        if (yield from self.get_key_info(token)) is None:
+        if (yield from self.get_emitter_info(token, peer)) is None:
             return []
 
         consumers = yield from self.backend.call.get_consumers()
         return consumers
 
+    @asyncio.coroutine
+    def forward_held_envelope(self, envelope_id: str) -> bool:
+        """Forward to the backend an envelope that was held back to be
+        batched, with the events and items received so far. The envelope is
+        then forwarded like any other one.
+
+        :param envelope_id:
+         the UUID of the envelope
+
+        :return:
+         True if successful, False otherwise
+        """
+        envelope_info = self.envelopes[envelope_id]
+        if envelope_info.get('held') != 'hold':
+            return False
+        envelope_info['held'] = 'flush'
+        envelope_info['flushed'] = asyncio.Future(loop=self.loop)
+
+        try:
+            res = yield from self.backend_forward_held(envelope_id)
+        except Exception:
+            logger.exception('Could not forward envelope %s', envelope_id)
+            res = False
+
+        # Items received from now on follow the usual path.
+        envelope_info['held'] = None
+        envelope_info['forward'] = res
+        if res:
+            for event_id, event_info in envelope_info['events'].items():
+                if event_info.pop('held_end', False):
+                    asyncio.async(
+                        self.backend_end_event(
+                            envelope_id, event_id, event_info['recv'], False
+                        ),
+                        loop=self.loop
+                    )
+
+        elif self.backend is not None:
+            asyncio.async(
+                self.backend.call.cancel_envelope(envelope_id),
+                loop=self.loop
+            )
+
+        envelope_info['flushed'].set_result(res)
+        return res
+
+    @traced('backend_forward_held')
+    @asyncio.coroutine
+    def backend_forward_held(self, envelope_id: str) -> bool:
+        """Internal helper method used to send a held envelope to the
+        backend, until all its events and items have been sent.
+        """
+        backend = self.backend
+        if backend is None:
+            return False
+
+        envelope_info = self.envelopes[envelope_id]
+        tenant, weight = yield from self.get_tenant(
+            envelope_info['emitter_id'], envelope_info['profile_id']
+        )
+        res = yield from backend.call.start_envelope(
+            envelope_id, tenant=tenant, weight=weight
+        )
+        if not res:
+            return False
+
+        while True:
+            pending = [
+                (event_id, event_info)
+                for event_id, event_info in envelope_info['events'].items()
+                if event_info['held'] or event_info['items']
+            ]
+            if not pending:
+                return True
+
+            for event_id, event_info in pending:
+                if event_info['held']:
+                    code, msg = yield from backend.call.start_event(
+                        envelope_id, event_id, event_info['type_id'],
+                        event_info['type_name'],
+                        immediate_reply=event_info['immediate_reply']
+                    )
+                    if code != 0:
+                        return False
+                    event_info['held'] = False
+                    event_info['started'] = True
+
+                items, event_info['items'] = event_info['items'], []
+                if items:
+                    index = event_info['sent']
+                    code, msg = yield from backend.call.send_items(
+                        envelope_id, event_id, list(enumerate(items, index))
+                    )
+                    if code != 0:
+                        return False
+                    event_info['sent'] = index + len(items)
+
+    @asyncio.coroutine
+    def get_emitter_info(self, token: str, peer: bytes=None) -> dict:
+        """Internal helper method used to find the emitter a token was
+        given to, from the session bound to the caller's connection if any,
+        or from Redis.
+
+        :param token:
+         the emitter's connection token
+
+        :param peer:
+         the routing identity of the caller's connection, if known
+
+        :return:
+         the emitter information saved at login, or None if the token is
+         invalid
+        """
+        if peer is not None:
+            info = self.sessions.get(peer, token)
+            if info is not None:
+                return info
+
+        emitter_json = yield from self.get_key_info(token)
+        if emitter_json is None:
+            return None
+        try:
+            info = json.loads(emitter_json)
+        except ValueError:
+            return None
+
+        if peer is not None:
+            self.sessions.bind(peer, token, info)
+        return info
+
+    @asyncio.coroutine
+    def get_tenant(self, emitter_id: str, profile_id: str) -> tuple:
+        """Internal helper method used to find the tenant the items of an
+        emitter are scheduled with, and its weight.
+
+        :param emitter_id:
+         the UUID of the emitter
+
+        :param profile_id:
+         the UUID of the profile of the emitter
+
+        :return:
+         a 2-tuple (tenant, weight)
+        """
+        weight = self.profile_weights.get(profile_id)
+        if weight is None:
+            weight = yield from self.find_profile_weight(profile_id)
+            self.profile_weights[profile_id] = weight
+
+        if self.tenant_by == 'emitter':
+            return emitter_id, weight
+        return profile_id, weight
+
+    @traced('backend_process_envelope')
+    @asyncio.coroutine
+    def backend_process_envelope(
+        self, envelope_id: str, events: list, *, tenant=None,
+        weight: float=1, replayable: bool=True
+    ) -> tuple:
+        """Forward a complete envelope to the backend.
+
+        :param envelope_id:
+         the UUID of the envelope
+
+        :param events:
+         a list of (event ID, type ID, type name, items, immediate reply)
+         tuples
+
+        :param tenant:
+         the tenant of the envelope, as returned by :meth:`get_tenant`
+
+        :param weight:
+         the weight of the tenant
+
+        :param replayable:
+         False if the envelope must be cancelled instead of waiting for a
+         replay when the backend refuses it, see :meth:`park_envelope`
+
+        :return: 2-element tuple:
+        - Boolean indicating success (True when succesful).
+        - Data sent back by the consumer, when using the "immediate reply"
+        feature; None otherwise.
+        """
+        backend = self.backend
+        if self.backend_fast is not None and any(e[4] for e in events):
+            backend = self.backend_fast
+
+        try:
+            res = yield from backend.call.process_envelope(
+                envelope_id, events, tenant=tenant, weight=weight
+            )
+        except Exception:
+            logger.exception('Could not forward envelope %s', envelope_id)
+            res = {'success': False}
+
+        if res['success'] is True:
+            yield from self.update_envelope_state_exec(envelope_id)
+        else:
+            yield from self.park_envelope(envelope_id, replayable)
+
+        return res['success'], res.get('reply_data')
+
+    @traced('backend_start_envelope')
     @asyncio.coroutine
     def backend_start_envelope(self, envelope_id: str) -> bool:
         """Forward the new envelope to the backend.
@@ -515,18 +1089,31 @@ class XbusBrokerFront(XbusBrokerBase):
          True if successful, False otherwise
         """
         envelope_info = self.envelopes[envelope_id]
-        res = yield from self.backend.call.start_envelope(envelope_id)
+        if self.backend is None:
+            res = None
+        else:
+            tenant, weight = yield from self.get_tenant(
+                envelope_info['emitter_id'], envelope_info['profile_id']
+            )
+            try:
+                res = yield from self.backend.call.start_envelope(
+                    envelope_id, tenant=tenant, weight=weight
+                )
+            except Exception:
+                # ie: the backend is overloaded; the envelope is left waiting
+                # for a replay.
+                logger.exception('Could not forward envelope %s', envelope_id)
+                res = None
         if res:
             envelope_info['forward'] = True
-            if envelope_info['trigger']._callbacks:
-                envelope_info['trigger'].set_result(True)
-                envelope_info['trigger'] = asyncio.Future(loop=self.loop)
+            envelope_info['trigger'].fire()
             return True
         else:
             envelope_info['forward'] = False
-            envelope_info['trigger'].set_result(False)
+            envelope_info['trigger'].cancel()
             return False
 
+    @traced('backend_start_event')
     @asyncio.coroutine
     def backend_start_event(self, envelope_id: str, event_id: str,
                             type_id: str, type_name: str) -> bool:
@@ -551,24 +1138,25 @@ class XbusBrokerFront(XbusBrokerBase):
         event_info = envelope_info['events'][event_id]
         forward = envelope_info.get('forward')
         if forward is None:
-            forward = yield from envelope_info['trigger']
+            forward = yield from envelope_info['trigger'].wait()
 
         if forward is False:
-            event_info['trigger'].set_result(False)
+            event_info['trigger'].cancel()
             return False
 
-        code, msg = yield from self.backend.call.start_event(
-            envelope_id, event_id, type_id, type_name
+        code, msg = yield from self.backend_for(event_info).call.start_event(
+            envelope_id, event_id, type_id, type_name,
+            immediate_reply=event_info['immediate_reply']
         )
         if code == 0:
-            if event_info['trigger']._callbacks:
-                event_info['trigger'].set_result(True)
-                event_info['trigger'] = asyncio.Future(loop=self.loop)
+            event_info['started'] = True
+            event_info['trigger'].fire()
             return True
         else:
             yield from self.disable_backend_forward(envelope_id)
             return False
 
+    @traced('backend_send_item')
     @asyncio.coroutine
     def backend_send_item(
             self, envelope_id: str, event_id: str, index: int, data: bytes
@@ -591,24 +1179,118 @@ class XbusBrokerFront(XbusBrokerBase):
          True if successful, False otherwise
         """
         event_info = self.envelopes[envelope_id]['events'][event_id]
+        if (
+            self.data_plane is not None and self.data_plane.connected and
+            not event_info['immediate_reply']
+        ):
+            res = yield from self.backend_stream_item(
+                envelope_id, event_id, index, data
+            )
+            return res
+
         while event_info['sent'] < index:
-            trigger_res = yield from event_info['trigger']
+            trigger_res = yield from event_info['trigger'].wait()
             if trigger_res is False:
                 return False
 
-        code, msg = yield from self.backend.call.send_item(
-            envelope_id, event_id, index, data
+        blob = yield from self.claim_check(data)
+
+        urgent = event_info['immediate_reply']
+        envelope_info = self.envelopes[envelope_id]
+        tenant, weight = yield from self.get_tenant(
+            envelope_info['emitter_id'], envelope_info['profile_id']
         )
+        with (yield from self.limiter.acquire(urgent, tenant, weight)):
+            call = self.backend_for(event_info).call
+            if blob is not None:
+                code, msg = yield from call.send_item_blob(
+                    envelope_id, event_id, index, blob.handle, blob.size
+                )
+            else:
+                code, msg = yield from call.send_item(
+                    envelope_id, event_id, index, data
+                )
         if code == 0:
             event_info['sent'] += 1
-            if event_info['trigger']._callbacks:
-                event_info['trigger'].set_result(True)
-                event_info['trigger'] = asyncio.Future(loop=self.loop)
+            event_info['trigger'].fire()
             return True
         else:
             yield from self.disable_backend_forward(envelope_id)
             return False
 
+    @asyncio.coroutine
+    def backend_stream_item(
+            self, envelope_id: str, event_id: str, index: int, data: bytes
+    ):
+        """Forward the item to the backend through the data plane, without
+        waiting for its acknowledgement. The items of an event are written
+        in order once the backend has started the event, and at most
+        `data_plane.window` of them may wait for their acknowledgement (see
+        :meth:`acknowledge_items`).
+
+        :return:
+         True if successful, False otherwise
+        """
+        event_info = self.envelopes[envelope_id]['events'][event_id]
+        while (
+            not event_info['started'] or
+            max(event_info['written'], event_info['sent']) < index or
+            index - event_info['sent'] >= self.data_plane.window
+        ):
+            trigger_res = yield from event_info['trigger'].wait()
+            if trigger_res is False:
+                return False
+
+        blob = yield from self.claim_check(data)
+
+        envelope_info = self.envelopes[envelope_id]
+        tenant, weight = yield from self.get_tenant(
+            envelope_info['emitter_id'], envelope_info['profile_id']
+        )
+        with (yield from self.limiter.acquire(False, tenant, weight)):
+            sent = self.data_plane.send(
+                envelope_id, event_id, index, blob or data
+            )
+        if not sent:
+            yield from self.disable_backend_forward(envelope_id)
+            return False
+
+        event_info['written'] = index + 1
+        event_info['trigger'].fire()
+        return True
+
+    def acknowledge_items(self, envelope_id: str, event_id: str, index: int):
+        """Internal helper method used to record that the backend has
+        received the items of an event up to the given index, through the
+        data plane.
+        """
+        try:
+            event_info = self.envelopes[envelope_id]['events'][event_id]
+        except KeyError:
+            return
+        if index >= event_info['sent']:
+            event_info['sent'] = index + 1
+            event_info['trigger'].fire()
+
+    @asyncio.coroutine
+    def claim_check(self, data: bytes):
+        """Internal helper method used to write the data of a large item
+        to the blob store, if enabled.
+
+        :return:
+         the :class:`.BlobRef` of the data, or None if the item must be sent
+         as is
+        """
+        if self.blobs is None or not self.blobs.accepts(data):
+            return None
+        try:
+            blob = yield from self.blobs.put(data)
+        except OSError:
+            logger.exception('Could not write a blob, sending the item')
+            return None
+        return blob
+
+    @traced('backend_end_event')
     @asyncio.coroutine
     def backend_end_event(
         self, envelope_id: str, event_id: str, nb_items: int,
@@ -637,11 +1319,11 @@ class XbusBrokerFront(XbusBrokerBase):
         envelope_info = self.envelopes[envelope_id]
         event_info = envelope_info['events'][event_id]
         while event_info['sent'] < nb_items:
-            trigger_res = yield from event_info['trigger']
+            trigger_res = yield from event_info['trigger'].wait()
             if trigger_res is False:
                 return False, None
 
-        call_data = yield from self.backend.call.end_event(
+        call_data = yield from self.backend_for(event_info).call.end_event(
             envelope_id, event_id, nb_items, immediate_reply,
         )
 
@@ -650,12 +1332,61 @@ class XbusBrokerFront(XbusBrokerBase):
             yield from self.disable_backend_forward(envelope_id)
             return False, None
 
-        if envelope_info['trigger']._callbacks:
-            envelope_info['trigger'].set_result(True)
-            envelope_info['trigger'] = asyncio.Future(loop=self.loop)
+        envelope_info['trigger'].fire()
 
         return True, call_data.get('reply_data') if immediate_reply else None
 
+    def backend_for(self, event_info: dict):
+        """Internal helper method used to choose the connection to the
+        backend an event is forwarded through.
+
+        :param event_info:
+         the information kept by the front about the event
+
+        :return:
+         the connection dedicated to immediate reply events if the event
+         expects one and that connection is open, the main one otherwise
+        """
+        if event_info['immediate_reply'] and self.backend_fast is not None:
+            return self.backend_fast
+        return self.backend
+
+    @rpc.method
+    def get_admission(self) -> dict:
+        """Report the load of the front, as watched by its admission
+        controller.
+
+        :return:
+         a dict as returned by :meth:`.AdmissionController.snapshot`, empty
+         if admission control is disabled
+        """
+        if self.admission is None:
+            return {}
+        return self.admission.snapshot()
+
+    def queued_items(self) -> int:
+        """Count the items received from the emitters and not forwarded to
+        the backend yet.
+        """
+        return self.limiter.waiting + self.forwarding
+
+    def item_forwarded(self, task):
+        """Internal helper method used to account for an item whose
+        :meth:`backend_send_item` call has finished, whatever its result.
+        """
+        self.forwarding -= 1
+
+    @rpc.method
+    def get_reply_latency(self) -> dict:
+        """Report the time taken to reply to immediate reply events, from
+        the "end_event" call of the emitter to its reply.
+
+        :return:
+         a dict as returned by :meth:`.LatencyHistogram.snapshot`
+        """
+        return self.reply_latency.snapshot()
+
+    @traced('backend_end_envelope')
     @asyncio.coroutine
     def backend_end_envelope(self, envelope_id: str):
         """Forward the end of the envelope to the backend.
@@ -668,21 +1399,25 @@ class XbusBrokerFront(XbusBrokerBase):
         """
         envelope_info = self.envelopes[envelope_id]
         events = envelope_info['events'].values()
+        replayable = all(evt['durability'] != 'none' for evt in events)
         while not all(evt.get('closed', False) for evt in events):
-            trigger_res = yield from envelope_info['trigger']
+            trigger_res = yield from envelope_info['trigger'].wait()
             if trigger_res is False:
+                del self.envelopes[envelope_id]
+                yield from self.park_envelope(envelope_id, replayable)
                 return False
 
         res = yield from self.backend.call.end_envelope(envelope_id)
         if res['success'] is True:
             yield from self.update_envelope_state_exec(envelope_id)
         else:
-            yield from self.update_envelope_state_wait(envelope_id)
+            yield from self.park_envelope(envelope_id, replayable)
             yield from self.disable_backend_forward(envelope_id)
 
         del self.envelopes[envelope_id]
-        return bool(res == 0)
+        return res['success'] is True
 
+    @traced('backend_cancel_envelope')
     @asyncio.coroutine
     def backend_cancel_envelope(self, envelope_id):
         """Forward the cancellation of the envelope to the backend.
@@ -702,6 +1437,34 @@ class XbusBrokerFront(XbusBrokerBase):
         else:
             return False
 
+    @asyncio.coroutine
+    def park_envelope(self, envelope_id: str, replayable: bool=True) -> bool:
+        """Internal helper method used when an envelope could not be
+        forwarded to the backend: it is left waiting for a replay, unless
+        some of its items were not stored (ie: the durability level of one of
+        its events is "none"), in which case it is cancelled.
+
+        :param envelope_id:
+         the UUID of the envelope
+
+        :param replayable:
+         whether all the items of the envelope were stored
+
+        :return:
+         True if the envelope is waiting for a replay, False if it was
+         cancelled
+        """
+        if not replayable:
+            logger.warning(
+                'Cancelling envelope %s: it could not be forwarded and its '
+                'items were not stored', envelope_id
+            )
+            yield from self.update_envelope_state_cancel(envelope_id)
+            return False
+
+        yield from self.update_envelope_state_wait(envelope_id)
+        return True
+
     @asyncio.coroutine
     def disable_backend_forward(self, envelope_id: str) -> bool:
         """Internal helper that adds a flag to the envelope's cached info,
@@ -716,9 +1479,9 @@ class XbusBrokerFront(XbusBrokerBase):
         try:
             envelope_info = self.envelopes[envelope_id]
             envelope_info['forward'] = False
-            envelope_info['trigger'].set_result(False)
+            envelope_info['trigger'].cancel()
             for event_info in envelope_info['events'].values():
-                event_info['trigger'].set_result(False)
+                event_info['trigger'].cancel()
 
         except KeyError:
             return False
@@ -749,6 +1512,28 @@ class XbusBrokerFront(XbusBrokerBase):
             else:
                 return None, None, None
 
+    @asyncio.coroutine
+    def find_profile_weight(self, profile_id: str) -> float:
+        """Internal helper method used to find the scheduling weight of an
+        emitter profile.
+
+        :param profile_id:
+         the UUID of the emitter profile
+
+        :return:
+         the weight of the profile, 1 if it is not found
+        """
+        with (yield from self.dbengine) as conn:
+            query = select((emitter_profile.c.weight,))
+            query = query.where(emitter_profile.c.id == profile_id).limit(1)
+
+            cr = yield from conn.execute(query)
+            row = yield from cr.first()
+            if row:
+                return row[0]
+            else:
+                return 1
+
     @asyncio.coroutine
     def find_event_type_by_name(self, name: str) -> tuple:
         """Internal helper method used to find an event type's id
@@ -757,12 +1542,17 @@ class XbusBrokerFront(XbusBrokerBase):
         :param name:
          the name that identifies the event type you are searching for
 
-        :return: 2-element tuple, with:
+        :return: 4-element tuple, with:
         - The internal ID of the event type object (or None if not found).
         - Whether the event type has the "immediate reply" flag set.
+        - The durability level of the items of the event type.
+        - How the items of the event type are compressed when stored.
         """
         with (yield from self.dbengine) as conn:
-            query = select((event_type.c.id, event_type.c.immediate_reply))
+            query = select((
+                event_type.c.id, event_type.c.immediate_reply,
+                event_type.c.durability, event_type.c.compression
+            ))
             query = query.where(event_type.c.name == name)
             query = query.limit(1)
 
@@ -771,7 +1561,47 @@ class XbusBrokerFront(XbusBrokerBase):
             if row:
                 return row.as_tuple()
             else:
-                return None, None
+                return None, None, None, None
+
+    @asyncio.coroutine
+    def find_allowed_event_types(self, profile_id: str, names: set) -> dict:
+        """Internal helper method used to find, in a single query, the
+        event types an emitter has the right to start among the given names.
+
+        :param profile_id:
+         the internal UUID of the emitter's profile
+
+        :param names:
+         the names of the event types
+
+        :return:
+         a dict mapping the name of each allowed event type to a 4-tuple
+         (internal ID, whether it has the "immediate reply" flag set,
+         durability level, compression)
+        """
+        with (yield from self.dbengine) as conn:
+            query = select((
+                event_type.c.name, event_type.c.id,
+                event_type.c.immediate_reply, event_type.c.durability,
+                event_type.c.compression
+            ))
+            query = query.select_from(
+                event_type.join(
+                    emitter_profile_event_type_rel,
+                    emitter_profile_event_type_rel.c.event_id ==
+                    event_type.c.id
+                )
+            )
+            query = query.where(
+                and_(
+                    emitter_profile_event_type_rel.c.profile_id == profile_id,
+                    event_type.c.name.in_(names)
+                )
+            )
+
+            cr = yield from conn.execute(query)
+            rows = yield from cr.fetchall()
+            return {row[0]: row.as_tuple()[1:] for row in rows}
 
     @asyncio.coroutine
     def check_event_access(self, profile_id: str, type_id: str) -> bool:
@@ -805,6 +1635,7 @@ class XbusBrokerFront(XbusBrokerBase):
             res = yield from cr.first()
             return True if res[0] > 0 else False
 
+    @traced('log_new_envelope')
     @asyncio.coroutine
     def log_new_envelope(self, envelope_id: str, emitter_id: str):
         """Internal helper method used to log the creation of a new envelope.
@@ -838,6 +1669,23 @@ class XbusBrokerFront(XbusBrokerBase):
             update = update.values(state='exec')
             yield from conn.execute(update)
 
+    @asyncio.coroutine
+    def update_envelopes_state(self, envelope_ids: list, state: str):
+        """Internal helper method used to log the state of several envelopes
+        at once.
+
+        :param envelope_ids:
+         the UUIDs of the envelopes
+
+        :param state:
+         the new state of the envelopes
+        """
+        with (yield from self.dbengine) as conn:
+            update = envelope.update()
+            update = update.where(envelope.c.id.in_(envelope_ids))
+            update = update.values(state=state)
+            yield from conn.execute(update)
+
     @asyncio.coroutine
     def update_envelope_state_wait(self, envelope_id: str):
         """Internal helper method used to log the fact that an envelope has
@@ -867,6 +1715,7 @@ class XbusBrokerFront(XbusBrokerBase):
             update = update.values(state='canc')
             yield from conn.execute(update)
 
+    @traced('log_new_event')
     @asyncio.coroutine
     def log_new_event(self, event_id: str, envelope_id: str, emitter_id: str,
                       type_id: str, estimate: int):
@@ -914,8 +1763,77 @@ class XbusBrokerFront(XbusBrokerBase):
             update = update.values(sent_items=sent_items)
             yield from conn.execute(update)
 
+    @traced('log_complete_envelope')
     @asyncio.coroutine
-    def log_sent_item(self, event_id: str, index: int, data: bytes):
+    def log_complete_envelope(
+        self, envelope_id: str, emitter_id: str, events: list
+    ):
+        """Internal helper method used to log a complete envelope, with its
+        events and items, in a single transaction.
+
+        :param envelope_id:
+         the UUID of the new envelope
+
+        :param emitter_id:
+         the internal UUID of the emitter of the new envelope
+
+        :param events:
+         a list of (event ID, type ID, type name, items, immediate reply,
+         estimate, durability, compression) tuples; the items of the events
+         whose durability level is "none" are not logged
+        """
+        rows = [
+            {'event_id': event_id, 'index': index, 'data': data}
+            for event_id, type_id, name, items, reply, estimate,
+            durability, compression in events if durability != 'none'
+            for index, data in enumerate(items)
+        ]
+        compressions = {
+            event_row[0]: event_row[7] for event_row in events
+            if event_row[7] != 'none'
+        }
+        if rows and compressions:
+            yield from self.loop.run_in_executor(
+                None, compress_rows, rows, compressions
+            )
+
+        with (yield from self.dbengine) as conn:
+            tr = yield from conn.begin()
+            try:
+                insert = envelope.insert()
+                insert = insert.values(
+                    id=envelope_id, state='emit', emitter_id=emitter_id,
+                    posted_date=func.localtimestamp()
+                )
+                yield from conn.execute(insert)
+
+                insert = event.insert()
+                insert = insert.values([
+                    {
+                        'id': event_id, 'envelope_id': envelope_id,
+                        'emitter_id': emitter_id, 'type_id': type_id,
+                        'estimated_items': estimate,
+                        'sent_items': len(items), 'state': 'unprocessed',
+                    }
+                    for event_id, type_id, name, items, reply, estimate, _, _
+                    in events
+                ])
+                yield from conn.execute(insert)
+
+                if rows:
+                    yield from conn.execute(item.insert().values(rows))
+
+            except Exception:
+                yield from tr.rollback()
+                raise
+
+            else:
+                yield from tr.commit()
+
+    @asyncio.coroutine
+    def log_sent_item(
+        self, event_id: str, index: int, data: bytes, compression: str='none'
+    ):
         """Internal helper method used to preserve the data of each item
         received from the emitter.
 
@@ -927,7 +1845,14 @@ class XbusBrokerFront(XbusBrokerBase):
 
         :param data:
          the item's data payload.
+
+        :param compression:
+         how the item is compressed, see :func:`.compress`
         """
+        if compression != 'none':
+            data = yield from self.loop.run_in_executor(
+                None, compress, data, compression
+            )
         with (yield from self.dbengine) as conn:
             insert = item.insert()
             insert = insert.values(event_id=event_id, index=index, data=data)
@@ -943,7 +1868,7 @@ class XbusBrokerFront2Back(rpc.AttrHandler):
 
     @rpc.method
     @asyncio.coroutine
-    def register_backend(self, uri):
+    def register_backend(self, uri, data_uri=None):
         """Register a backend on the frontend by giving its URI. If the
         operation goes well returns True. Else return False
 
@@ -951,21 +1876,43 @@ class XbusBrokerFront2Back(rpc.AttrHandler):
          the URI where the backend is exposing his own 0mq socket configured as
          a router.
 
+        :param data_uri:
+         the URI of the data plane of the backend, if enabled (see
+         :class:`.DataPlaneReceiver`)
+
+        A backend registering itself replaces the previous one (ie: after
+        a restart of the backend), and every envelope that is waiting for a
+        backend is then replayed.
+
         :return:
            - True: if your backend is correctly registered
-           - False: if your backend is not properly registered (ie: another
-             backend is already registered on this frontend...)
+           - False: if your backend is not properly registered
         """
-        if self.broker.backend is not None:
-            return False
+        previous = self.broker.backend
+        previous_fast = self.broker.backend_fast
+
+        # set the backend client on the broker
+        self.broker.backend = yield from self.broker.tuning.connect_rpc(uri)
+        # and a second one, so that immediate reply events do not queue
+        # behind bulk events
+        self.broker.backend_fast = yield from self.broker.tuning.connect_rpc(
+            uri
+        )
+        for client in (previous, previous_fast):
+            if client is not None:
+                client.close()
+
+        data_plane = self.broker.data_plane
+        if data_plane is not None:
+            if data_uri:
+                yield from data_plane.connect(data_uri)
+            else:
+                data_plane.close()
 
-        else:
-            # set the backend client on the broker
-            self.broker.backend = True
-            self.broker.backend = yield from aiozmq.rpc.connect_rpc(
-                connect=uri
-            )
-            return True
+        asyncio.async(
+            self.broker.replayer.replay_waiting(), loop=self.broker.loop
+        )
+        return True
 
 
 @asyncio.coroutine
@@ -996,25 +1943,97 @@ def get_frontserver(engine_callback, config, socket, b2fsocket, loop=None):
      a future that is waiting for a wait_closed() call before being
      fired back.
     """
+    tuning = get_socket_tuning(config)
     dbengine = yield from engine_callback(config)
     broker = XbusBrokerFront(dbengine, loop=loop)
+    broker.tuning = tuning
 
     redis_host = config.get('redis', 'host')
     redis_port = config.getint('redis', 'port')
     yield from broker.prepare_redis(redis_host, redis_port)
 
-    frontzmqserver = yield from rpc.serve_rpc(
+    broker.replayer = EnvelopeReplayer(
         broker,
-        bind=socket,
-        loop=loop
+        concurrency=config.getint('replay', 'concurrency', fallback=4),
+        batch_size=config.getint('replay', 'batch_size', fallback=500),
+        window=config.getint('replay', 'window', fallback=4),
+        interval=config.getfloat('replay', 'interval', fallback=30),
+        loop=loop,
     )
+    broker.replayer.start()
+    broker.item_writer = ItemWriter(
+        broker,
+        max_rows=config.getint('durability', 'max_rows', fallback=1000),
+        interval=config.getfloat('durability', 'interval', fallback=0.05),
+        loop=loop,
+    )
+    dsn = config.get('database', 'sqlalchemy.dburi')
+    if (
+        config.getboolean('durability', 'copy', fallback=True) and
+        ItemCopier.supports(dsn)
+    ):
+        broker.item_writer.copier = ItemCopier(dsn, loop=loop)
+    broker.batcher = EnvelopeBatcher(
+        broker,
+        max_items=config.getint('batch', 'max_items', fallback=0),
+        max_envelopes=config.getint('batch', 'max_envelopes', fallback=100),
+        linger=config.getfloat('batch', 'linger', fallback=0.005),
+        loop=loop,
+    )
+    broker.limiter = PriorityLimiter(
+        limit=config.getint('scheduler', 'max_in_flight', fallback=64),
+        reserved=config.getint('scheduler', 'reserved', fallback=8),
+        loop=loop,
+    )
+    broker.tenant_by = config.get('scheduler', 'tenant', fallback='profile')
+    if config.getboolean('quota', 'enabled', fallback=True):
+        broker.quotas = QuotaManager(
+            broker,
+            burst=config.getfloat('quota', 'burst', fallback=1.0),
+            refresh=config.getfloat('quota', 'refresh', fallback=60),
+            envelope_ttl=config.getfloat(
+                'quota', 'envelope_ttl', fallback=3600
+            ),
+            loop=loop,
+        )
+    broker.admission = get_admission_controller(broker, config, loop=loop)
+    yield from broker.setup_metrics(config)
+    setup_tracing(config, loop=loop)
+    broker.blobs = get_blob_store(config, loop=loop)
+    if config.getboolean('data_plane', 'enabled', fallback=False):
+        broker.data_plane = DataPlaneSender(
+            broker,
+            window=config.getint('data_plane', 'window', fallback=1000),
+            loop=loop,
+        )
+
+    if config.getboolean('front', 'sessions', fallback=False):
+        # Bind the emitters' sessions to their connections.
+        broker.sessions.ttl = config.getfloat(
+            'front', 'session_ttl', fallback=3600
+        )
+        frontzmqserver = yield from serve_peer_rpc(
+            broker,
+            bind=socket,
+            loop=loop,
+            tuning=broker.tuning,
+            metrics=broker.rpc_metrics
+        )
+    else:
+        frontzmqserver = yield from broker.tuning.serve_rpc(
+            broker,
+            bind=socket,
+            loop=loop,
+            metrics=broker.rpc_metrics
+        )
 
     # prepare the socket we use to communicate between front and backend
     front2back = XbusBrokerFront2Back(broker)
-    front_from_back_zqm = yield from rpc.serve_rpc(
+    front_from_back_zqm = yield from broker.tuning.serve_rpc(
         front2back,
         bind=b2fsocket,
         loop=loop,
+        metrics=broker.rpc_metrics,
     )
 
     coroutines = [
@@ -0,0 +1,120 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import time
+
+
+class Session(object):
+    """The emitter session bound to a 0mq connection.
+    """
+
+    def __init__(self, token: str, info: dict):
+        """
+        :param token:
+         the token returned to the emitter by the login call
+
+        :param info:
+         the emitter information saved with the token
+        """
+        self.token = token
+        self.info = info
+        # When the token was last checked in Redis.
+        self.last_seen = time.monotonic()
+
+
+class SessionStore(object):
+    """A SessionStore keeps in memory the sessions of the emitters, by the
+    routing identity of their 0mq connection, so that their token does not
+    have to be looked up in Redis at each call.
+
+    0mq does not report which peer went away, so a session is forgotten
+    when its emitter logs out or `ttl` seconds after it was bound; the token
+    is then looked up in Redis again at the next call. The token itself
+    remains valid in Redis until logout.
+    """
+
+    def __init__(self, ttl: float=3600):
+        """
+        :param ttl:
+         the number of seconds after which a session is forgotten
+        """
+        self.ttl = ttl
+        self.sessions = {}
+        # {token: set of peers}
+        self.peers = {}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def bind(self, peer: bytes, token: str, info: dict):
+        """Bind a session to a connection, replacing any previous one.
+
+        :param peer:
+         the routing identity of the connection
+
+        :param token:
+         the token returned to the emitter
+
+        :param info:
+         the emitter information saved with the token
+        """
+        self.purge()
+        self.drop(peer)
+        self.sessions[peer] = Session(token, info)
+        self.peers.setdefault(token, set()).add(peer)
+
+    def get(self, peer: bytes, token: str) -> dict:
+        """Find the emitter information of a connection.
+
+        :param peer:
+         the routing identity of the connection
+
+        :param token:
+         the token given by the emitter, which must be the one of the session
+
+        :return:
+         the emitter information, or None if the connection has no session
+         for this token or if the session has expired
+        """
+        session = self.sessions.get(peer)
+        if session is None or session.token != token:
+            return None
+        if session.last_seen + self.ttl < time.monotonic():
+            self.drop(peer)
+            return None
+        return session.info
+
+    def drop(self, peer: bytes):
+        """Forget the session of a connection.
+
+        :param peer:
+         the routing identity of the connection
+        """
+        session = self.sessions.pop(peer, None)
+        if session is None:
+            return
+        peers = self.peers.get(session.token)
+        if peers is not None:
+            peers.discard(peer)
+            if not peers:
+                del self.peers[session.token]
+
+    def drop_token(self, token: str):
+        """Forget the sessions of every connection that uses a token.
+
+        :param token:
+         the token of the sessions
+        """
+        for peer in self.peers.pop(token, ()):
+            self.sessions.pop(peer, None)
+
+    def purge(self):
+        """Forget the sessions that have expired.
+        """
+        limit = time.monotonic() - self.ttl
+        expired = [
+            peer for peer, session in self.sessions.items()
+            if session.last_seen < limit
+        ]
+        for peer in expired:
+            self.drop(peer)
@@ -0,0 +1,154 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import logging
+
+from xbus.broker.model import item
+from xbus.broker.model.compression import compress_rows
+
+logger = logging.getLogger(__name__)
+
+
+class ItemWriter(object):
+    """An ItemWriter persists the items of the events whose type uses the
+    "group" durability level. The items are acknowledged to the emitter
+    right away, and written in the background with multi-row inserts.
+
+    The items of an event are guaranteed to be written once :meth:`flush`
+    returns True, which the front checks before closing the event.
+
+    When the database is PostgreSQL, the batches are written with the COPY
+    command by an :class:`.ItemCopier` instead.
+
+    The items of the events whose type has a compression are compressed in
+    a worker thread before being written.
+    """
+
+    def __init__(
+        self, broker, max_rows: int=1000, interval: float=0.05, loop=None
+    ):
+        """Create a new item writer.
+
+        :param broker:
+         the :class:`.XbusBrokerFront` instance whose database is used
+
+        :param max_rows:
+         the number of pending items above which they are written at once
+
+        :param interval:
+         the period of time in seconds a pending item may wait for others
+
+        :param loop:
+         the event loop used by the frontend
+        """
+        self.broker = broker
+        self.max_rows = max_rows
+        self.interval = interval
+        self.loop = loop
+        # Set up by get_frontserver when the database supports COPY.
+        self.copier = None
+
+        self.rows = []
+        # Compression of the events of the pending items, when not "none".
+        self.compressions = {}
+        self.timer = None
+        self.writing = set()
+        # Events some items of which could not be written.
+        self.failed = set()
+
+    def write(
+        self, event_id: str, index: int, data: bytes, compression: str='none'
+    ):
+        """Queue an item to be written.
+
+        :param event_id:
+         the UUID of the event
+
+        :param index:
+         the position of the item in the event
+
+        :param data:
+         the item's data payload
+
+        :param compression:
+         how the item is compressed, see :func:`.compress`
+        """
+        self.rows.append({'event_id': event_id, 'index': index, 'data': data})
+        if compression != 'none':
+            self.compressions[event_id] = compression
+        if len(self.rows) >= self.max_rows:
+            self.start()
+        elif self.timer is None:
+            self.timer = self.loop.call_later(self.interval, self.start)
+
+    def start(self):
+        """Start writing the pending items in the background.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        rows, self.rows = self.rows, []
+        compressions, self.compressions = self.compressions, {}
+        if rows:
+            task = asyncio.async(
+                self.insert(rows, compressions), loop=self.loop
+            )
+            self.writing.add(task)
+            task.add_done_callback(self.writing.discard)
+
+    @asyncio.coroutine
+    def flush(self, event_id: str) -> bool:
+        """Write the pending items and wait for all the items queued so far
+        to be written.
+
+        :param event_id:
+         the UUID of the event whose items must have been written
+
+        :return:
+         True if successful, False if some items of the event could not be
+         written
+        """
+        self.start()
+        if self.writing:
+            yield from asyncio.wait(list(self.writing), loop=self.loop)
+
+        if event_id in self.failed:
+            self.failed.discard(event_id)
+            return False
+        return True
+
+    @asyncio.coroutine
+    def cancel(self, event_id: str):
+        """Forget the items of a cancelled event: those still pending are
+        not written, and the failure to write the others is not kept.
+
+        :param event_id:
+         the UUID of the event
+        """
+        self.rows = [row for row in self.rows if row['event_id'] != event_id]
+        self.compressions.pop(event_id, None)
+        if self.writing:
+            yield from asyncio.wait(list(self.writing), loop=self.loop)
+        self.failed.discard(event_id)
+
+    @asyncio.coroutine
+    def insert(self, rows: list, compressions: dict=None) -> bool:
+        """Internal helper method used to write a batch of items.
+        """
+        try:
+            if compressions:
+                yield from self.loop.run_in_executor(
+                    None, compress_rows, rows, compressions
+                )
+            if self.copier is not None:
+                yield from self.copier.copy(rows)
+            else:
+                with (yield from self.broker.dbengine) as conn:
+                    yield from conn.execute(item.insert().values(rows))
+        except Exception:
+            logger.exception('Could not write %d items', len(rows))
+            self.failed.update(row['event_id'] for row in rows)
+            return False
+        return True
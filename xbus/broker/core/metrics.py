@@ -0,0 +1,492 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+from bisect import bisect_left
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency buckets: from 0.5ms to 60s.
+DEFAULT_LATENCY_BOUNDS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60,
+)
+
+
+class LatencyHistogram(object):
+    """A LatencyHistogram counts durations into fixed buckets, which is
+    cheap enough to be done for every call and gives the percentiles of the
+    latency with the precision of the buckets.
+    """
+
+    def __init__(self, bounds: tuple=DEFAULT_LATENCY_BOUNDS):
+        """
+        :param bounds:
+         the sorted upper bounds of the buckets, in seconds; durations above
+         the last bound are counted in an extra bucket
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, duration: float):
+        """Count a duration.
+
+        :param duration:
+         the duration in seconds
+        """
+        self.counts[bisect_left(self.bounds, duration)] += 1
+        self.count += 1
+        self.sum += duration
+
+    def percentile(self, q: float) -> float:
+        """Estimate a percentile of the durations.
+
+        :param q:
+         the percentile, between 0 and 100
+
+        :return:
+         the upper bound of the bucket holding the percentile, infinity if it
+         is above the last bound, or None if nothing was counted
+        """
+        if not self.count:
+            return None
+        rank = self.count * q / 100
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self) -> dict:
+        """Report the state of the histogram.
+
+        :return:
+         a dict with the number and total of the durations, their 50th, 99th
+         and 99.9th percentiles, and the count of each bucket
+        """
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+            'buckets': list(zip(self.bounds + (float('inf'),), self.counts)),
+        }
+
+
+class CounterValue(object):
+    """The value of a counter for one set of labels. It is meant to be
+    looked up once, with :meth:`Metric.labels`, and kept by the code which
+    updates it.
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float=1):
+        self.value += amount
+
+
+class GaugeValue(CounterValue):
+    """The value of a gauge for one set of labels.
+    """
+
+    __slots__ = ()
+
+    def dec(self, amount: float=1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Metric(object):
+    """A named metric, with one value per set of labels. The broker runs in
+    a single thread, so the values are updated without any lock.
+    """
+
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple=()):
+        """
+        :param name:
+         the name of the metric, in the Prometheus format
+
+        :param documentation:
+         what the metric measures
+
+        :param labelnames:
+         the names of the labels of the metric
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # {label values: value}
+        self.values = {}
+
+    def labels(self, *labelvalues):
+        """Find the value of the metric for the given labels, creating it if
+        needed.
+        """
+        value = self.values.get(labelvalues)
+        if value is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError('Expected labels: {}'.format(
+                    ', '.join(self.labelnames)
+                ))
+            value = self.values[labelvalues] = self.new_value()
+        return value
+
+    def new_value(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """The samples of the metric: (name, {label: value}, value) tuples.
+        """
+        for labelvalues, value in sorted(self.values.items()):
+            labels = dict(zip(self.labelnames, labelvalues))
+            yield self.name, labels, value.value
+
+
+class Counter(Metric):
+    """A value which only goes up.
+    """
+
+    type = 'counter'
+
+    def new_value(self):
+        return CounterValue()
+
+
+class Gauge(Metric):
+    """A value which goes up and down. Its values may also be computed when
+    the metrics are collected, by callbacks returning {label values:
+    value}, for the values which are cheaper to compute on demand than to
+    keep up to date.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple=()):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.collectors = []
+
+    def new_value(self):
+        return GaugeValue()
+
+    def samples(self):
+        values = {
+            labelvalues: value.value
+            for labelvalues, value in self.values.items()
+        }
+        for collect in self.collectors:
+            values.update(collect())
+        for labelvalues, value in sorted(values.items()):
+            labels = dict(zip(self.labelnames, labelvalues))
+            yield self.name, labels, value
+
+
+class Histogram(Metric):
+    """Durations counted into buckets, one :class:`LatencyHistogram` per
+    set of labels.
+    """
+
+    type = 'histogram'
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: tuple=(),
+        bounds: tuple=DEFAULT_LATENCY_BOUNDS
+    ):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.bounds = bounds
+
+    def new_value(self):
+        return LatencyHistogram(self.bounds)
+
+    def attach(self, histogram: LatencyHistogram, *labelvalues):
+        """Expose an existing histogram as the value for the given labels.
+        """
+        self.values[labelvalues] = histogram
+
+    def samples(self):
+        for labelvalues, histogram in sorted(self.values.items()):
+            labels = dict(zip(self.labelnames, labelvalues))
+            seen = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                seen += count
+                yield self.name + '_bucket', dict(labels, le=bound), seen
+            buckets = dict(labels, le='+Inf')
+            yield self.name + '_bucket', buckets, histogram.count
+            yield self.name + '_sum', labels, histogram.sum
+            yield self.name + '_count', labels, histogram.count
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n'
+    )
+
+
+class MetricsRegistry(object):
+    """The metrics of the broker, rendered in the Prometheus text format by
+    :meth:`render`.
+
+    The front and the backend may run in the same process: asking twice
+    for the same metric returns the same instance, so they share it, with
+    their own labels.
+    """
+
+    def __init__(self):
+        # {name: Metric instance}
+        self.metrics = {}
+        self.exporter = None
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric, unless there is already one with the same name.
+
+        :return:
+         the registered metric
+
+        :raises ValueError:
+         if another kind of metric is registered under that name
+        """
+        existing = self.metrics.get(metric.name)
+        if existing is None:
+            self.metrics[metric.name] = metric
+            return metric
+        if type(existing) is not type(metric):
+            raise ValueError('Metric {} already registered as a {}'.format(
+                metric.name, existing.type
+            ))
+        return existing
+
+    def counter(self, name: str, documentation: str, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames=(),
+              collect=None):
+        gauge = self.register(Gauge(name, documentation, labelnames))
+        if collect is not None:
+            gauge.collectors.append(collect)
+        return gauge
+
+    def histogram(self, name: str, documentation: str, labelnames=(),
+                  bounds: tuple=DEFAULT_LATENCY_BOUNDS):
+        return self.register(
+            Histogram(name, documentation, labelnames, bounds)
+        )
+
+    def render(self) -> str:
+        """Render the metrics in the Prometheus text format.
+        """
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append('# HELP {} {}'.format(
+                name, metric.documentation.replace('\n', ' ')
+            ))
+            lines.append('# TYPE {} {}'.format(name, metric.type))
+            try:
+                samples = list(metric.samples())
+            except Exception:
+                logger.exception('Could not collect the metric %s', name)
+                continue
+            for sample_name, labels, value in samples:
+                if labels:
+                    sample_name += '{' + ','.join(
+                        '{}="{}"'.format(key, _escape(labels[key]))
+                        for key in sorted(labels)
+                    ) + '}'
+                lines.append('{} {}'.format(sample_name, float(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+# The metrics of the broker process.
+REGISTRY = MetricsRegistry()
+
+
+class RPCMetrics(object):
+    """The number, errors and latency of the calls to the RPC methods of
+    the front or the backend, see :class:`.ServerProtocol`.
+    """
+
+    def __init__(self, component: str, registry: MetricsRegistry=REGISTRY):
+        """
+        :param component:
+         'front' or 'back'
+        """
+        self.component = component
+        self.calls = registry.counter(
+            'xbus_rpc_calls_total', 'RPC calls received',
+            ('component', 'method'),
+        )
+        self.errors = registry.counter(
+            'xbus_rpc_errors_total', 'RPC calls which raised an error',
+            ('component', 'method'),
+        )
+        self.latency = registry.histogram(
+            'xbus_rpc_latency_seconds', 'Time taken to serve RPC calls',
+            ('component', 'method'),
+        )
+        # The values of each method, looked up once:
+        # {method: (calls, errors, latency)}
+        self.methods = {}
+
+    def method(self, name: str) -> tuple:
+        """Find the values of the metrics of an RPC method.
+        """
+        values = self.methods.get(name)
+        if values is None:
+            labels = (self.component, name)
+            values = self.methods[name] = (
+                self.calls.labels(*labels), self.errors.labels(*labels),
+                self.latency.labels(*labels),
+            )
+        return values
+
+
+class MeteredConnection(object):
+    """Wraps an aiopg.sa connection to measure the time taken by its
+    queries.
+    """
+
+    def __init__(self, conn, histogram: LatencyHistogram):
+        self._conn = conn
+        self._histogram = histogram
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    @asyncio.coroutine
+    def execute(self, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            res = yield from self._conn.execute(*args, **kwargs)
+        finally:
+            self._histogram.observe(time.monotonic() - start)
+        return res
+
+    @asyncio.coroutine
+    def scalar(self, *args, **kwargs):
+        res = yield from self.execute(*args, **kwargs)
+        res = yield from res.scalar()
+        return res
+
+
+class _MeteredContext(object):
+
+    def __init__(self, context, histogram: LatencyHistogram):
+        self.context = context
+        self.histogram = histogram
+
+    def __enter__(self):
+        return MeteredConnection(self.context.__enter__(), self.histogram)
+
+    def __exit__(self, *exc_info):
+        return self.context.__exit__(*exc_info)
+
+
+class MeteredEngine(object):
+    """Wraps an aiopg.sa engine so that the connections it gives with
+    `with (yield from engine) as conn:` measure the time taken by their
+    queries.
+    """
+
+    def __init__(self, engine, histogram: LatencyHistogram):
+        self._engine = engine
+        self._histogram = histogram
+
+    def __getattr__(self, name):
+        return getattr(self._engine, name)
+
+    def __iter__(self):
+        context = yield from self._engine
+        return _MeteredContext(context, self._histogram)
+
+
+class MetricsExporter(object):
+    """Serves the metrics of a registry over HTTP, on GET /metrics.
+    """
+
+    def __init__(self, registry: MetricsRegistry, loop=None):
+        self.registry = registry
+        self.loop = loop
+        self.server = None
+
+    @asyncio.coroutine
+    def start(self, host: str, port: int):
+        self.server = yield from asyncio.start_server(
+            self.handle, host, port, loop=self.loop
+        )
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+    @asyncio.coroutine
+    def handle(self, reader, writer):
+        """Internal helper method used to answer an HTTP request.
+        """
+        try:
+            request = yield from reader.readline()
+            while True:
+                line = yield from reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request.split()
+            if (
+                len(parts) >= 2 and parts[0] == b'GET' and
+                parts[1].split(b'?')[0] in (b'/', b'/metrics')
+            ):
+                status = '200 OK'
+                body = self.registry.render().encode('utf-8')
+            else:
+                status = '404 Not Found'
+                body = b'Not Found\n'
+            writer.write(
+                'HTTP/1.0 {}\r\n'
+                'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                'Content-Length: {}\r\n\r\n'.format(
+                    status, len(body)
+                ).encode('ascii') + body
+            )
+            yield from writer.drain()
+        except Exception:
+            logger.exception('Could not serve the metrics')
+        finally:
+            writer.close()
+
+
+@asyncio.coroutine
+def start_metrics_exporter(config, loop=None):
+    """A helper function that is used internally to serve the metrics of the
+    process from the `metrics` section of the configuration. The front and
+    the backend both call it; the exporter is only started once.
+
+    :param config:
+     the application configuration instance
+     :class:`configparser.ConfigParser`
+
+    :param loop:
+     the event loop used by the broker
+
+    :return:
+     the :class:`MetricsExporter`, or None if the exporter is disabled
+    """
+    if not config.getboolean('metrics', 'enabled', fallback=False):
+        return None
+    if REGISTRY.exporter is None:
+        REGISTRY.exporter = MetricsExporter(REGISTRY, loop=loop)
+        yield from REGISTRY.exporter.start(
+            config.get('metrics', 'host', fallback='127.0.0.1'),
+            config.getint('metrics', 'port', fallback=9184),
+        )
+    return REGISTRY.exporter
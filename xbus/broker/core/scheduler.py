@@ -0,0 +1,209 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+from collections import deque
+
+
+class _Slot(object):
+    """Context manager releasing a slot of a :class:`PriorityLimiter`.
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        self.limiter.release()
+
+
+class DeficitRoundRobin(object):
+    """A DeficitRoundRobin holds a queue per tenant (ie: per emitter profile
+    or per emitter) and pops from them in turn, each tenant being served a
+    number of times proportional to its weight, so that a tenant with a lot
+    of pending work does not delay the others.
+
+    Every call costs 1: at each turn, a tenant is granted its weight and may
+    be served as long as its deficit covers the cost. The deficit of a tenant
+    whose queue runs empty is reset.
+    """
+
+    def __init__(self):
+        # {tenant: deque of items}
+        self.queues = {}
+        # {tenant: weight}
+        self.weights = {}
+        # {tenant: number of calls the tenant may still be served}
+        self.deficits = {}
+        # Tenants with pending items, the one being served first.
+        self.active = deque()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, tenant, weight: float, item):
+        """Queue an item.
+
+        :param tenant:
+         the identifier of the tenant the item belongs to
+
+        :param weight:
+         the share of the tenant, relative to the other tenants
+
+        :param item:
+         the queued item
+        """
+        queue = self.queues.get(tenant)
+        if queue is None:
+            queue = self.queues[tenant] = deque()
+            self.deficits[tenant] = 0
+            self.active.append(tenant)
+        self.weights[tenant] = max(weight, 0.01)
+        queue.append(item)
+        self.size += 1
+
+    def pop(self):
+        """Pop the next item.
+
+        :raises IndexError:
+         if no item is queued
+        """
+        while self.active:
+            tenant = self.active[0]
+            queue = self.queues[tenant]
+            if self.deficits[tenant] >= 1:
+                self.deficits[tenant] -= 1
+                self.size -= 1
+                item = queue.popleft()
+                if not queue:
+                    self.active.popleft()
+                    del self.queues[tenant]
+                    del self.deficits[tenant]
+                    del self.weights[tenant]
+                return item
+            # The tenant has had its share for this turn.
+            self.active.rotate(-1)
+            self.deficits[tenant] += self.weights[tenant]
+        raise IndexError('pop from an empty DeficitRoundRobin')
+
+    def remove(self, tenant, item) -> bool:
+        """Remove a queued item.
+
+        :return:
+         True if the item was queued, False otherwise
+        """
+        queue = self.queues.get(tenant)
+        if queue is None or item not in queue:
+            return False
+        queue.remove(item)
+        self.size -= 1
+        if not queue:
+            self.active.remove(tenant)
+            del self.queues[tenant]
+            del self.deficits[tenant]
+            del self.weights[tenant]
+        return True
+
+
+class PriorityLimiter(object):
+    """A PriorityLimiter bounds the number of calls in flight, like a
+    semaphore, while serving urgent calls (ie: the ones of immediate reply
+    events) ahead of bulk ones.
+
+    A released slot is always given to an urgent call first. Moreover,
+    `reserved` slots can only be taken by urgent calls, so that they do not
+    have to wait for a bulk call to finish when the limiter is saturated.
+
+    Bulk calls are served fairly among their tenants, according to their
+    weights (see :class:`DeficitRoundRobin`).
+
+    Usage::
+
+        with (yield from limiter.acquire(urgent)):
+            yield from call()
+    """
+
+    def __init__(self, limit: int=64, reserved: int=8, loop=None):
+        """
+        :param limit:
+         the maximum number of calls in flight
+
+        :param reserved:
+         the number of slots only available to urgent calls
+
+        :param loop:
+         the event loop used by the broker
+        """
+        self.limit = limit
+        self.reserved = min(reserved, limit - 1)
+        self.loop = loop
+        self.in_use = 0
+        self.urgent_waiters = deque()
+        self.bulk_waiters = DeficitRoundRobin()
+
+    @property
+    def waiting(self) -> int:
+        """The number of calls waiting for a slot.
+        """
+        return len(self.urgent_waiters) + len(self.bulk_waiters)
+
+    def available(self, urgent: bool) -> bool:
+        """Tell whether a call could take a slot right now.
+        """
+        if urgent:
+            return self.in_use < self.limit
+        return self.in_use < self.limit - self.reserved
+
+    @asyncio.coroutine
+    def acquire(self, urgent: bool=False, tenant=None, weight: float=1):
+        """Wait for a slot.
+
+        :param urgent:
+         whether the call must be served ahead of bulk calls
+
+        :param tenant:
+         the identifier of the tenant of a bulk call
+
+        :param weight:
+         the share of the tenant, relative to the other tenants
+
+        :return:
+         a context manager releasing the slot
+        """
+        waiters = self.urgent_waiters if urgent else self.bulk_waiters
+        if waiters or not self.available(urgent):
+            waiter = asyncio.Future(loop=self.loop)
+            if urgent:
+                waiters.append(waiter)
+            else:
+                waiters.push(tenant, weight, waiter)
+            try:
+                yield from waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # The slot was given to us, hand it over.
+                    self.release()
+                elif urgent and waiter in waiters:
+                    waiters.remove(waiter)
+                elif not urgent:
+                    waiters.remove(tenant, waiter)
+                raise
+        else:
+            self.in_use += 1
+        return _Slot(self)
+
+    def release(self):
+        """Release a slot, giving it to the next waiting call if any.
+        """
+        self.in_use -= 1
+        for urgent, waiters in (
+            (True, self.urgent_waiters), (False, self.bulk_waiters)
+        ):
+            while waiters and self.available(urgent):
+                waiter = waiters.popleft() if urgent else waiters.pop()
+                if not waiter.done():
+                    self.in_use += 1
+                    waiter.set_result(None)
@@ -0,0 +1,382 @@
+# -*- encoding: utf-8 -*-
+"""Tracing of the envelopes through the stages of the front and the backend.
+
+The coroutines decorated with :func:`traced` record a span for each of
+their calls: the stage they implement, the envelope and event it concerns,
+and when it started and ended. The spans are sampled by envelope, so that an
+envelope is either traced in all the stages of the front and the backend or
+not at all, and only the most recent ones are kept, in a fixed-size ring
+buffer. They can be exported to a local file, as JSON lines or in the JSON
+encoding of OTLP (OpenTelemetry protocol).
+"""
+__author__ = 'jgavrel'
+
+import asyncio
+from collections import deque
+from collections import namedtuple
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import random
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('json', 'otlp')
+
+
+class Span(namedtuple('Span', (
+    'stage', 'component', 'envelope_id', 'event_id', 'start', 'end', 'error',
+))):
+    """A call to a stage: the start and end times are in seconds since the
+    epoch; the error is the name of the exception it raised, if any.
+    """
+
+    __slots__ = ()
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    def as_dict(self) -> dict:
+        res = self._asdict()
+        res['duration'] = self.duration
+        return res
+
+
+class Tracer(object):
+    """Keeps the spans of the sampled envelopes.
+    """
+
+    def __init__(
+        self, size: int=10000, sample_rate: float=0.0, loop=None
+    ):
+        """
+        :param size:
+         the number of spans kept; the oldest ones are dropped first
+
+        :param sample_rate:
+         the share of the envelopes which are traced, from 0 (tracing is
+         disabled) to 1
+
+        :param loop:
+         the event loop used to export the spans periodically
+        """
+        self.sample_rate = sample_rate
+        self.spans = deque(maxlen=size)
+        self.loop = loop
+        self.task = None
+        # The number of spans recorded and exported so far.
+        self.recorded = 0
+        self.exported = 0
+
+    def resize(self, size: int):
+        """Change the number of spans kept, keeping the most recent ones.
+        """
+        self.spans = deque(self.spans, maxlen=size)
+
+    def sampled(self, envelope_id: str) -> bool:
+        """Tell whether an envelope is traced. The choice only depends on the
+        envelope ID, so that the front and the backend make the same one.
+        """
+        if self.sample_rate >= 1:
+            return True
+        checksum = zlib.crc32(envelope_id.encode())
+        return checksum < self.sample_rate * 0x100000000
+
+    def record(self, span: Span):
+        """Keep a span, dropping the oldest one if the buffer is full.
+        """
+        self.spans.append(span)
+        self.recorded += 1
+
+    def trace(self, envelope_id: str) -> list:
+        """Find the spans of an envelope which are still kept.
+
+        :return:
+         the :class:`Span` instances, sorted by start time
+        """
+        return sorted(
+            (span for span in self.spans if span.envelope_id == envelope_id),
+            key=lambda span: span.start
+        )
+
+    def breakdown(self, envelope_id: str) -> dict:
+        """Report where the time of an envelope went.
+
+        :return:
+         a dict with the start, end and duration of the envelope, the
+         number of calls and time spent in each stage, in the order the
+         stages were entered, and the spans themselves; empty if no span
+         of the envelope is kept
+        """
+        spans = self.trace(envelope_id)
+        if not spans:
+            return {}
+        stages = {}
+        for span in spans:
+            key = span.component, span.stage
+            stage = stages.get(key)
+            if stage is None:
+                stage = stages[key] = {
+                    'component': span.component,
+                    'stage': span.stage,
+                    'first': span.start,
+                    'calls': 0,
+                    'errors': 0,
+                    'total': 0.0,
+                    'max': 0.0,
+                }
+            stage['calls'] += 1
+            stage['errors'] += span.error is not None
+            stage['total'] += span.duration
+            stage['max'] = max(stage['max'], span.duration)
+        start = spans[0].start
+        end = max(span.end for span in spans)
+        return {
+            'envelope_id': envelope_id,
+            'start': start,
+            'end': end,
+            'duration': end - start,
+            'stages': sorted(stages.values(), key=lambda s: s['first']),
+            'spans': [span.as_dict() for span in spans],
+        }
+
+    def export(self, path: str, fmt: str='json') -> int:
+        """Append the spans recorded since the previous export to a file;
+        those which have already been dropped from the buffer are lost.
+
+        :param path:
+         the path of the file
+
+        :param fmt:
+         'json' writes one JSON object per span and per line; 'otlp' writes
+         one OTLP/JSON ExportTraceServiceRequest per line, the format of the
+         file exporter of the OpenTelemetry collector
+
+        :return:
+         the number of exported spans
+        """
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError('Unknown trace export format: %s' % fmt)
+        count = min(self.recorded - self.exported, len(self.spans))
+        self.exported = self.recorded
+        if not count:
+            return 0
+        spans = list(self.spans)[-count:]
+        if fmt == 'otlp':
+            lines = [json.dumps(otlp_request(spans))]
+        else:
+            lines = [json.dumps(span.as_dict()) for span in spans]
+        with open(path, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+        return count
+
+    def start(self, path: str, fmt: str='json', interval: float=10):
+        """Export the new spans to a file in the background, see
+        :meth:`export`.
+        """
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError('Unknown trace export format: %s' % fmt)
+        if self.task is None:
+            self.task = asyncio.async(
+                self.watch(path, fmt, interval), loop=self.loop
+            )
+
+    def stop(self):
+        """Stop exporting the spans.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    @asyncio.coroutine
+    def watch(self, path: str, fmt: str, interval: float):
+        """Internal helper method used to export the new spans every
+        `interval` seconds until cancelled.
+        """
+        while True:
+            yield from asyncio.sleep(interval, loop=self.loop)
+            try:
+                self.export(path, fmt)
+            except Exception:
+                logger.exception('Could not export the spans to %s', path)
+
+
+TRACER = Tracer()
+
+
+def _trace_id(envelope_id: str) -> str:
+    """Turn an envelope ID into an OTLP trace ID (32 hexadecimal digits);
+    the UUIDs generated by the front are used as they are.
+    """
+    if len(envelope_id) == 32:
+        try:
+            int(envelope_id, 16)
+            return envelope_id
+        except ValueError:
+            pass
+    return hashlib.md5(envelope_id.encode()).hexdigest()
+
+
+def _otlp_attribute(key: str, value: str) -> dict:
+    return {'key': key, 'value': {'stringValue': value}}
+
+
+def otlp_request(spans: list) -> dict:
+    """Encode spans as an OTLP/JSON ExportTraceServiceRequest. The trace of a
+    span is its envelope.
+
+    :param spans:
+     the :class:`Span` instances
+    """
+    encoded = []
+    for span in spans:
+        attributes = [
+            _otlp_attribute('xbus.component', span.component or ''),
+            _otlp_attribute('xbus.envelope_id', span.envelope_id),
+        ]
+        if span.event_id is not None:
+            attributes.append(_otlp_attribute('xbus.event_id', span.event_id))
+        status = {}
+        if span.error is not None:
+            status = {'code': 2, 'message': span.error}
+        encoded.append({
+            'traceId': _trace_id(span.envelope_id),
+            'spanId': '%016x' % random.getrandbits(64),
+            'name': '%s.%s' % (span.component, span.stage),
+            'kind': 1,
+            'startTimeUnixNano': str(int(span.start * 1e9)),
+            'endTimeUnixNano': str(int(span.end * 1e9)),
+            'attributes': attributes,
+            'status': status,
+        })
+    return {'resourceSpans': [{
+        'resource': {'attributes': [
+            _otlp_attribute('service.name', 'xbus.broker'),
+        ]},
+        'scopeSpans': [{
+            'scope': {'name': __name__},
+            'spans': encoded,
+        }],
+    }]}
+
+
+def _argument(params: list, name: str):
+    """Find the position of a parameter, or None."""
+    try:
+        return params.index(name)
+    except ValueError:
+        return None
+
+
+def traced(stage: str, result: str=None):
+    """Decorate a coroutine method so that its calls are recorded as spans
+    by :data:`TRACER`.
+
+    The envelope ID is read from its `envelope_id` argument, or else from
+    the `envelope_id` attribute of the instance, and the event ID from its
+    `event_id` argument or the `event_id` attribute of its `event` argument.
+    The component is the `component` attribute of the instance.
+
+    :param stage:
+     the name of the stage
+
+    :param result:
+     'envelope_id' or 'event_id' if the method creates the envelope or the
+     event and returns its ID
+    """
+    def decorator(func):
+        params = list(inspect.signature(func).parameters)
+        positions = {
+            name: _argument(params, name)
+            for name in ('envelope_id', 'event_id', 'event')
+        }
+
+        def argument(args, kwargs, name):
+            position = positions[name]
+            if position is not None and position < len(args):
+                return args[position]
+            return kwargs.get(name)
+
+        @asyncio.coroutine
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = TRACER
+            if not tracer.sample_rate:
+                res = yield from func(*args, **kwargs)
+                return res
+
+            ids = {
+                'envelope_id': argument(args, kwargs, 'envelope_id'),
+                'event_id': argument(args, kwargs, 'event_id'),
+            }
+            if ids['envelope_id'] is None:
+                ids['envelope_id'] = getattr(args[0], 'envelope_id', None)
+            if ids['event_id'] is None:
+                event = argument(args, kwargs, 'event')
+                ids['event_id'] = getattr(event, 'event_id', None)
+            # The ID of a new envelope is only known once it is created.
+            if ids['envelope_id'] is None:
+                skip = result != 'envelope_id'
+            else:
+                skip = not tracer.sampled(ids['envelope_id'])
+            if skip:
+                res = yield from func(*args, **kwargs)
+                return res
+
+            error = None
+            res = None
+            start = time.time()
+            try:
+                res = yield from func(*args, **kwargs)
+                return res
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                end = time.time()
+                if result is not None and isinstance(res, str) and res:
+                    ids[result] = res
+                envelope_id = ids['envelope_id']
+                if envelope_id and tracer.sampled(envelope_id):
+                    tracer.record(Span(
+                        stage, getattr(args[0], 'component', None),
+                        envelope_id, ids['event_id'], start, end, error,
+                    ))
+        return wrapper
+    return decorator
+
+
+def setup_tracing(config, loop=None):
+    """A helper function that is used internally to configure
+    :data:`TRACER` from the `tracing` section of the configuration. The
+    front and the backend both call it; the export is only started once.
+
+    :param config:
+     the application configuration instance
+     :class:`configparser.ConfigParser`
+
+    :param loop:
+     the event loop used by the broker
+
+    :return:
+     the :class:`Tracer`, or None if tracing is disabled
+    """
+    if not config.getboolean('tracing', 'enabled', fallback=False):
+        return None
+    TRACER.sample_rate = config.getfloat(
+        'tracing', 'sample_rate', fallback=0.01
+    )
+    TRACER.resize(config.getint('tracing', 'buffer_size', fallback=10000))
+    TRACER.loop = loop
+    path = config.get('tracing', 'export_file', fallback=None)
+    if path:
+        TRACER.start(
+            path, config.get('tracing', 'export_format', fallback='json'),
+            config.getfloat('tracing', 'export_interval', fallback=10),
+        )
+    return TRACER
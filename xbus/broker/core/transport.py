@@ -0,0 +1,313 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+import socket
+import time
+import zmq
+
+import aiozmq
+from aiozmq.rpc import ServiceClosedError
+from aiozmq.rpc.base import Service
+from aiozmq.rpc.rpc import _ServerProtocol
+
+# The options of the [zmq] configuration section applied to every socket of
+# the broker, and the 0mq socket options they set.
+SOCKET_OPTIONS = {
+    'sndhwm': zmq.SNDHWM,
+    'rcvhwm': zmq.RCVHWM,
+    'sndbuf': zmq.SNDBUF,
+    'rcvbuf': zmq.RCVBUF,
+    'linger': zmq.LINGER,
+    'tcp_keepalive': zmq.TCP_KEEPALIVE,
+    'tcp_keepalive_idle': zmq.TCP_KEEPALIVE_IDLE,
+    'tcp_keepalive_cnt': zmq.TCP_KEEPALIVE_CNT,
+    'tcp_keepalive_intvl': zmq.TCP_KEEPALIVE_INTVL,
+}
+
+
+def with_peer(func):
+    """Decorator marking an RPC method which must receive the 0mq routing
+    identity of its caller, as a `peer` keyword argument, when it is served
+    by :func:`serve_peer_rpc`. The value given by the caller, if any, is
+    always replaced.
+    """
+    func.with_peer = True
+    return func
+
+
+class ServerProtocol(_ServerProtocol):
+    """An RPC server protocol recording the calls to the methods of its
+    handler in an :class:`.RPCMetrics`.
+
+    Every dispatched call is counted. The latency is measured for the
+    coroutine methods, from their dispatch to their result; the other
+    methods return before their call is even scheduled.
+    """
+
+    def __init__(self, loop, handler, metrics=None):
+        super(ServerProtocol, self).__init__(loop, handler)
+        self.metrics = metrics
+        self.dispatched = None
+        # {future: (RPC metrics, start time)}
+        self.started = {}
+
+    def dispatch(self, name):
+        func = super(ServerProtocol, self).dispatch(name)
+        if self.metrics is not None:
+            self.dispatched = self.metrics.method(name)
+            self.dispatched[0].inc()
+        return func
+
+    def add_pending(self, coro):
+        fut = super(ServerProtocol, self).add_pending(coro)
+        if self.dispatched is not None:
+            self.started[fut] = (self.dispatched, time.monotonic())
+            self.dispatched = None
+        return fut
+
+    def process_call_result(self, fut, *, name, **kwargs):
+        started = self.started.pop(fut, None)
+        if started is not None:
+            (calls, errors, latency), start = started
+            latency.observe(time.monotonic() - start)
+        elif self.metrics is not None and name in self.metrics.methods:
+            calls, errors, latency = self.metrics.methods[name]
+        else:
+            errors = None
+        if (
+            errors is not None and not fut.cancelled() and
+            fut.exception() is not None
+        ):
+            errors.inc()
+        self.dispatched = None
+        super(ServerProtocol, self).process_call_result(
+            fut, name=name, **kwargs
+        )
+
+
+class PeerServerProtocol(ServerProtocol):
+    """An RPC server protocol giving its caller's routing identity to the
+    methods decorated with :func:`with_peer`.
+
+    The identity of a request is known while it is being dispatched, which is
+    done synchronously by :meth:`msg_received` before the method is called.
+    """
+
+    peer = None
+
+    def msg_received(self, data):
+        # The routing identity is the first frame received on a ROUTER socket.
+        self.peer = data[0] if len(data) > 4 else None
+        try:
+            super(PeerServerProtocol, self).msg_received(data)
+        finally:
+            self.peer = None
+
+    def check_args(self, func, args, kwargs):
+        if getattr(func, 'with_peer', False):
+            kwargs = dict(kwargs, peer=self.peer)
+        return super(PeerServerProtocol, self).check_args(func, args, kwargs)
+
+
+def call_many(clients: list, name: str, args: tuple, loop=None) -> list:
+    """Call the same method with the same arguments on several RPC
+    clients, encoding the request once and writing the same frames to every
+    socket, so that the cost of a fan-out does not grow with the size of
+    the arguments times the number of clients.
+
+    The clients must use the default translation table. This relies on the
+    internals of the client protocol of aiozmq; it falls back to one regular
+    call per client if they are not available.
+
+    :param clients:
+     the :class:`aiozmq.rpc.RPCClient` instances to call
+
+    :param name:
+     the name of the remote method
+
+    :param args:
+     the positional arguments of the call
+
+    :param loop:
+     the event loop the clients run with
+
+    :return:
+     a list with the future of the reply of each client
+    """
+    try:
+        protocols = [client._proto for client in clients]
+        frames = [
+            name.encode('utf-8'),
+            protocols[0].packer.packb(args),
+            protocols[0].packer.packb({}),
+        ]
+    except (AttributeError, IndexError):
+        return [getattr(client.call, name)(*args) for client in clients]
+
+    futures = []
+    for protocol in protocols:
+        future = asyncio.Future(loop=loop)
+        if protocol.transport is None:
+            future.set_exception(ServiceClosedError())
+        else:
+            header, req_id = protocol._new_id()
+            protocol.calls[req_id] = future
+            protocol.transport.write([header] + frames)
+        futures.append(future)
+    return futures
+
+
+class SocketTuning(object):
+    """The options applied to every 0mq socket the broker creates, from the
+    [zmq] section of the configuration (see :data:`SOCKET_OPTIONS`).
+
+    The options must be set before a socket binds or connects, so the
+    sockets are created unbound, tuned, then bound or connected.
+    """
+
+    def __init__(self, options: dict=None, prefer_ipc: bool=True):
+        """
+        :param options:
+         the 0mq socket options: {zmq option: value}
+
+        :param prefer_ipc:
+         whether to connect to the recipients running on the same host
+         through the ipc:// endpoint they may announce
+        """
+        self.options = options or {}
+        self.prefer_ipc = prefer_ipc
+
+    def apply(self, sock):
+        """Set the options on a socket.
+
+        :param sock:
+         a :class:`zmq.Socket` or an aiozmq transport
+        """
+        for option, value in self.options.items():
+            sock.setsockopt(option, value)
+
+    @asyncio.coroutine
+    def connect_rpc(self, connect: str, *, loop=None, **kwargs):
+        """A replacement for :func:`aiozmq.rpc.connect_rpc` applying the
+        options before connecting.
+        """
+        client = yield from aiozmq.rpc.connect_rpc(loop=loop, **kwargs)
+        self.apply(client.transport)
+        yield from client.transport.connect(connect)
+        return client
+
+    @asyncio.coroutine
+    def serve_rpc(self, handler, *, bind: str, loop=None, metrics=None):
+        """A replacement for :func:`aiozmq.rpc.serve_rpc` applying the
+        options before binding, and recording the calls in `metrics` (see
+        :class:`ServerProtocol`).
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        transport, protocol = yield from self.create_zmq_connection(
+            lambda: ServerProtocol(loop, handler, metrics),
+            zmq.ROUTER, bind=bind, loop=loop
+        )
+        return Service(loop, protocol)
+
+    @asyncio.coroutine
+    def create_zmq_connection(
+        self, protocol_factory, zmq_type, *, bind=None, connect=None,
+        loop=None
+    ):
+        """A replacement for :func:`aiozmq.create_zmq_connection` applying
+        the options before binding or connecting.
+        """
+        transport, protocol = yield from aiozmq.create_zmq_connection(
+            protocol_factory, zmq_type, loop=loop
+        )
+        self.apply(transport)
+        if bind is not None:
+            yield from transport.bind(bind)
+        if connect is not None:
+            yield from transport.connect(connect)
+        return transport, protocol
+
+    def endpoint_for(self, url: str, metadata: dict) -> str:
+        """Choose the endpoint of a recipient: its "ipc_uri", if it
+        announces one in its metadata and runs on the same host.
+
+        :param url:
+         the endpoint the recipient registered with
+
+        :param metadata:
+         the metadata of the recipient
+        """
+        ipc_uri = metadata.get('ipc_uri')
+        if (
+            self.prefer_ipc and ipc_uri and ipc_uri.startswith('ipc://') and
+            metadata.get('host') == socket.gethostname()
+        ):
+            return ipc_uri
+        return url
+
+
+def get_socket_tuning(config) -> SocketTuning:
+    """A helper function that is used internally to read the tuning of
+    the sockets from the `zmq` section of the configuration. It also sets
+    the number of I/O threads of the 0mq context, which must be done before
+    any socket is created.
+
+    :param config:
+     the application configuration instance
+     :class:`configparser.ConfigParser`
+
+    :return:
+     a :class:`SocketTuning`
+    """
+    io_threads = config.getint('zmq', 'io_threads', fallback=0)
+    if io_threads:
+        zmq.Context.instance().set(zmq.IO_THREADS, io_threads)
+
+    options = {}
+    for name, option in SOCKET_OPTIONS.items():
+        value = config.getint('zmq', name, fallback=None)
+        if value is not None:
+            options[option] = value
+    return SocketTuning(
+        options, config.getboolean('zmq', 'prefer_ipc', fallback=True)
+    )
+
+
+@asyncio.coroutine
+def serve_peer_rpc(
+    handler, *, bind=None, loop=None, tuning=None, metrics=None
+):
+    """A replacement for :func:`aiozmq.rpc.serve_rpc` serving the handler
+    with a :class:`PeerServerProtocol`.
+
+    :param handler:
+     the :class:`aiozmq.rpc.AttrHandler` instance to serve
+
+    :param bind:
+     the address the 0mq socket is bound to
+
+    :param loop:
+     the event loop the server must run with
+
+    :param tuning:
+     the :class:`SocketTuning` of the socket
+
+    :param metrics:
+     the :class:`.RPCMetrics` the calls are recorded in, if any
+
+    :return:
+     a :class:`aiozmq.rpc.Service` instance
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    if tuning is None:
+        tuning = SocketTuning()
+
+    transport, protocol = yield from tuning.create_zmq_connection(
+        lambda: PeerServerProtocol(loop, handler, metrics),
+        zmq.ROUTER, bind=bind, loop=loop
+    )
+    return Service(loop, protocol)
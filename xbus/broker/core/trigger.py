@@ -0,0 +1,57 @@
+# -*- encoding: utf-8 -*-
+__author__ = 'jgavrel'
+
+import asyncio
+
+
+class Trigger(object):
+    """A Trigger wakes up the coroutines waiting for the state of an
+    envelope, an event or a node to change, until it is cancelled.
+
+    Most of them are never waited on, so the underlying future is only
+    created when a coroutine starts waiting.
+    """
+
+    __slots__ = ('loop', 'future', 'cancelled')
+
+    def __init__(self, loop=None):
+        """
+        :param loop:
+         the event loop of the waiting coroutines
+        """
+        self.loop = loop
+        self.future = None
+        self.cancelled = False
+
+    @asyncio.coroutine
+    def wait(self) -> bool:
+        """Wait until the trigger is fired or cancelled.
+
+        :return:
+         True if it has been fired, False if it has been cancelled
+        """
+        if self.cancelled:
+            return False
+        if self.future is None:
+            self.future = asyncio.Future(loop=self.loop)
+        res = yield from self.future
+        return res
+
+    def fire(self):
+        """Wake up the waiting coroutines, if any.
+        """
+        if self.cancelled:
+            return
+        self._wake(True)
+
+    def cancel(self):
+        """Wake up the waiting coroutines, and those which will wait later
+        on, with a False result.
+        """
+        self.cancelled = True
+        self._wake(False)
+
+    def _wake(self, res: bool):
+        future, self.future = self.future, None
+        if future is not None and not future.done():
+            future.set_result(res)
@@ -6,7 +6,7 @@ import datetime
 from uuid import uuid4
 
 from sqlalchemy import Table, ForeignKey, Column
-from sqlalchemy.types import (Unicode, Integer, DateTime)
+from sqlalchemy.types import (Unicode, Integer, DateTime, Float)
 
 from xbus.broker.model import metadata
 from xbus.broker.model.types import UUID
@@ -94,4 +94,9 @@ emitter = Table(
            ForeignKey('emitter_profile.id', ondelete='CASCADE'),
            nullable=False),
     Column('last_emit', DateTime),
+    # Limits enforced by the front, see :class:`.QuotaManager`; NULL means
+    # no limit besides the ones of the profile.
+    Column('item_rate', Float),
+    Column('byte_rate', Float),
+    Column('max_open_envelopes', Integer),
 )
@@ -0,0 +1,115 @@
+# -*- encoding: utf-8 -*-
+"""Compression of the items stored in the database.
+
+A compressed item starts with a header made of :data:`MAGIC` and a byte
+identifying the codec. Items without this header, which include every item
+stored before compression was introduced, are read as they are.
+"""
+__author__ = 'jgavrel'
+
+import lzma
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+# How the items of an event type are compressed when they are stored.
+COMPRESSIONS = ['none', 'zlib', 'lzma', 'lz4']
+
+MAGIC = b'\x00XZ'
+
+# Smaller items are not worth compressing.
+MIN_SIZE = 128
+
+_codec_ids = {'zlib': 1, 'lzma': 2, 'lz4': 3}
+_compressors = {
+    'zlib': lambda data: zlib.compress(data, 6),
+    'lzma': lambda data: lzma.compress(data, preset=1),
+}
+_decompressors = {
+    1: zlib.decompress,
+    2: lzma.decompress,
+}
+_errors = (zlib.error, lzma.LZMAError)
+if lz4 is not None:
+    _compressors['lz4'] = lz4.frame.compress
+    _decompressors[3] = lz4.frame.decompress
+    _errors += (RuntimeError,)
+
+
+def compress(data: bytes, compression: str) -> bytes:
+    """Compress the data of an item, if it is worth it.
+
+    :param data:
+     the item data
+
+    :param compression:
+     one of :data:`COMPRESSIONS`; the lz4 codec is only used when the lz4
+     package is installed
+
+    :return:
+     the data to store: the compressed data after a header, or the data
+     itself if it is small, does not compress, or the codec is unavailable
+    """
+    compressor = _compressors.get(compression)
+    if compressor is None or data is None or len(data) < MIN_SIZE:
+        return data
+    compressed = compressor(data)
+    if len(compressed) + len(MAGIC) + 1 >= len(data):
+        return data
+    return MAGIC + bytes((_codec_ids[compression],)) + compressed
+
+
+def compress_rows(rows: list, compressions: dict) -> list:
+    """Compress the data of item rows.
+
+    :param rows:
+     a list of dicts with the 'event_id', 'index' and 'data' keys
+
+    :param compressions:
+     the compression of each event: {event ID: compression}; the items of
+     the other events are left as they are
+
+    :return:
+     the rows, modified in place
+    """
+    for row in rows:
+        compression = compressions.get(row['event_id'], 'none')
+        if compression != 'none':
+            row['data'] = compress(row['data'], compression)
+    return rows
+
+
+def decompress(data: bytes) -> bytes:
+    """Read the data of a stored item.
+
+    :param data:
+     the data as stored
+
+    :return:
+     the item data
+    """
+    if data is None or not data.startswith(MAGIC):
+        return data
+    decompressor = _decompressors.get(data[len(MAGIC)])
+    if decompressor is None:
+        return data
+    try:
+        return decompressor(data[len(MAGIC) + 1:])
+    except _errors:
+        # Not compressed after all, but starting with the header.
+        return data
+
+
+def decompress_rows(rows: list) -> list:
+    """Read the data of stored item rows.
+
+    :param rows:
+     a list of (index, data) tuples, as stored
+
+    :return:
+     a new list of (index, data) tuples with the item data
+    """
+    return [(index, decompress(bytes(data))) for index, data in rows]
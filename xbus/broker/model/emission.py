@@ -8,7 +8,9 @@ from uuid import uuid4
 
 from sqlalchemy import Column
 from sqlalchemy import Enum
+from sqlalchemy import Float
 from sqlalchemy import ForeignKey
+from sqlalchemy import Integer
 from sqlalchemy import Table
 from sqlalchemy import Text
 from sqlalchemy import Unicode
@@ -54,6 +56,14 @@ emitter_profile = Table(
     ),
     Column("display_name", Unicode(255)),
     Column('description', Text),
+    # Share of the broker given to the emitters of the profile when several
+    # profiles are sending items at the same time.
+    Column('weight', Float, nullable=False, server_default='1'),
+    # Limits enforced by the front, see :class:`.QuotaManager`; NULL means
+    # no limit.
+    Column('item_rate', Float),
+    Column('byte_rate', Float),
+    Column('max_open_envelopes', Integer),
 )
 
 emitter_profile_event_type_rel = Table(
@@ -8,12 +8,18 @@ from sqlalchemy import ForeignKey
 from sqlalchemy import Column
 from sqlalchemy import Unicode
 from sqlalchemy import Boolean
+from sqlalchemy import Enum
+from sqlalchemy import Integer
 
 from sqlalchemy.types import Text
 
 from xbus.broker.model import metadata
+from xbus.broker.model.compression import COMPRESSIONS
 from xbus.broker.model.types import UUID
 
+# How the items of an event are persisted by the front: before each item is
+# acknowledged, in batches written in the background, or not at all.
+DURABILITY_LEVELS = ['sync', 'group', 'none']
 
 event_type = Table(
     'event_type', metadata,
@@ -24,6 +30,20 @@ event_type = Table(
     # See the "immediate reply" part of the Xbus documentation for details on
     # this field.
     Column('immediate_reply', Boolean),
+
+    # See the "durability" part of the Xbus documentation for details on this
+    # field.
+    Column('durability', Enum(*DURABILITY_LEVELS, name='durability_level'),
+           nullable=False, server_default='sync'),
+
+    # Number of seconds the backend may serve the reply of a consumer to
+    # identical immediate reply events from its cache; 0 disables the cache.
+    Column('reply_cache_ttl', Integer, nullable=False, server_default='0'),
+
+    # How the items of the events of this type are compressed when they are
+    # stored; see the "durability" part of the Xbus documentation.
+    Column('compression', Enum(*COMPRESSIONS, name='item_compression'),
+           nullable=False, server_default='none'),
 )
 
 event_node = Table(
@@ -6,9 +6,16 @@ from sqlalchemy import func
 from sqlalchemy import select
 from sqlalchemy import desc
 from sqlalchemy import join
+from sqlalchemy import and_
+from sqlalchemy.dialects import postgresql
 
+from xbus.broker.model.compression import decompress_rows
 from xbus.broker.model.event import event_node
 from xbus.broker.model.event import event_node_rel
+from xbus.broker.model.event import event_type
+from xbus.broker.model.logging import envelope
+from xbus.broker.model.logging import event
+from xbus.broker.model.logging import item
 from xbus.broker.model.types import UUIDArray
 from xbus.broker.model import service
 from xbus.broker.model import role
@@ -64,3 +71,101 @@ def get_consumer_roles(dbengine):
     cr = yield from dbengine.execute(query)
     res = yield from cr.fetchall()
     return res
+
+
+@asyncio.coroutine
+def get_envelopes_by_state(dbengine, state):
+    query = select([envelope.c.id])
+    query = query.where(envelope.c.state == state)
+    query = query.order_by(envelope.c.posted_date)
+    cr = yield from dbengine.execute(query)
+    res = yield from cr.fetchall()
+    return [row[0] for row in res]
+
+
+@asyncio.coroutine
+def get_envelope_events(dbengine, envelope_id):
+    query = select(
+        [
+            event.c.id,
+            event.c.type_id,
+            event_type.c.name,
+        ]
+    )
+    query = query.where(event.c.envelope_id == envelope_id)
+    query = query.select_from(
+        join(event, event_type, event_type.c.id == event.c.type_id)
+    )
+    query = query.order_by(event.c.started_date, event.c.id)
+    cr = yield from dbengine.execute(query)
+    res = yield from cr.fetchall()
+    return res
+
+
+@asyncio.coroutine
+def get_event_info(dbengine, event_id):
+    query = select(
+        [
+            event.c.envelope_id,
+            event.c.type_id,
+            event_type.c.name,
+            func.count(item.c.index).label('nb_items'),
+        ]
+    )
+    query = query.where(event.c.id == event_id)
+    query = query.select_from(
+        join(
+            join(event, event_type, event_type.c.id == event.c.type_id),
+            item,
+            item.c.event_id == event.c.id,
+            isouter=True,
+        )
+    )
+    query = query.group_by(event.c.envelope_id, event.c.type_id,
+                           event_type.c.name)
+    cr = yield from dbengine.execute(query)
+    res = yield from cr.first()
+    return res
+
+
+@asyncio.coroutine
+def open_item_cursor(dbengine, name, event_id, start=0):
+    """Declare a server-side cursor over the items of an event, in index
+    order. The connection must be inside a transaction; the rows are then
+    read using :func:`fetch_item_cursor`.
+    """
+    query = select([item.c.index, item.c.data])
+    query = query.where(
+        and_(item.c.event_id == event_id, item.c.index >= start)
+    )
+    query = query.order_by(item.c.index)
+    compiled = query.compile(dialect=postgresql.dialect())
+    yield from dbengine.execute(
+        'DECLARE {} NO SCROLL CURSOR FOR {}'.format(name, compiled),
+        compiled.params
+    )
+
+
+@asyncio.coroutine
+def fetch_item_cursor(dbengine, name, count, loop=None):
+    """Fetch the next rows of a cursor declared by :func:`open_item_cursor`,
+    as a list of (index, data) tuples. An empty list means the cursor is
+    exhausted. Compressed items are decompressed in the default executor of
+    the loop.
+    """
+    cr = yield from dbengine.execute(
+        'FETCH FORWARD {} FROM {}'.format(int(count), name)
+    )
+    res = yield from cr.fetchall()
+    if not res:
+        return []
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    rows = [(row[0], row[1]) for row in res]
+    res = yield from loop.run_in_executor(None, decompress_rows, rows)
+    return res
+
+
+@asyncio.coroutine
+def close_item_cursor(dbengine, name):
+    yield from dbengine.execute('CLOSE {}'.format(name))